@@ -1,7 +1,111 @@
 import hashlib
 import json
+import multiprocessing
 import os
 import base64
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from .config import config, _Config
+
+T = TypeVar("T")
+
+PARENT_CHECK_INTERVAL_S = 1.0
+
+
+class HasherBusy(Exception):
+    """Every hashing process is busy and AUTH_QUEUE_DEPTH more are waiting"""
+
+    pending: int
+
+    def __init__(self, pending: int):
+        self.pending = pending
+
+
+class PasswordHasher:
+    """Runs scrypt in a pool of worker processes, so that hashing passwords
+    doesn't take CPU (or GIL) from the process serving pages. The calling
+    handler thread waits on the result. Once every process is busy and
+    queue_depth more hashes are waiting, new ones are refused with
+    HasherBusy rather than queued without limit. With no processes,
+    hashing runs in the calling thread."""
+
+    processes: int
+    queue_depth: int
+    pending: int
+    pool: Optional[ProcessPoolExecutor]
+    lock: threading.Lock
+
+    def __init__(self, processes: int, queue_depth: int):
+        self.processes = processes
+        self.queue_depth = queue_depth
+        self.pending = 0
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def run(self, function: Callable[..., T], *args: Any) -> T:
+        if self.processes <= 0:
+            return function(*args)
+        with self.lock:
+            if self.pending >= self.processes + self.queue_depth:
+                raise HasherBusy(self.pending)
+            self.pending += 1
+            if self.pool is None:
+                # Spawned rather than forked, so the processes don't hold on
+                # to the server's sockets or copy its memory
+                self.pool = ProcessPoolExecutor(
+                    self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_exit_with_parent,
+                    initargs=(os.getpid(),),
+                )
+            pool = self.pool
+        try:
+            return pool.submit(function, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def close(self) -> None:
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+def _exit_with_parent(parent_pid: int) -> None:
+    """Runs in each hashing process. A server killed before it could close
+    the pool would otherwise leave them behind, holding its stdout open"""
+
+    def watch() -> None:
+        while os.getppid() == parent_pid:
+            time.sleep(PARENT_CHECK_INTERVAL_S)
+        os._exit(0)
+
+    threading.Thread(target=watch, name="parent-watch", daemon=True).start()
+
+
+_hasher = PasswordHasher(config.AUTH_PROCESSES, config.AUTH_QUEUE_DEPTH)
+
+
+def configure(server_config: _Config) -> None:
+    global _hasher
+    _hasher.close()
+    _hasher = PasswordHasher(
+        server_config.AUTH_PROCESSES, server_config.AUTH_QUEUE_DEPTH
+    )
+
+
+def close() -> None:
+    _hasher.close()
+
+
+def _reset_hasher() -> None:
+    # The parent's pool processes aren't this process's to use
+    global _hasher
+    _hasher = PasswordHasher(_hasher.processes, _hasher.queue_depth)
 
 
 def encode_password_v1(password: bytes) -> bytes:
@@ -29,4 +133,13 @@ def validate_password_v1(password: bytes, secret_bundle: bytes) -> bool:
 
 
 def encode_password(password: bytes) -> bytes:
-    return encode_password_v1(password)
+    """Raises HasherBusy if too many passwords are being hashed already"""
+    return _hasher.run(encode_password_v1, password)
+
+
+def validate_password(password: bytes, secret_bundle: bytes) -> bool:
+    """Raises HasherBusy if too many passwords are being hashed already"""
+    return _hasher.run(validate_password_v1, password, secret_bundle)
+
+
+os.register_at_fork(after_in_child=_reset_hasher)
@@ -1,4 +1,16 @@
-from .auth import encode_password_v1, validate_password_v1, encode_password
+import os
+import threading
+import time
+
+import pytest
+
+from .auth import (
+    HasherBusy,
+    PasswordHasher,
+    encode_password_v1,
+    validate_password_v1,
+    encode_password,
+)
 
 
 def test_encode_password_v1() -> None:
@@ -15,3 +27,56 @@ def test_encode_password_v1() -> None:
 def test_encode_password_is_v1() -> None:
     res = encode_password(b"testPassword")
     assert validate_password_v1(b"testPassword", res) is True
+
+
+def test_hasher_runs_in_worker_processes() -> None:
+    hasher = PasswordHasher(processes=1, queue_depth=0)
+    try:
+        assert hasher.run(os.getpid) != os.getpid()
+
+        slow = threading.Thread(target=hasher.run, args=(time.sleep, 0.5))
+        slow.start()
+        while hasher.pending == 0:
+            time.sleep(0.01)
+        with pytest.raises(HasherBusy):
+            hasher.run(os.getpid)
+        slow.join()
+        assert hasher.pending == 0
+    finally:
+        hasher.close()
+
+
+def test_hasher_without_processes_runs_inline() -> None:
+    hasher = PasswordHasher(processes=0, queue_depth=0)
+    assert hasher.run(os.getpid) == os.getpid()
+    assert hasher.pool is None
+
+
+def _running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # Orphans may sit as zombies if nothing reaps them
+            return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/stat"), reason="needs /proc")
+def test_hasher_processes_exit_with_their_parent() -> None:
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Dies without closing the hasher, as if it were SIGKILLed
+        hasher = PasswordHasher(processes=1, queue_depth=0)
+        os.write(write_end, str(hasher.run(os.getpid)).encode())
+        os._exit(0)
+
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        hasher_pid = int(pipe.read())
+    os.waitpid(pid, 0)
+
+    deadline = time.monotonic() + 5
+    while _running(hasher_pid) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not _running(hasher_pid)
@@ -0,0 +1,369 @@
+"""Load test of the whole server. Builds a synthetic forum database, starts
+serve.run against it in a separate process and replays a mix of forum
+traffic from several keep-alive clients at once. Reports requests/s and
+latency percentiles per route, and saves them as JSON so runs can be
+compared between commits:
+
+    python3 -m nds_core.benchmarks.load --output before.json
+    python3 -m nds_core.benchmarks.load --compare before.json
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..auth import encode_password
+from ..config import _Config
+from ..storage import ColorData, Storage
+
+PASSWORD = b"benchmark"
+STATIC_FILES = ("/style.css", "/bedstead.otf")
+
+# Name, relative weight. Logins are rare but run scrypt, so are expensive
+TRAFFIC_MIX: List[Tuple[str, int]] = [
+    ("index", 30),
+    ("thread", 40),
+    ("static", 20),
+    ("reply", 8),
+    ("login", 2),
+]
+
+
+def build_database(
+    path: str, num_users: int, num_threads: int, posts_per_thread: int
+) -> None:
+    """Fills a new database with users, and threads with posts from random
+    users. Every user has the password PASSWORD"""
+    storage = Storage(path)
+    storage.connection.execute("PRAGMA synchronous = OFF;")
+
+    # Hashing is deliberately slow, so every user shares one secret
+    secret = encode_password(PASSWORD)
+    user_ids = [
+        storage.create_user(
+            f"user{i}",
+            secret,
+            ColorData(
+                r=random.randint(0, 255),
+                g=random.randint(0, 255),
+                b=random.randint(0, 255),
+            ),
+        )
+        for i in range(num_users)
+    ]
+
+    start_date = datetime.datetime.now() - datetime.timedelta(days=num_threads)
+    for i in range(num_threads):
+        post_date = start_date + datetime.timedelta(days=i)
+        thread_id = storage.create_thread(
+            post_date=post_date,
+            user_id=random.choice(user_ids),
+            title=f"Thread number {i}",
+            initial_post_content=f"First post of thread {i}. " * 5,
+        )
+        for j in range(posts_per_thread - 1):
+            storage.create_post_in_thread(
+                user_id=random.choice(user_ids),
+                thread_id=thread_id,
+                post_date=post_date + datetime.timedelta(minutes=j + 1),
+                post_content=f"Reply {j} to thread {i}. " * 5,
+            )
+    storage.close()
+
+
+def _serve(server_config: _Config) -> None:
+    # Keep the request log from drowning out the results
+    devnull = open(os.devnull, "w")
+    sys.stdout = devnull
+    os.dup2(devnull.fileno(), 1)
+
+    from ..serve import run
+
+    run(server_config)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def _wait_for_port(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class Client:
+    """One simulated browser, with a persistent connection and a session
+    for posting replies"""
+
+    port: int
+    num_users: int
+    num_threads: int
+    connection: http.client.HTTPConnection
+    session_cookie: Optional[str]
+    latencies: Dict[str, List[float]]
+    errors: Dict[str, int]
+
+    def __init__(self, port: int, num_users: int, num_threads: int):
+        self.port = port
+        self.num_users = num_users
+        self.num_threads = num_threads
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        self.session_cookie = None
+        self.latencies = {name: [] for name, _ in TRAFFIC_MIX}
+        self.errors = {name: 0 for name, _ in TRAFFIC_MIX}
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[Dict[str, str]] = None,
+        cookie: Optional[str] = None,
+    ) -> http.client.HTTPResponse:
+        headers = {"Accept-Encoding": "gzip"}
+        encoded_body = None
+        if body is not None:
+            encoded_body = urllib.parse.urlencode(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if cookie is not None:
+            headers["Cookie"] = cookie
+
+        try:
+            self.connection.request(method, url, encoded_body, headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            # Server closed a persistent connection, try again on a new one
+            self.connection.close()
+            self.connection.request(method, url, encoded_body, headers)
+            response = self.connection.getresponse()
+            response.read()
+        if response.getheader("Connection", "").lower() == "close":
+            self.connection.close()
+        return response
+
+    def login(self) -> http.client.HTTPResponse:
+        user_name = f"user{random.randrange(self.num_users)}"
+        response = self.request(
+            "POST",
+            "/user/login.html",
+            {"user_name": user_name, "password": PASSWORD.decode("utf-8")},
+        )
+        set_cookie = response.getheader("Set-Cookie")
+        if set_cookie is not None:
+            self.session_cookie = set_cookie.split(";", maxsplit=1)[0]
+        return response
+
+    def random_thread(self) -> str:
+        return f"/threads/{random.randint(1, self.num_threads)}/"
+
+    def run_one(self, name: str) -> None:
+        start = time.perf_counter()
+        if name == "index":
+            response = self.request("GET", "/index.html")
+        elif name == "thread":
+            response = self.request("GET", self.random_thread())
+        elif name == "static":
+            response = self.request("GET", random.choice(STATIC_FILES))
+        elif name == "reply":
+            response = self.request(
+                "POST",
+                self.random_thread() + "reply.html",
+                {"reply_content": "A benchmark reply"},
+                self.session_cookie,
+            )
+        else:
+            response = self.login()
+        self.latencies[name].append(time.perf_counter() - start)
+        if response.status >= 400:
+            self.errors[name] += 1
+
+    def run(self, stop_time: float) -> None:
+        names = [name for name, _ in TRAFFIC_MIX]
+        weights = [weight for _, weight in TRAFFIC_MIX]
+        while time.perf_counter() < stop_time:
+            self.run_one(random.choices(names, weights)[0])
+        self.connection.close()
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest rank percentile"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+def summarize(latencies: List[float], errors: int, duration: float) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_s": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_load(port: int, args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    clients = [Client(port, args.users, args.threads) for _ in range(args.clients)]
+    for client in clients:
+        client.login()
+
+    # Let caches and connections settle before measuring
+    warmup_end = time.perf_counter() + args.warmup
+    _run_clients(clients, lambda client: client.run(warmup_end))
+    for client in clients:
+        client.latencies = {name: [] for name, _ in TRAFFIC_MIX}
+        client.errors = {name: 0 for name, _ in TRAFFIC_MIX}
+
+    start = time.perf_counter()
+    stop_time = start + args.duration
+    _run_clients(clients, lambda client: client.run(stop_time))
+    duration = time.perf_counter() - start
+
+    results = {}
+    all_latencies: List[float] = []
+    all_errors = 0
+    for name, _ in TRAFFIC_MIX:
+        latencies = [t for client in clients for t in client.latencies[name]]
+        errors = sum(client.errors[name] for client in clients)
+        results[name] = summarize(latencies, errors, duration)
+        all_latencies += latencies
+        all_errors += errors
+    results["total"] = summarize(all_latencies, all_errors, duration)
+    return results
+
+
+def _run_clients(clients: List[Client], target: Callable[[Client], None]) -> None:
+    threads = [threading.Thread(target=target, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(
+    results: Dict[str, Dict[str, Any]],
+    previous: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> None:
+    print(
+        f"{'route':<8} {'requests':>9} {'errors':>7} {'req/s':>9}"
+        f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for name, stats in results.items():
+        print(
+            f"{name:<8} {stats['requests']:>9} {stats['errors']:>7}"
+            f" {stats['requests_per_s']:>9} {stats['p50_ms']:>8}"
+            f" {stats['p95_ms']:>8} {stats['p99_ms']:>8}"
+        )
+        if previous is not None and name in previous:
+            before = previous[name]
+            print(
+                f"{'  vs':<8} {'':>9} {'':>7}"
+                f" {_change(before['requests_per_s'], stats['requests_per_s']):>9}"
+                f" {_change(before['p50_ms'], stats['p50_ms']):>8}"
+                f" {_change(before['p95_ms'], stats['p95_ms']):>8}"
+                f" {_change(before['p99_ms'], stats['p99_ms']):>8}"
+            )
+
+
+def _change(before: float, after: float) -> str:
+    if before == 0:
+        return "-"
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=20, help="posts per thread")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds")
+    parser.add_argument("--workers", type=int, default=1, help="server processes")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, "benchmark.db")
+        print(
+            f"Building database: {args.users} users,"
+            f" {args.threads} threads x {args.posts} posts"
+        )
+        build_database(db_path, args.users, args.threads, args.posts)
+
+        server_config = _Config()
+        server_config.STORAGE_PATH = db_path
+        server_config.WEBSERVER_PORT = _free_port()
+        server_config.WEBSERVER_WORKER_PROCESSES = args.workers
+
+        server_process = multiprocessing.get_context("fork").Process(
+            target=_serve, args=(server_config,)
+        )
+        server_process.start()
+        try:
+            _wait_for_port(server_config.WEBSERVER_PORT, timeout=10)
+            print(f"Running {args.clients} clients for {args.duration}s")
+            results = run_load(server_config.WEBSERVER_PORT, args)
+        finally:
+            server_process.terminate()
+            server_process.join()
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as compare_file:
+            previous = json.load(compare_file)["results"]
+    print_results(results, previous)
+
+    if args.output is not None:
+        report = {
+            "revision": git_revision(),
+            "date": datetime.datetime.now().isoformat(),
+            "parameters": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Microbenchmark of request parsing plus the header/cookie lookups every
+request goes through, compared against the original list based parser.
+
+    python3 -m nds_core.benchmarks.parser
+"""
+
+import argparse
+import time
+from typing import Callable, List, Optional, Tuple
+
+from ..webserver import parse_request
+
+REQUEST = (
+    b"GET /threads/12/?after=40&q=hello%20world HTTP/1.1\r\n"
+    b"Host: 192.168.4.1:8080\r\n"
+    b"User-Agent: Mozilla/5.0 (Linux; Android 12; Pixel 6) AppleWebKit/537.36\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    b"Accept-Language: en-GB,en;q=0.9\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Referer: http://192.168.4.1:8080/index.html\r\n"
+    b"Connection: keep-alive\r\n"
+    b"Cookie: theme=dark; nds_core_auth=3q2+7wAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=\r\n"
+    b'If-None-Match: "anon-thread-12-40-1662773769-3"\r\n'
+    b"\r\n"
+)
+
+
+def legacy_parse_request(
+    raw: bytes,
+) -> Tuple[bytes, str, List[Tuple[bytes, bytes]], List[Tuple[str, str]]]:
+    """The parser as it was before HeaderMap, kept as the baseline"""
+    header, content = raw.split(b"\r\n\r\n", maxsplit=1)
+    lines = header.split(b"\r\n")
+
+    method_raw, url_raw, protocol = lines[0].strip().split(b" ")
+    headers: List[Tuple[bytes, bytes]] = [
+        tuple([t.strip() for t in line.split(b":", maxsplit=1)])  # type: ignore
+        for line in lines[1:]
+    ]
+
+    url_parts = url_raw.decode("utf-8").split("?", maxsplit=1)
+    url = url_parts[0]
+    query_str = url_parts[1] if len(url_parts) > 1 else ""
+    query_params = []
+    for query in query_str.split("&"):
+        spl = query.split("=", maxsplit=1)
+        key = spl[0]
+        val = spl[1] if len(spl) > 1 else ""
+        query_params.append((key, val))
+    return method_raw, url, headers, query_params
+
+
+def _legacy_get_header(
+    headers: List[Tuple[bytes, bytes]], name: bytes
+) -> Optional[bytes]:
+    name = name.lower()
+    for key, val in headers:
+        if key.lower() == name:
+            return val
+    return None
+
+
+def legacy_request_cycle() -> None:
+    _method, _url, headers, _query = legacy_parse_request(REQUEST)
+    for name in (
+        b"Transfer-Encoding",
+        b"Content-Length",
+        b"Connection",
+        b"If-None-Match",
+        b"Accept-Encoding",
+    ):
+        _legacy_get_header(headers, name)
+    for cookie_str in [h[1] for h in headers if h[0] == b"Cookie"]:
+        for cookie in cookie_str.split(b";"):
+            key, val = cookie.split(b"=", maxsplit=1)
+            if key.strip() == b"nds_core_auth":
+                val.decode("utf-8").strip()
+
+
+def request_cycle() -> None:
+    request = parse_request(REQUEST)
+    assert request is not None
+    for name in (
+        b"Transfer-Encoding",
+        b"Content-Length",
+        b"Connection",
+        b"If-None-Match",
+        b"Accept-Encoding",
+    ):
+        request.headers.get(name)
+    for key, _val in request.cookies:
+        if key == "nds_core_auth":
+            break
+
+
+def time_per_call(function: Callable[[], None], iterations: int) -> float:
+    """Best of 5 runs, in microseconds per call"""
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return best / iterations * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    legacy = time_per_call(legacy_request_cycle, args.iterations)
+    current = time_per_call(request_cycle, args.iterations)
+    print(f"legacy parser:  {legacy:6.2f} us/request")
+    print(f"current parser: {current:6.2f} us/request ({legacy / current:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
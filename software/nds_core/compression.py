@@ -0,0 +1,139 @@
+import gzip
+import os
+import zlib
+from typing import Iterable, Iterator, Optional
+
+from .config import _Config
+from .webserver import (
+    Body,
+    Headers,
+    HTTPRequest,
+    HTTPResponse,
+    PushStream,
+    get_header,
+    is_file_body,
+)
+
+ENCODINGS = ("gzip", "deflate")  # In order of preference
+
+
+def choose_encoding(request: HTTPRequest) -> Optional[str]:
+    """Picks the best encoding from the client's Accept-Encoding header, or
+    None if it doesn't accept any we can do"""
+    accept_encoding = request.headers.get(b"Accept-Encoding")
+    if accept_encoding is None:
+        return None
+
+    accepted = set()
+    for item in accept_encoding.decode("utf-8", errors="replace").split(","):
+        name, _, params = item.strip().lower().partition(";")
+        q_value = params.strip()
+        if q_value.startswith("q="):
+            try:
+                if float(q_value[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+
+    for encoding in ENCODINGS:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "gzip":
+        # mtime=0 so the same input always gives the same output
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zlib.compress(data, level)
+
+
+def compress_stream(
+    chunks: Iterable[bytes], encoding: str, level: int
+) -> Iterator[bytes]:
+    """Compresses each chunk as it comes. Every chunk is flushed through, so
+    the client can decompress and show it without waiting for the next"""
+    wbits = 31 if encoding == "gzip" else 15  # 31 adds gzip's header
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    chunk_iter = iter(chunks)
+    try:
+        for chunk in chunk_iter:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        # Passes on the server closing the stream early
+        close = getattr(chunk_iter, "close", None)
+        if close is not None:
+            close()
+
+
+def compress_response(
+    server_config: _Config, request: HTTPRequest, response: HTTPResponse
+) -> HTTPResponse:
+    """Compresses the response body if the client accepts it and it is worth
+    doing. Streamed bodies are compressed a chunk at a time as they are
+    sent"""
+    if get_header(response.headers, b"Content-Encoding") is not None:
+        return response
+
+    body = response.data
+    compressed: Body
+    if isinstance(body, bytes):
+        if len(body) < server_config.WEBSERVER_COMPRESS_MIN_BYTES:
+            return response
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return _with_vary(response)
+        compressed = compress(body, encoding, server_config.WEBSERVER_COMPRESS_LEVEL)
+
+    elif is_file_body(body):
+        # Static files come already compressed from the StaticCache
+        return response
+
+    elif isinstance(body, PushStream):
+        # Sent piece by piece as things happen, eg server-sent events
+        return response
+
+    else:
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return _with_vary(response)
+        compressed = compress_stream(
+            body, encoding, server_config.WEBSERVER_COMPRESS_LEVEL
+        )
+
+    return HTTPResponse(
+        response.status_code, compressed, encoded_headers(response.headers, encoding)
+    )
+
+
+def encoded_headers(headers: Headers, encoding: str) -> Headers:
+    """The headers for a response's body once it is compressed"""
+    encoded = []
+    for key, val in headers:
+        if key.lower() == b"content-length":
+            continue
+        if key.lower() == b"etag" and val.endswith(b'"'):
+            # The compressed bytes are a different representation, so they
+            # need their own ETag. conditional.py knows to strip this again
+            val = val[:-1] + b"-" + encoding.encode("utf-8") + b'"'
+        encoded.append((key, val))
+    encoded.append((b"Content-Encoding", encoding.encode("utf-8")))
+    encoded.append((b"Vary", b"Accept-Encoding"))
+    return encoded
+
+
+def _with_vary(response: HTTPResponse) -> HTTPResponse:
+    """Tells caches the body would have differed with another
+    Accept-Encoding"""
+    return HTTPResponse(
+        response.status_code,
+        response.data,
+        response.headers + [(b"Vary", b"Accept-Encoding")],
+    )
+
+
+def is_compressible_file(server_config: _Config, path: str) -> bool:
+    extension = os.path.splitext(path)[1].lower()
+    return extension not in server_config.WEBSERVER_COMPRESS_SKIP_EXTENSIONS
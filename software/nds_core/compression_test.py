@@ -0,0 +1,80 @@
+import gzip
+import zlib
+from typing import Iterator
+
+from .config import _Config
+from .webserver import HTTPRequest, HTTPResponse
+from .compression import choose_encoding, compress_response
+
+
+def make_request(accept_encoding: bytes) -> HTTPRequest:
+    return HTTPRequest(
+        method="GET",
+        url="/",
+        content=b"",
+        headers=[(b"Accept-Encoding", accept_encoding)],
+        query_params=[],
+    )
+
+
+def test_choose_encoding() -> None:
+    assert choose_encoding(make_request(b"gzip, deflate, br")) == "gzip"
+    assert choose_encoding(make_request(b"deflate")) == "deflate"
+    assert choose_encoding(make_request(b"gzip;q=0, deflate;q=0.5")) == "deflate"
+    assert choose_encoding(make_request(b"br")) is None
+
+
+def test_compresses_large_bodies_only() -> None:
+    body = b"<div>hello</div>" * 100
+    response = compress_response(
+        _Config(), make_request(b"gzip"), HTTPResponse(200, body)
+    )
+    assert (b"Content-Encoding", b"gzip") in response.headers
+    assert isinstance(response.data, bytes)
+    assert gzip.decompress(response.data) == body
+
+    response = compress_response(
+        _Config(), make_request(b"deflate"), HTTPResponse(200, body)
+    )
+    assert isinstance(response.data, bytes)
+    assert zlib.decompress(response.data) == body
+
+    response = compress_response(
+        _Config(), make_request(b"gzip"), HTTPResponse(200, b"tiny")
+    )
+    assert response.data == b"tiny"
+
+
+def test_compresses_streams_chunk_by_chunk() -> None:
+    closed = []
+
+    def stream() -> Iterator[bytes]:
+        try:
+            yield b"<head></head>"
+            yield b"<div>hello</div>" * 50
+        finally:
+            closed.append(True)
+
+    response = compress_response(
+        _Config(), make_request(b"gzip"), HTTPResponse(200, stream())
+    )
+    assert (b"Content-Encoding", b"gzip") in response.headers
+    assert isinstance(response.data, Iterator)
+
+    # The first chunk can be decompressed on its own
+    first = next(response.data)
+    decompressor = zlib.decompressobj(31)
+    assert decompressor.decompress(first) == b"<head></head>"
+    rest = b"".join(response.data)
+    assert gzip.decompress(first + rest) == b"<head></head>" + b"<div>hello</div>" * 50
+    assert closed == [True]
+
+    # Closing early closes the stream underneath
+    closed.clear()
+    response = compress_response(
+        _Config(), make_request(b"deflate"), HTTPResponse(200, stream())
+    )
+    assert isinstance(response.data, Iterator)
+    next(response.data)
+    getattr(response.data, "close")()
+    assert closed == [True]
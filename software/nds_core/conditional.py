@@ -0,0 +1,126 @@
+import datetime
+import email.utils
+from typing import List, Optional
+
+from .webserver import HTTPRequest, HTTPResponse, Headers, get_header
+from .server import discard_body
+
+# compression.py tags compressed representations of a resource by
+# appending these to its ETag. They still revalidate against the original
+_ENCODING_SUFFIXES = (b"-gzip", b"-deflate")
+
+
+def make_etag(*parts: object) -> bytes:
+    """Builds a strong ETag out of whatever identifies the version of a
+    resource"""
+    return b'"' + "-".join(str(p) for p in parts).encode("utf-8") + b'"'
+
+
+def http_date(date: datetime.datetime) -> bytes:
+    """Formats a date for Last-Modified. Naive datetimes are taken to be
+    local time"""
+    utc_date = date.astimezone(datetime.timezone.utc)
+    return email.utils.format_datetime(utc_date, usegmt=True).encode("utf-8")
+
+
+def validator_headers(
+    etag: Optional[bytes], last_modified: Optional[datetime.datetime]
+) -> Headers:
+    headers: Headers = []
+    if etag is not None:
+        headers.append((b"ETag", etag))
+    if last_modified is not None:
+        headers.append((b"Last-Modified", http_date(last_modified)))
+    return headers
+
+
+def is_not_modified(
+    request: HTTPRequest,
+    etag: Optional[bytes],
+    last_modified: Optional[datetime.datetime],
+) -> bool:
+    """True if the client's cached copy (from If-None-Match or
+    If-Modified-Since) is still current"""
+    if request.method not in ("GET", "HEAD"):
+        return False
+
+    if_none_match = request.headers.get(b"If-None-Match")
+    if if_none_match is not None:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if etag is None:
+            return False
+        if if_none_match.strip() == b"*":
+            return True
+        return _strip_etag(etag) in _parse_etags(if_none_match)
+
+    if_modified_since = request.headers.get(b"If-Modified-Since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since.decode("utf-8"))
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        # HTTP dates only have whole second resolution
+        modified = last_modified.astimezone().replace(microsecond=0)
+        return modified <= since
+
+    return False
+
+
+def not_modified_response(
+    etag: Optional[bytes],
+    last_modified: Optional[datetime.datetime],
+    headers: Headers = [],
+) -> HTTPResponse:
+    return HTTPResponse(
+        status_code=304, headers=headers + validator_headers(etag, last_modified)
+    )
+
+
+def conditional_response(request: HTTPRequest, response: HTTPResponse) -> HTTPResponse:
+    """Turns a 200 into a 304 if the client already has it. Handlers that
+    can check freshness before doing the expensive work should use
+    is_not_modified themselves, this catches everything else (eg static
+    files)"""
+    if response.status_code != 200:
+        return response
+
+    etag = get_header(response.headers, b"ETag")
+    last_modified_raw = get_header(response.headers, b"Last-Modified")
+    last_modified = None
+    if last_modified_raw is not None:
+        try:
+            last_modified = email.utils.parsedate_to_datetime(
+                last_modified_raw.decode("utf-8")
+            )
+        except (TypeError, ValueError):
+            pass
+
+    if not is_not_modified(request, etag, last_modified):
+        return response
+
+    discard_body(response.data)
+    return HTTPResponse(
+        status_code=304,
+        headers=[
+            h
+            for h in response.headers
+            if h[0].lower() in (b"etag", b"last-modified", b"cache-control", b"vary")
+        ],
+    )
+
+
+def _strip_etag(etag: bytes) -> bytes:
+    etag = etag.strip()
+    if etag.startswith(b"W/"):
+        etag = etag[2:]
+    etag = etag.strip(b'"')
+    for suffix in _ENCODING_SUFFIXES:
+        if etag.endswith(suffix):
+            etag = etag[: -len(suffix)]
+    return etag
+
+
+def _parse_etags(header: bytes) -> List[bytes]:
+    return [_strip_etag(e) for e in header.split(b",") if e.strip()]
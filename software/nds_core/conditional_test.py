@@ -0,0 +1,63 @@
+import datetime
+
+from .webserver import HTTPRequest, HTTPResponse, Headers
+from .conditional import (
+    make_etag,
+    http_date,
+    is_not_modified,
+    conditional_response,
+    validator_headers,
+)
+
+
+def make_request(headers: Headers) -> HTTPRequest:
+    return HTTPRequest(
+        method="GET",
+        url="/",
+        content=b"",
+        headers=headers,
+        query_params=[],
+    )
+
+
+def test_if_none_match() -> None:
+    etag = make_etag("thread", 1, 5)
+    assert etag == b'"thread-1-5"'
+
+    assert is_not_modified(make_request([(b"If-None-Match", etag)]), etag, None)
+    assert is_not_modified(
+        make_request([(b"If-None-Match", b'"other", W/"thread-1-5-gzip"')]), etag, None
+    )
+    assert not is_not_modified(
+        make_request([(b"If-None-Match", b'"thread-1-4"')]), etag, None
+    )
+    assert not is_not_modified(make_request([]), etag, None)
+
+
+def test_if_modified_since() -> None:
+    modified = datetime.datetime(2022, 9, 10, 12, 30, 15, 5000)
+    request = make_request([(b"If-Modified-Since", http_date(modified))])
+
+    assert is_not_modified(request, None, modified)
+    assert not is_not_modified(request, None, modified + datetime.timedelta(seconds=1))
+
+    # If-None-Match takes priority when both are present
+    request.headers.append(b"If-None-Match", b'"stale"')
+    assert not is_not_modified(request, b'"fresh"', modified)
+
+
+def test_conditional_response_strips_body() -> None:
+    etag = make_etag("static")
+    response = HTTPResponse(
+        200,
+        b"body",
+        [(b"Cache-Control", b"max-age=3600")] + validator_headers(etag, None),
+    )
+
+    fresh = conditional_response(make_request([(b"If-None-Match", etag)]), response)
+    assert fresh.status_code == 304
+    assert fresh.data == b""
+    assert (b"ETag", etag) in fresh.headers
+
+    stale = conditional_response(make_request([(b"If-None-Match", b'"x"')]), response)
+    assert stale is response
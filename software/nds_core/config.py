@@ -1,12 +1,135 @@
+from typing import Dict, Optional, Tuple
+
+
 class _Config:
     STORAGE: str = "SQLITE"
+    STORAGE_PATH: str = "testdb.db"
+    DEV_MODE: bool = False  # Reload page templates when their files change
+
+    LOG_LEVEL: str = "INFO"  # DEBUG, INFO, WARN or ERROR. Anything lower is skipped
+    LOG_QUEUE_SIZE: int = (
+        10000  # Lines buffered for the background writer. 0 writes synchronously
+    )
+    LOG_SAMPLE_EVERY: Dict[str, int] = (
+        {}  # Event name -> N, to only log every Nth of a high volume event
+    )
     WEBSERVER_PORT: int = 8080
+    WEBSERVER_BACKLOG: int = 128  # Max connections waiting to be accepted
 
-    WEBSERVER_BUFFER_SEND_MS: int = (
-        10  # Time to wait between sending large chunks of page data
+    WEBSERVER_WORKER_PROCESSES: int = (
+        1  # Number of forked server processes. 1 serves from the main process
+    )
+    WEBSERVER_REUSE_PORT: bool = (
+        True  # Give each worker its own socket with SO_REUSEPORT, where available
+    )
+    WEBSERVER_WORKER_RESTART_DELAY_MS: int = (
+        1000  # Wait before restarting a worker that crashed straight after starting
+    )
+    WEBSERVER_HANDLER_THREADS: int = (
+        4  # Threads running page handlers. 0 runs them on the selector thread
+    )
+    WEBSERVER_HANDLER_QUEUE_DEPTH: int = (
+        64  # Requests waiting on a handler thread before new ones get a 503
+    )
+    WEBSERVER_MAX_CONNECTIONS: int = (
+        512  # Open connections per process before new ones get a 503
     )
+    WEBSERVER_RETRY_AFTER_S: int = (
+        2  # Retry-After sent with 503s when the server is over capacity
+    )
+
     WEBSERVER_CLIENT_TIMEOUT_MS: int = (
-        1000  # Max time for a client to ack transmitting data
+        1000  # Max time a client can sit idle before it is disconnected
+    )
+    WEBSERVER_HEADER_TIMEOUT_MS: int = (
+        5000  # Max time a client can take to send a request line and headers
+    )
+    WEBSERVER_BODY_TIMEOUT_MS: int = (
+        30000  # Max time a client can take to send a request body
+    )
+    WEBSERVER_POLL_INTERVAL_MS: int = (
+        500  # Max time the server waits on the selector before housekeeping
+    )
+    WEBSERVER_RECV_BYTES: int = 4096  # Max bytes read from a client per recv
+    WEBSERVER_KEEP_ALIVE_TIMEOUT_MS: int = (
+        5000  # Max time an idle persistent connection is held open between requests
+    )
+    WEBSERVER_KEEP_ALIVE_MAX_REQUESTS: int = (
+        100  # Persistent connections are closed after serving this many requests
+    )
+    WEBSERVER_MAX_HEADER_BYTES: int = (
+        8192  # Requests with a larger request line + headers get a 431
+    )
+    WEBSERVER_MAX_BODY_BYTES: int = 1024 * 1024  # Requests with a larger body get a 413
+
+    WEBSERVER_METRICS_PATH: Optional[str] = (
+        None  # Serve Prometheus metrics at this url, eg "/metrics". None turns them off
+    )
+
+    WEBSERVER_STATIC_CACHE_BYTES: int = (
+        16 * 1024 * 1024  # Memory for static files and their compressed variants
+    )
+    WEBSERVER_STATIC_CACHE_MAX_FILE_BYTES: int = (
+        1024 * 1024  # Larger static files are sent from disk with sendfile
+    )
+    WEBSERVER_PAGE_CACHE_BYTES: int = (
+        8 * 1024 * 1024  # Rendered index and thread pages, 0 to turn off
+    )
+    WEBSERVER_STREAM_THREADS: bool = (
+        False  # Send thread pages as their posts are read, with chunked encoding
+    )
+    # Logins waiting on a hash hold a handler thread, so keep AUTH_PROCESSES +
+    # AUTH_QUEUE_DEPTH below WEBSERVER_HANDLER_THREADS to leave some for pages
+    AUTH_PROCESSES: int = (
+        2  # Processes hashing passwords. 0 hashes them on the handler thread
+    )
+    AUTH_QUEUE_DEPTH: int = (
+        1  # Passwords waiting to be hashed before new logins get a 503
+    )
+    SESSION_TOKENS: str = (
+        "KEY"  # New sessions are "KEY": kept in the database, or "SIGNED": tokens
+    )
+    SESSION_SIGNING_KEY: Optional[str] = (
+        None  # Signs session tokens. None uses a random key kept in the database
+    )
+    SESSION_REVOCATION_SYNC_S: float = (
+        2  # How often tokens revoked by other workers are picked up
+    )
+    SESSION_SWEEP_INTERVAL_S: float = 300  # How often expired sessions are deleted
+    SESSION_SWEEP_BATCH: int = 500  # Sessions deleted per write transaction
+    SESSION_CACHE_SIZE: int = 10000  # Sessions kept in memory, 0 to turn off
+    SESSION_CACHE_TTL_S: float = (
+        30  # How long a cached session is used before it is looked up again
+    )
+    SESSION_CACHE_SYNC_S: float = (
+        2  # How often sessions deleted by other workers are dropped from the cache
+    )
+    SESSION_CACHE_NEGATIVE_TTL_S: float = (
+        5  # How long a key with no session behind it is remembered
+    )
+    LIVE_UPDATES_POLL_MS: int = (
+        2000  # How often open threads are checked for posts made by other workers
+    )
+    LIVE_UPDATES_PING_MS: int = (
+        15000  # Keep-alive comment sent to idle live update streams
+    )
+
+    WEBSERVER_COMPRESS_MIN_BYTES: int = (
+        512  # Bodies smaller than this aren't worth compressing
+    )
+    WEBSERVER_COMPRESS_LEVEL: int = 6  # gzip/zlib compression level, 1-9
+    WEBSERVER_COMPRESS_SKIP_EXTENSIONS: Tuple[str, ...] = (
+        # Formats that are already compressed
+        ".otf",
+        ".woff",
+        ".woff2",
+        ".png",
+        ".jpg",
+        ".jpeg",
+        ".gif",
+        ".mp4",
+        ".zip",
+        ".gz",
     )
 
 
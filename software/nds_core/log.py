@@ -1,23 +1,180 @@
-from typing import Dict, Any
+from collections import deque
+from typing import Deque, Dict, Any, List, Optional, Tuple, Union
+import atexit
 import json
+import os
+import sys
+import threading
+
+from .config import config, _Config
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARN": WARN, "ERROR": ERROR}
+
+WRITE_BATCH = 256  # Max records written to stdout in one go
+WRITE_INTERVAL_S = 0.05  # How often the background writer wakes up
+
+Record = Tuple[str, str, Dict[str, Any]]  # level, event, data
+
+
+class _Writer:
+    """Formats and writes log records to stdout from a background thread,
+    so that callers never wait on json or the terminal/disk. Logging is just
+    an append to a deque, the writer wakes up every WRITE_INTERVAL_S and
+    writes out whatever has built up in one go. Records that arrive while
+    the buffer is full are dropped and counted rather than blocking the
+    caller."""
+
+    records: Deque[Union[Record, threading.Event]]
+    max_records: int
+    dropped: int
+    wake: threading.Event
+    stopping: bool
+    thread: threading.Thread
+
+    def __init__(self, max_records: int):
+        self.records = deque()
+        self.max_records = max_records
+        self.dropped = 0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, record: Record) -> None:
+        if len(self.records) >= self.max_records:
+            self.dropped += 1
+            return
+        self.records.append(record)
+
+    def flush(self, timeout: float = 1.0) -> None:
+        """Waits for everything logged so far to be written"""
+        done = threading.Event()
+        self.records.append(done)
+        self.wake.set()
+        done.wait(timeout)
+
+    def close(self, timeout: float = 1.0) -> None:
+        """Writes out what is left and stops the thread"""
+        self.stopping = True
+        self.wake.set()
+        self.thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            self.wake.wait(WRITE_INTERVAL_S)
+            self.wake.clear()
+            while self.records or self.dropped:
+                self._write_batch()
+            if self.stopping:
+                return
+
+    def _write_batch(self) -> None:
+        batch: List[str] = []
+        waiting: List[threading.Event] = []
+        while self.records and len(batch) < WRITE_BATCH:
+            record = self.records.popleft()
+            if isinstance(record, threading.Event):
+                waiting.append(record)
+            else:
+                batch.append(_format(*record))
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            batch.append(_format("WARN", "log_dropped", {"count": dropped}))
+        if batch:
+            try:
+                sys.stdout.write("\n".join(batch) + "\n")
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                pass  # Nowhere left to complain to
+        for done in waiting:
+            done.set()
+
+
+_min_level = LEVELS[config.LOG_LEVEL]
+_sample_every: Dict[str, int] = dict(config.LOG_SAMPLE_EVERY)
+_sample_counts: Dict[str, int] = {}
+_queue_size = config.LOG_QUEUE_SIZE
+_writer: Optional[_Writer] = None
+_writer_lock = threading.Lock()
+
+
+def configure(server_config: _Config) -> None:
+    global _min_level, _sample_every, _queue_size, _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        # The next record logged starts a writer with the new queue size
+        writer.close()
+    _min_level = LEVELS[server_config.LOG_LEVEL]
+    _sample_every = dict(server_config.LOG_SAMPLE_EVERY)
+    _sample_counts.clear()
+    _queue_size = server_config.LOG_QUEUE_SIZE
+
+
+def flush() -> None:
+    if _writer is not None:
+        _writer.flush()
+
+
+def _reset_writer() -> None:
+    # Run in forked children: the writer thread doesn't survive the fork,
+    # and anything still queued was the parent's to write
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+def _format(level: str, event: str, data: Dict[str, Any]) -> str:
+    return f"{level} -- {event} -- {json.dumps(data)}"
 
 
 def _log(level: str, event: str, data: Dict[str, Any]) -> None:
-    msg = f"{level} -- {event} -- {json.dumps(data)}"
-    print(msg)
+    global _writer
+    sample_every = _sample_every.get(event)
+    if sample_every is not None and sample_every > 1:
+        # Only every Nth of these high volume events is kept
+        count = _sample_counts.get(event, 0)
+        _sample_counts[event] = count + 1
+        if count % sample_every:
+            return
+        data = {**data, "sample_every": sample_every}
+
+    if _queue_size <= 0:
+        print(_format(level, event, data))
+        return
+    writer = _writer
+    if writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = _Writer(_queue_size)
+            writer = _writer
+    writer.put((level, event, data))
 
 
 def info(event: str, data: Dict[str, Any]) -> None:
-    _log("INFO", event, data)
+    if _min_level <= INFO:
+        _log("INFO", event, data)
 
 
 def warn(event: str, data: Dict[str, Any]) -> None:
-    _log("WARN", event, data)
+    if _min_level <= WARN:
+        _log("WARN", event, data)
 
 
 def error(event: str, data: Dict[str, Any]) -> None:
-    _log("ERROR", event, data)
+    if _min_level <= ERROR:
+        _log("ERROR", event, data)
 
 
 def debug(event: str, data: Dict[str, Any]) -> None:
-    _log("DEBUG", event, data)
+    if _min_level <= DEBUG:
+        _log("DEBUG", event, data)
+
+
+os.register_at_fork(after_in_child=_reset_writer)
+atexit.register(flush)
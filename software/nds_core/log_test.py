@@ -0,0 +1,59 @@
+from typing import Iterator
+
+import pytest
+
+from . import log
+from .config import _Config
+
+
+def make_config(queue_size: int) -> _Config:
+    log_config = _Config()
+    log_config.LOG_LEVEL = "INFO"
+    log_config.LOG_QUEUE_SIZE = queue_size
+    log_config.LOG_SAMPLE_EVERY = {"noisy": 3}
+    return log_config
+
+
+@pytest.fixture(autouse=True)
+def restore_log_config() -> Iterator[None]:
+    yield
+    log.configure(_Config())
+
+
+def test_filters_by_level(capsys: pytest.CaptureFixture[str]) -> None:
+    log.configure(make_config(0))
+    log.debug("hidden", {})
+    log.info("shown", {"a": 1})
+    assert capsys.readouterr().out == 'INFO -- shown -- {"a": 1}\n'
+
+
+def test_samples_noisy_events(capsys: pytest.CaptureFixture[str]) -> None:
+    log.configure(make_config(0))
+    for i in range(7):
+        log.info("noisy", {"i": i})
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(" -- ")[2] for line in lines] == [
+        '{"i": 0, "sample_every": 3}',
+        '{"i": 3, "sample_every": 3}',
+        '{"i": 6, "sample_every": 3}',
+    ]
+
+
+def test_background_writer(capsys: pytest.CaptureFixture[str]) -> None:
+    log.configure(make_config(100))
+    for i in range(10):
+        log.warn("queued", {"i": i})
+    log.flush()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == [f'WARN -- queued -- {{"i": {i}}}' for i in range(10)]
+
+
+def test_configure_stops_the_old_writer(capsys: pytest.CaptureFixture[str]) -> None:
+    log.configure(make_config(100))
+    log.warn("queued", {})
+    writer = log._writer
+    assert writer is not None
+
+    log.configure(make_config(100))
+    assert not writer.thread.is_alive()
+    assert capsys.readouterr().out == "WARN -- queued -- {}\n"
@@ -0,0 +1,257 @@
+"""Request counts, latency histograms and bytes sent per route, served in
+the Prometheus text format. Time spent inside a request is also split into
+stages (storage, template, send) so that slow handlers can be pinned down.
+
+Numbers are kept per process. With several prefork workers each scrape of
+/metrics sees the worker that happened to accept it."""
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    cast,
+)
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+F = TypeVar("F", bound=Callable[..., Any])
+C = TypeVar("C")
+
+
+class Histogram:
+    buckets: Tuple[float, ...]
+    counts: List[int]  # Per bucket, the last is everything past the largest
+    total: float
+    count: int
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Everything recorded by this process. Safe to use from several
+    threads"""
+
+    lock: threading.Lock
+    requests: Dict[Tuple[str, int], int]  # (route, status code) -> count
+    latency: Dict[str, Histogram]  # route -> histogram
+    stages: Dict[Tuple[str, str], Histogram]  # (route, stage) -> histogram
+    bytes_sent: Dict[str, int]  # route -> count
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.stages = {}
+        self.bytes_sent = {}
+
+    def record_request(
+        self,
+        route: str,
+        status_code: int,
+        seconds: float,
+        stage_seconds: Dict[str, float],
+    ) -> None:
+        with self.lock:
+            key = (route, status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._histogram(self.latency, route).observe(seconds)
+            for stage_name, stage_time in stage_seconds.items():
+                self._histogram(self.stages, (route, stage_name)).observe(stage_time)
+
+    def record_sent(self, route: str, num_bytes: int, seconds: float) -> None:
+        with self.lock:
+            self.bytes_sent[route] = self.bytes_sent.get(route, 0) + num_bytes
+            self._histogram(self.stages, (route, "send")).observe(seconds)
+
+    def _histogram(self, histograms: Dict[Any, Histogram], key: Any) -> Histogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        return histogram
+
+    def render(self, extra_counters: Dict[str, int], gauges: Dict[str, int]) -> bytes:
+        """Everything in the Prometheus text exposition format, along with
+        whatever counters and gauges the server wants to add"""
+        lines: List[str] = []
+        with self.lock:
+            lines += _header("nds_requests_total", "counter", "Requests handled")
+            for (route, status_code), count in sorted(self.requests.items()):
+                labels = _labels(route=route, status=str(status_code))
+                lines.append(f"nds_requests_total{labels} {count}")
+
+            lines += _header(
+                "nds_request_duration_seconds",
+                "histogram",
+                "Time from receiving a request to having its response ready",
+            )
+            for route, histogram in sorted(self.latency.items()):
+                lines += _histogram_lines(
+                    "nds_request_duration_seconds", {"route": route}, histogram
+                )
+
+            lines += _header(
+                "nds_stage_duration_seconds",
+                "histogram",
+                "Time spent in each stage of a request",
+            )
+            for (route, stage_name), histogram in sorted(self.stages.items()):
+                lines += _histogram_lines(
+                    "nds_stage_duration_seconds",
+                    {"route": route, "stage": stage_name},
+                    histogram,
+                )
+
+            lines += _header(
+                "nds_response_bytes_total", "counter", "Bytes sent to clients"
+            )
+            for route, count in sorted(self.bytes_sent.items()):
+                lines.append(f"nds_response_bytes_total{_labels(route=route)} {count}")
+
+        for name, value in sorted(extra_counters.items()):
+            lines += _header(name, "counter", "")
+            lines.append(f"{name} {value}")
+        for name, value in sorted(gauges.items()):
+            lines += _header(name, "gauge", "")
+            lines.append(f"{name} {value}")
+
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+metrics = Metrics()
+
+_local = threading.local()
+
+
+def start_request() -> float:
+    """Starts collecting stage timings for the request being handled on
+    this thread"""
+    _local.stages = {}
+    _local.stack = []
+    return time.perf_counter()
+
+
+def finish_request(route: str, status_code: int, start: float) -> None:
+    stage_seconds: Dict[str, float] = getattr(_local, "stages", None) or {}
+    _local.stages = None
+    metrics.record_request(
+        route, status_code, time.perf_counter() - start, stage_seconds
+    )
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Adds the time spent in the block to the current request's total for
+    the stage. Stages can nest, the outer stage is paused while the inner
+    one runs. Does nothing outside of a request"""
+    stages: Optional[Dict[str, float]] = getattr(_local, "stages", None)
+    if stages is None:
+        yield
+        return
+
+    stack: List[List[Any]] = _local.stack  # [stage name, started]
+    now = time.perf_counter()
+    if stack:
+        parent = stack[-1]
+        stages[parent[0]] = stages.get(parent[0], 0.0) + now - parent[1]
+    stack.append([name, now])
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        stages[name] = stages.get(name, 0.0) + end - stack.pop()[1]
+        if stack:
+            stack[-1][1] = end
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator version of stage"""
+
+    def decorate(function: F) -> F:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return cast(F, wrapper)
+
+    return decorate
+
+
+def timed_methods(name: str) -> Callable[[Type[C]], Type[C]]:
+    """Class decorator that times every public method as the stage"""
+
+    def decorate(cls: Type[C]) -> Type[C]:
+        for attr_name, attr in list(vars(cls).items()):
+            if callable(attr) and not attr_name.startswith("_"):
+                setattr(cls, attr_name, timed(name)(attr))
+        return cls
+
+    return decorate
+
+
+def _header(name: str, metric_type: str, help_text: str) -> List[str]:
+    lines = [f"# TYPE {name} {metric_type}"]
+    if help_text:
+        lines.insert(0, f"# HELP {name} {help_text}")
+    return lines
+
+
+def _labels(**labels: str) -> str:
+    escaped = (f'{key}="{_escape(val)}"' for key, val in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(
+    name: str, labels: Dict[str, str], histogram: Histogram
+) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=str(bound))} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.total}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+    return lines
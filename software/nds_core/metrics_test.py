@@ -0,0 +1,48 @@
+import time
+
+from .metrics import Metrics, stage, start_request, timed, _local
+
+
+def test_nested_stages_are_exclusive() -> None:
+    @timed("storage")
+    def query() -> None:
+        time.sleep(0.02)
+
+    start_request()
+    with stage("template"):
+        time.sleep(0.02)
+        query()
+    stages = _local.stages
+    _local.stages = None
+
+    assert 0.02 <= stages["storage"] < 0.04
+    assert 0.02 <= stages["template"] < 0.04
+
+
+def test_stage_outside_request_does_nothing() -> None:
+    with stage("storage"):
+        pass
+    assert getattr(_local, "stages", None) is None
+
+
+def test_render_prometheus_text() -> None:
+    metrics = Metrics()
+    metrics.record_request("/index.html", 200, 0.003, {"storage": 0.001})
+    metrics.record_request("/index.html", 200, 0.2, {})
+    metrics.record_sent("/index.html", 1234, 0.0001)
+
+    text = metrics.render({"nds_server_requests_shed_total": 2}, {}).decode("utf-8")
+    lines = text.splitlines()
+    assert 'nds_requests_total{route="/index.html",status="200"} 2' in lines
+    assert (
+        'nds_request_duration_seconds_bucket{route="/index.html",le="0.005"} 1' in lines
+    )
+    assert (
+        'nds_request_duration_seconds_bucket{route="/index.html",le="+Inf"} 2' in lines
+    )
+    assert 'nds_request_duration_seconds_count{route="/index.html"} 2' in lines
+    assert (
+        'nds_stage_duration_seconds_count{route="/index.html",stage="send"} 1' in lines
+    )
+    assert 'nds_response_bytes_total{route="/index.html"} 1234' in lines
+    assert "nds_server_requests_shed_total 2" in lines
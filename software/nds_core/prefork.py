@@ -0,0 +1,110 @@
+import os
+import signal
+import socket
+import time
+from types import FrameType
+from typing import Callable, Dict, Optional
+
+from .config import _Config
+from .webserver import HttpSocket
+from . import log
+
+WorkerFunction = Callable[[socket.socket], None]
+
+
+class Supervisor:
+    """Forks a fixed number of worker processes that all serve the same
+    port, and replaces any that die. Workers either bind their own socket
+    with SO_REUSEPORT, so the kernel balances connections between them, or
+    share one listening socket inherited from the supervisor."""
+
+    server_config: _Config
+    worker_function: WorkerFunction
+    reuse_port: bool
+    shared_socket: Optional[socket.socket]
+    workers: Dict[int, float]  # pid -> start time
+    running: bool
+
+    def __init__(self, server_config: _Config, worker_function: WorkerFunction):
+        self.server_config = server_config
+        self.worker_function = worker_function
+        self.reuse_port = server_config.WEBSERVER_REUSE_PORT and hasattr(
+            socket, "SO_REUSEPORT"
+        )
+        self.shared_socket = None
+        self.workers = {}
+        self.running = False
+
+    def run(self) -> None:
+        self.running = True
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+
+        if self.reuse_port:
+            # Each worker binds its own socket. The supervisor mustn't hold
+            # one open or the kernel would hand it connections nobody accepts
+            self._supervise()
+        else:
+            with HttpSocket(self.server_config) as http_socket:
+                self.shared_socket = http_socket
+                self._supervise()
+
+    def _supervise(self) -> None:
+        for _ in range(self.server_config.WEBSERVER_WORKER_PROCESSES):
+            self._spawn()
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            start_time = self.workers.pop(pid, None)
+            if start_time is None:
+                continue
+            log.warn(
+                "worker_exited",
+                {"pid": pid, "exit_code": os.waitstatus_to_exitcode(status)},
+            )
+
+            if self.running:
+                if time.monotonic() - start_time < 1:
+                    # Crashing on startup, don't spin forking new ones
+                    time.sleep(
+                        self.server_config.WEBSERVER_WORKER_RESTART_DELAY_MS / 1000
+                    )
+                self._spawn()
+
+    def _spawn(self) -> None:
+        pid = os.fork()
+        if pid != 0:
+            log.info("worker_started", {"pid": pid})
+            self.workers[pid] = time.monotonic()
+            return
+
+        # In the worker. Until it has a server to stop, signals just kill it
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            if self.shared_socket is not None:
+                self.worker_function(self.shared_socket)
+            else:
+                with HttpSocket(self.server_config, reuse_port=True) as http_socket:
+                    self.worker_function(http_socket)
+        except Exception as err:
+            log.error("worker_failure", {"exception": str(err)})
+            exit_code = 1
+        finally:
+            # os._exit skips atexit, so nothing else would write out the logs
+            log.flush()
+            os._exit(exit_code)
+
+    def _on_stop_signal(self, signum: int, frame: Optional[FrameType]) -> None:
+        log.info("supervisor_stopping", {"signal": signum})
+        self.running = False
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
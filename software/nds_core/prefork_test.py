@@ -0,0 +1,58 @@
+import os
+import select
+import signal
+import socket
+from typing import List
+
+from .config import _Config
+from .prefork import Supervisor
+
+
+def read_pids(pipe: int, count: int) -> List[int]:
+    pids: List[int] = []
+    data = b""
+    while len(pids) < count:
+        readable, _, _ = select.select([pipe], [], [], 10)
+        assert readable, "Timed out waiting for workers to start"
+        data += os.read(pipe, 1024)
+        *lines, data = data.split(b"\n")
+        pids += [int(line) for line in lines]
+    return pids
+
+
+def test_supervisor_replaces_workers_that_exit() -> None:
+    server_config = _Config()
+    server_config.WEBSERVER_PORT = 0
+    server_config.WEBSERVER_WORKER_PROCESSES = 3
+    server_config.WEBSERVER_WORKER_RESTART_DELAY_MS = 10
+
+    read_end, write_end = os.pipe()
+
+    def worker(http_socket: socket.socket) -> None:
+        os.write(write_end, f"{os.getpid()}\n".encode())
+        signal.pause()
+
+    supervisor_pid = os.fork()
+    if supervisor_pid == 0:
+        exit_code = 0
+        try:
+            os.close(read_end)
+            Supervisor(server_config, worker).run()
+        except BaseException:
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    os.close(write_end)
+    try:
+        workers = read_pids(read_end, 3)
+        assert len(set(workers)) == 3
+
+        os.kill(workers[0], signal.SIGKILL)
+        [replacement] = read_pids(read_end, 1)
+        assert replacement not in workers
+    finally:
+        os.kill(supervisor_pid, signal.SIGTERM)
+        _, status = os.waitpid(supervisor_pid, 0)
+        os.close(read_end)
+    assert os.waitstatus_to_exitcode(status) == 0
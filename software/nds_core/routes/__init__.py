@@ -1,17 +1,19 @@
-import os
 from ..webserver import HTTPRequest, HTTPResponse
 
-import re
+from typing import Tuple
 
-from .file_utils import openStatic, STATIC_DIR
+from ..config import _Config
 from ..storage import Storage
-from ..session import get_session_data
+from ..session import Sessions
 from . import route_simple
 from . import route_user
 from . import route_thread
 from . import route_index
 from .registry import RouteDict, RequestContext
-
+from .dispatcher import Dispatcher
+from .static_cache import StaticCache
+from .page_cache import PageCache
+from .live_updates import LiveUpdates
 
 ROUTES: RouteDict = {
     **route_simple.routes,
@@ -19,30 +21,58 @@ ROUTES: RouteDict = {
     **route_thread.routes,
     **route_index.routes,
 }
+DISPATCHER = Dispatcher(ROUTES)
+STATIC_METHODS = ("GET", "HEAD")
+STATIC_ROUTE = "static"  # HTTPRequest.route of static files
 
 
-def handle_route_request(storage: Storage, page_request: HTTPRequest) -> HTTPResponse:
+def handle_route_request(
+    server_config: _Config,
+    storage: Storage,
+    sessions: Sessions,
+    static_cache: StaticCache,
+    page_cache: PageCache,
+    live_updates: LiveUpdates,
+    page_request: HTTPRequest,
+) -> HTTPResponse:
     """Converts the HTTP page request into a page string"""
 
-    session_data = get_session_data(storage, page_request)
-
     page_request_str = page_request.url
-    for route in ROUTES:
-        reg_match = re.fullmatch(route, page_request.url)
-        if reg_match is not None:
-            context = RequestContext(storage, page_request, session_data, reg_match)
+    route_match = DISPATCHER.match(page_request.method, page_request_str)
+    if route_match is not None:
+        page_request.route = route_match.pattern
+        if route_match.handler is None:
+            return method_not_allowed(route_match.allowed_methods)
 
-            return ROUTES[route](context)
+        session_data = sessions.get(page_request)
+        context = RequestContext(
+            storage,
+            page_request,
+            session_data,
+            route_match.url_match,
+            page_cache,
+            server_config,
+            live_updates,
+            sessions,
+        )
+        return route_match.handler(context)
 
     if page_request_str == "/debug":
         a = 1 / 0  # noqa
 
     # Look in static directory last
-    if page_request_str[1:] in os.listdir(STATIC_DIR):
-        return HTTPResponse(
-            status_code=200,
-            headers=[(b"Cache-Control", b"max-age=3600")],
-            data=openStatic(page_request_str[1:]),
-        )
+    static_file = static_cache.get(page_request_str[1:])
+    if static_file is not None:
+        page_request.route = STATIC_ROUTE
+        if page_request.method not in STATIC_METHODS:
+            return method_not_allowed(STATIC_METHODS)
+        return static_file.response(page_request)
 
     return HTTPResponse(status_code=302, headers=[(b"Location", b"/404.html")])
+
+
+def method_not_allowed(allowed_methods: Tuple[str, ...]) -> HTTPResponse:
+    return HTTPResponse(
+        status_code=405,
+        headers=[(b"Allow", ", ".join(allowed_methods).encode("utf-8"))],
+    )
@@ -0,0 +1,115 @@
+import re
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from .registry import RouteDict, RouteHandler
+
+# Characters that make a route pattern more than a plain path. Unescaped
+# dots are allowed, every route writes "/index.html" rather than
+# "/index\.html" and means the literal dot
+_REGEX_CHARS = set("[]()*+?{}|^$\\")
+_NAMED_GROUP = re.compile(r"\(\?P<\w+>")
+
+
+class RouteMatch:
+    pattern: str  # The route pattern the url matched
+    handler: Optional[RouteHandler]  # None if the route doesn't take the method
+    url_match: "re.Match[str]"
+    allowed_methods: Tuple[str, ...]
+
+    def __init__(
+        self,
+        pattern: str,
+        handler: Optional[RouteHandler],
+        url_match: "re.Match[str]",
+        allowed_methods: Tuple[str, ...],
+    ):
+        self.pattern = pattern
+        self.handler = handler
+        self.url_match = url_match
+        self.allowed_methods = allowed_methods
+
+
+class _Route:
+    pattern: str
+    regex: Pattern[str]
+    handlers: Dict[str, RouteHandler]  # method -> handler
+    allowed_methods: Tuple[str, ...]
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.handlers = {}
+        self.allowed_methods = ()
+
+    def add(self, method: str, handler: RouteHandler) -> None:
+        self.handlers[method] = handler
+        if method == "GET" and "HEAD" not in self.handlers:
+            # The server drops the body of HEAD responses itself
+            self.handlers["HEAD"] = handler
+        self.allowed_methods = tuple(sorted(self.handlers))
+
+
+class Dispatcher:
+    """The route table compiled for matching a url in one step. Literal
+    paths are looked up in a dict. Every route with parameters is joined
+    into one alternation regex, so that one search finds which of them
+    matched rather than trying each in turn."""
+
+    literal: Dict[str, Tuple[_Route, "re.Match[str]"]]
+    parameterised: List[_Route]
+    combined: Optional[Pattern[str]]
+
+    def __init__(self, routes: RouteDict):
+        by_pattern: Dict[str, _Route] = {}
+        for (pattern, method), handler in routes.items():
+            route = by_pattern.get(pattern)
+            if route is None:
+                route = by_pattern[pattern] = _Route(pattern)
+            route.add(method, handler)
+
+        self.literal = {}
+        self.parameterised = []
+        for pattern, route in by_pattern.items():
+            if _REGEX_CHARS.isdisjoint(pattern):
+                url_match = route.regex.fullmatch(pattern)
+                assert url_match is not None
+                self.literal[pattern] = (route, url_match)
+            else:
+                self.parameterised.append(route)
+
+        self.combined = None
+        if self.parameterised:
+            # Group names have to be unique across the whole regex, so the
+            # routes' own named groups are only captured when the winning
+            # route's regex is run again on its own
+            self.combined = re.compile(
+                "|".join(
+                    f"(?P<_route{i}>{_NAMED_GROUP.sub('(?:', route.pattern)})"
+                    for i, route in enumerate(self.parameterised)
+                )
+            )
+
+    def match(self, method: str, url: str) -> Optional[RouteMatch]:
+        """Finds the route for url, or None if there isn't one. If the route
+        exists but doesn't take this method the match has no handler"""
+        found = self.literal.get(url)
+        if found is not None:
+            route, url_match = found
+        else:
+            if self.combined is None:
+                return None
+            combined_match = self.combined.fullmatch(url)
+            if combined_match is None:
+                return None
+            assert combined_match.lastgroup is not None
+            route = self.parameterised[int(combined_match.lastgroup[6:])]
+            route_match = route.regex.fullmatch(url)
+            assert route_match is not None
+            url_match = route_match
+
+        return RouteMatch(
+            route.pattern,
+            route.handlers.get(method),
+            url_match,
+            route.allowed_methods,
+        )
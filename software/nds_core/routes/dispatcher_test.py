@@ -0,0 +1,57 @@
+from ..webserver import HTTPResponse
+from .dispatcher import Dispatcher
+from .registry import RouteDict, RequestContext, register_route
+
+
+def make_dispatcher() -> Dispatcher:
+    routes: RouteDict = {}
+
+    def handler(context: RequestContext) -> HTTPResponse:
+        return HTTPResponse(status_code=200)
+
+    register_route(routes, r"/index.html")(handler)
+    register_route(routes, r"/threads/(?P<thread_id>\d+)/")(handler)
+    register_route(
+        routes, r"/threads/(?P<thread_id>\d+)/reply.html", methods=("POST",)
+    )(handler)
+    register_route(routes, r"/users/(?P<user_id>\d+)/(?P<tab>\w+)")(handler)
+    return Dispatcher(routes)
+
+
+def test_matches_literal_routes() -> None:
+    dispatcher = make_dispatcher()
+    route_match = dispatcher.match("GET", "/index.html")
+    assert route_match is not None
+    assert route_match.pattern == "/index.html"
+    assert route_match.handler is not None
+
+    assert dispatcher.match("GET", "/index.htm") is None
+    assert dispatcher.match("GET", "/style.css") is None
+
+
+def test_matches_parameterised_routes() -> None:
+    dispatcher = make_dispatcher()
+    route_match = dispatcher.match("POST", "/threads/12/reply.html")
+    assert route_match is not None
+    assert route_match.pattern == r"/threads/(?P<thread_id>\d+)/reply.html"
+    assert route_match.url_match.groupdict() == {"thread_id": "12"}
+
+    route_match = dispatcher.match("GET", "/users/3/posts")
+    assert route_match is not None
+    assert route_match.url_match.groupdict() == {"user_id": "3", "tab": "posts"}
+
+    assert dispatcher.match("GET", "/threads/abc/") is None
+
+
+def test_method_not_allowed() -> None:
+    dispatcher = make_dispatcher()
+    route_match = dispatcher.match("GET", "/threads/12/reply.html")
+    assert route_match is not None
+    assert route_match.handler is None
+    assert route_match.allowed_methods == ("POST",)
+
+    # GET routes answer HEAD too
+    route_match = dispatcher.match("HEAD", "/threads/12/")
+    assert route_match is not None
+    assert route_match.handler is not None
+    assert route_match.allowed_methods == ("GET", "HEAD")
@@ -1,31 +1,62 @@
-import os
-from typing import Optional
-from nds_core.webserver import HTTPRequest
+from typing import Dict, Optional, Tuple
+from nds_core.webserver import HTTPRequest, Headers
 from ..storage import SessionData
+from ..conditional import make_etag
+from ..metrics import timed
+from .templates import Template, TemplateCache
 
 NAME = "NDS Core 12"
 FRAGMENT_DIR = "nds_core/routes/fragments"
 STATIC_DIR = "nds_core/routes/static"
 
+# Pages differ per user, so only the browser may cache them, and it has to
+# revalidate every time
+DYNAMIC_CACHE_HEADERS: Headers = [(b"Cache-Control", b"private, no-cache")]
 
-def openStatic(path: str) -> bytes:
-    return open(os.path.join(STATIC_DIR, path), "rb").read()
+# serve.py turns on auto_reload in DEV_MODE
+TEMPLATES = TemplateCache(FRAGMENT_DIR)
+
+
+def openTemplate(path: str) -> Template:
+    return TEMPLATES.get(path)
 
 
 def openFragment(path: str) -> str:
-    return open(os.path.join(FRAGMENT_DIR, path), "r", encoding="utf-8").read()
+    """A fragment with no fields to fill in"""
+    return TEMPLATES.get(path).source
+
+
+def pageEtag(session_data: Optional[SessionData], *parts: object) -> bytes:
+    """ETag for a rendered page. Signed in users see a different page to
+    anonymous ones, so the viewer is part of it"""
+    viewer = "anon" if session_data is None else f"user{session_data.user_id}"
+    return make_etag(viewer, *parts)
 
 
+@timed("template")
 def wrapContent(
     session_data: Optional[SessionData], request: HTTPRequest, title: str, content: str
 ) -> bytes:
-    template = openFragment("ROOT.html")
+    fields = rootFields(session_data, title)
+    return openTemplate("ROOT.html").format(CONTENT=content, **fields).encode("utf-8")
+
+
+def wrapContentParts(
+    session_data: Optional[SessionData], request: HTTPRequest, title: str
+) -> Tuple[bytes, bytes]:
+    """wrapContent for content that is sent in between the two halves"""
+    head, tail = openTemplate("ROOT.html").split("CONTENT")
+    fields = rootFields(session_data, title)
+    return (
+        head.format(**fields).encode("utf-8"),
+        tail.format(**fields).encode("utf-8"),
+    )
+
+
+def rootFields(session_data: Optional[SessionData], title: str) -> Dict[str, str]:
     settings_button = (
         openFragment("signInButton.html")
         if session_data is None
         else openFragment("userProfileButton.html")
     )
-
-    return template.format(
-        CONTENT=content, TITLE=NAME + ": " + title, SETTINGS_BUTTON=settings_button
-    ).encode("utf-8")
+    return {"TITLE": NAME + ": " + title, "SETTINGS_BUTTON": settings_button}
@@ -0,0 +1,150 @@
+import threading
+from typing import Dict, List, Optional
+
+from .. import log
+from ..config import _Config
+from ..storage import ItemId, Storage
+from ..webserver import PushStream
+from .file_utils import openTemplate
+
+CATCH_UP_POSTS = 100  # Posts read at a time when a watcher is behind
+RETRY_MS = 3000  # How long browsers wait before reconnecting
+
+
+class _Watcher:
+    stream: PushStream
+    last_ordering: int  # Of the last post sent
+    lock: threading.Lock  # So two catch ups can't both send a post
+
+    def __init__(self, stream: PushStream, last_ordering: int):
+        self.stream = stream
+        self.last_ordering = last_ordering
+        self.lock = threading.Lock()
+
+
+class LiveUpdates:
+    """Pushes new posts, as server-sent events, to everyone with a thread
+    open. Posts made through this process's Storage go out as soon as they
+    are committed. Posts made by other worker processes are found by
+    checking the watched threads every LIVE_UPDATES_POLL_MS.
+
+    Each post is read and rendered once however many are watching. A
+    watcher costs its socket and an entry here, no thread waits on it, and
+    threads nobody is watching cost nothing at all."""
+
+    storage: Storage
+    poll_interval_s: float
+    ping_interval_s: float
+    watchers: Dict[int, List[_Watcher]]  # thread_id -> watchers
+    lock: threading.Lock  # Only held to read or change watchers
+    background: Optional[threading.Thread]
+    stopping: threading.Event
+
+    def __init__(self, server_config: _Config, storage: Storage):
+        self.storage = storage
+        self.poll_interval_s = server_config.LIVE_UPDATES_POLL_MS / 1000
+        self.ping_interval_s = server_config.LIVE_UPDATES_PING_MS / 1000
+        self.watchers = {}
+        self.lock = threading.Lock()
+        self.background = None
+        self.stopping = threading.Event()
+
+    def watch(self, thread_id: int, after: int) -> PushStream:
+        """A stream of the thread's posts after the ordering after, and of
+        every post made from now on"""
+        stream = PushStream()
+        stream.write(f"retry: {RETRY_MS}\n\n".encode("utf-8"))
+        watcher = _Watcher(stream, after)
+        with self.lock:
+            self.watchers.setdefault(thread_id, []).append(watcher)
+            if self.background is None:
+                self.background = threading.Thread(
+                    target=self._run, name="live-updates", daemon=True
+                )
+                self.background.start()
+        stream.on_close(lambda: self._unwatch(thread_id, watcher))
+        self.catch_up(thread_id)
+        return stream
+
+    def data_changed(self, kind: str, item_id: ItemId) -> None:
+        """Storage write listener"""
+        if kind == "thread" and isinstance(item_id, int) and item_id in self.watchers:
+            self.catch_up(item_id)
+
+    def catch_up(self, thread_id: int) -> None:
+        """Sends each of the thread's watchers the posts they haven't had.
+        The database is read, and streams written to, without holding the
+        lock, so that closing a stream never waits on a catch up"""
+        with self.lock:
+            watchers = list(self.watchers.get(thread_id, ()))
+        if not watchers:
+            return
+        after = min(w.last_ordering for w in watchers)
+        post = openTemplate("post.html")
+        while True:
+            events = [
+                (
+                    post_data.ordering,
+                    _event(
+                        post_data.ordering,
+                        post.format(POST=post_data, USER=user_data),
+                    ),
+                )
+                for post_data, user_data in self.storage.iter_posts_by_thread_id(
+                    thread_id, CATCH_UP_POSTS, after
+                )
+            ]
+            for watcher in watchers:
+                with watcher.lock:
+                    for ordering, event in events:
+                        if ordering > watcher.last_ordering:
+                            watcher.stream.write(event)
+                            watcher.last_ordering = ordering
+            # Nobody left to send the rest to
+            watchers = [w for w in watchers if not w.stream.closed]
+            if len(events) < CATCH_UP_POSTS or not watchers:
+                return
+            after = events[-1][0]
+
+    def close(self) -> None:
+        self.stopping.set()
+        with self.lock:
+            streams = [w.stream for ws in self.watchers.values() for w in ws]
+        for stream in streams:
+            stream.close()
+
+    def _unwatch(self, thread_id: int, watcher: _Watcher) -> None:
+        with self.lock:
+            watchers = self.watchers.get(thread_id, [])
+            if watcher in watchers:
+                watchers.remove(watcher)
+            if not watchers:
+                self.watchers.pop(thread_id, None)
+
+    def _run(self) -> None:
+        since_ping = 0.0
+        while not self.stopping.wait(self.poll_interval_s):
+            since_ping += self.poll_interval_s
+            try:
+                with self.lock:
+                    thread_ids = list(self.watchers)
+                for thread_id in thread_ids:
+                    self.catch_up(thread_id)
+                if since_ping >= self.ping_interval_s:
+                    since_ping = 0.0
+                    self._ping()
+            except Exception as err:
+                log.error("live_updates_failure", {"exception": str(err)})
+
+    def _ping(self) -> None:
+        # Stops proxies timing the stream out, and finds clients that have
+        # gone away without closing the connection
+        with self.lock:
+            streams = [w.stream for ws in self.watchers.values() for w in ws]
+        for stream in streams:
+            stream.write(b": ping\n\n")
+
+
+def _event(event_id: int, data: str) -> bytes:
+    lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+    return f"id: {event_id}\nevent: post\n{lines}\n".encode("utf-8")
@@ -0,0 +1,105 @@
+import datetime
+from typing import Iterator, List, Optional, Tuple
+
+import pytest
+
+from ..config import _Config
+from ..storage import Storage, ColorData, PostData, UserData
+from .live_updates import CATCH_UP_POSTS, LiveUpdates
+
+
+@pytest.fixture
+def storage() -> Iterator[Storage]:
+    storage = Storage(":memory:")
+    yield storage
+    storage.close()
+
+
+def make_thread(storage: Storage) -> int:
+    user_id = storage.create_user("testUser", b"testSecret", ColorData(0, 0, 0))
+    return storage.create_thread(
+        datetime.datetime.now(), user_id, "Thread", "First post"
+    )
+
+
+def add_post(storage: Storage, thread_id: int, content: str) -> None:
+    storage.create_post_in_thread(1, thread_id, datetime.datetime.now(), content)
+
+
+def events(chunks: List[bytes]) -> List[str]:
+    """The post events in what was pushed"""
+    return [
+        event
+        for event in b"".join(chunks).decode("utf-8").split("\n\n")
+        if "event: post" in event
+    ]
+
+
+def test_pushes_new_posts(storage: Storage) -> None:
+    live_updates = LiveUpdates(_Config(), storage)
+    storage.add_write_listener(live_updates.data_changed)
+    thread_id = make_thread(storage)
+
+    latest = storage.query_latest_post_ordering(thread_id)
+    assert latest is not None
+    first = live_updates.watch(thread_id, latest)
+    add_post(storage, thread_id, "Second post")
+    # A late arrival, behind by a post, catches up without resending
+    # anything to the first watcher
+    second = live_updates.watch(thread_id, latest)
+    add_post(storage, thread_id, "Third post")
+
+    first_chunks, _ = first.take()
+    assert b"".join(first_chunks).startswith(b"retry: ")
+    assert b"id: " in first_chunks[1]
+    assert len(events(first_chunks)) == 2
+    assert "Second post" in first_chunks[1].decode("utf-8")
+    assert "Third post" in first_chunks[2].decode("utf-8")
+    second_chunks, _ = second.take()
+    assert len(events(second_chunks)) == 2
+
+    live_updates.close()
+    assert first.take() == ([], True)
+    assert live_updates.watchers == {}
+
+
+def test_closed_streams_stop_watching(storage: Storage) -> None:
+    live_updates = LiveUpdates(_Config(), storage)
+    thread_id = make_thread(storage)
+
+    stream = live_updates.watch(thread_id, -1)
+    assert len(events(stream.take()[0])) == 1  # The first post
+    stream.close()
+    assert live_updates.watchers == {}
+    add_post(storage, thread_id, "Unseen")
+    live_updates.data_changed("thread", thread_id)
+    assert stream.take() == ([], True)
+    live_updates.close()
+
+
+def test_catch_up_stops_once_nobody_is_watching(
+    storage: Storage, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    live_updates = LiveUpdates(_Config(), storage)
+    thread_id = make_thread(storage)
+    stream = live_updates.watch(thread_id, 0)
+    for i in range(CATCH_UP_POSTS * 3):
+        add_post(storage, thread_id, f"Post {i}")
+
+    reads = []
+    iter_posts = storage.iter_posts_by_thread_id
+
+    def read_and_hang_up(
+        thread_id: int, limit: int, after: Optional[int]
+    ) -> Iterator[Tuple[PostData, UserData]]:
+        # Streams can close, without waiting, while the database is read
+        assert live_updates.lock.acquire(blocking=False)
+        live_updates.lock.release()
+        reads.append(after)
+        stream.close()
+        return iter_posts(thread_id, limit, after)
+
+    monkeypatch.setattr(storage, "iter_posts_by_thread_id", read_and_hang_up)
+    live_updates.catch_up(thread_id)
+    assert reads == [0]
+    live_updates.close()
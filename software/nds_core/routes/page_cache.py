@@ -0,0 +1,179 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from ..config import _Config
+from ..storage import ItemId, SessionData
+from ..webserver import HTTPRequest, HTTPResponse, Headers
+from ..compression import choose_encoding, compress, encoded_headers
+
+# (url, query string, viewer). Signed in users see their own name and
+# colours on the page, so each gets their own copy
+PageKey = Tuple[str, str, str]
+
+INDEX_TAG = "index"
+
+
+def thread_tag(thread_id: int) -> str:
+    return f"thread{thread_id}"
+
+
+class CachedPage:
+    key: PageKey
+    etag: bytes  # The data the page was rendered from
+    body: bytes
+    tag: str  # What the page shows, for invalidation
+    variants: Dict[str, bytes]  # encoding -> compressed body
+
+    def __init__(self, key: PageKey, etag: bytes, body: bytes, tag: str):
+        self.key = key
+        self.etag = etag
+        self.body = body
+        self.tag = tag
+        self.variants = {}
+
+    def memory_used(self) -> int:
+        return len(self.body) + sum(len(v) for v in self.variants.values())
+
+
+class PageCacheStats:
+    hits: int
+    misses: int
+    evictions: int  # Dropped to stay within the memory budget
+    invalidations: int  # Dropped because what they show changed
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+class PageCache:
+    """Rendered page bodies, least recently used first out once they take
+    more than max_bytes. A page is only served from the cache if it was
+    rendered from the same data as the request's ETag says is current, so
+    writes by other worker processes are never missed. Writes through this
+    process's Storage drop the pages they affect straight away, rather than
+    leaving them to take up space until they are next asked for. Pages are
+    compressed once for each encoding clients ask for, and the compressed
+    variants kept alongside them."""
+
+    max_bytes: int
+    pages: "OrderedDict[PageKey, CachedPage]"
+    tags: Dict[str, Set[PageKey]]  # tag -> keys of the pages with it
+    memory_used: int
+    stats: PageCacheStats
+    lock: threading.Lock
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()
+        self.tags = {}
+        self.memory_used = 0
+        self.stats = PageCacheStats()
+        self.lock = threading.Lock()
+
+    def get(
+        self, request: HTTPRequest, session: Optional[SessionData], etag: bytes
+    ) -> Optional[CachedPage]:
+        key = _page_key(request, session)
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None or page.etag != etag:
+                self.stats.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.stats.hits += 1
+            return page
+
+    def response(
+        self,
+        server_config: _Config,
+        request: HTTPRequest,
+        page: CachedPage,
+        headers: Headers,
+    ) -> HTTPResponse:
+        """The page in the encoding the client wants, so compress_response
+        leaves it alone. The first time an encoding is asked for, the page
+        is compressed and the result kept with it"""
+        if len(page.body) < server_config.WEBSERVER_COMPRESS_MIN_BYTES:
+            return HTTPResponse(200, page.body, headers)
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return HTTPResponse(200, page.body, headers)
+
+        compressed = page.variants.get(encoding)
+        if compressed is None:
+            compressed = compress(
+                page.body, encoding, server_config.WEBSERVER_COMPRESS_LEVEL
+            )
+            with self.lock:
+                if self.pages.get(page.key) is page and encoding not in page.variants:
+                    page.variants[encoding] = compressed
+                    self.memory_used += len(compressed)
+                    self._evict()
+        return HTTPResponse(200, compressed, encoded_headers(headers, encoding))
+
+    def put(
+        self,
+        request: HTTPRequest,
+        session: Optional[SessionData],
+        etag: bytes,
+        body: bytes,
+        tag: str,
+    ) -> None:
+        if len(body) > self.max_bytes:
+            return
+        key = _page_key(request, session)
+        with self.lock:
+            self._remove(key)
+            self.pages[key] = CachedPage(key, etag, body, tag)
+            self.tags.setdefault(tag, set()).add(key)
+            self.memory_used += len(body)
+            self._evict()
+
+    def invalidate(self, tag: str) -> None:
+        with self.lock:
+            for key in list(self.tags.get(tag, ())):
+                self._remove(key)
+                self.stats.invalidations += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.stats.invalidations += len(self.pages)
+            self.pages.clear()
+            self.tags.clear()
+            self.memory_used = 0
+
+    def data_changed(self, kind: str, item_id: ItemId) -> None:
+        """Storage write listener"""
+        if kind == "thread" and isinstance(item_id, int):
+            self.invalidate(thread_tag(item_id))
+            self.invalidate(INDEX_TAG)
+        elif kind == "user":
+            # Users' names and colours are on every page
+            self.clear()
+
+    def _evict(self) -> None:
+        while self.memory_used > self.max_bytes:
+            self._remove(next(iter(self.pages)))
+            self.stats.evictions += 1
+
+    def _remove(self, key: PageKey) -> None:
+        page = self.pages.pop(key, None)
+        if page is None:
+            return
+        self.memory_used -= page.memory_used()
+        keys = self.tags[page.tag]
+        keys.discard(key)
+        if not keys:
+            del self.tags[page.tag]
+
+
+def _page_key(request: HTTPRequest, session: Optional[SessionData]) -> PageKey:
+    viewer = "anon" if session is None else f"user{session.user_id}"
+    return (request.url, request.query_string, viewer)
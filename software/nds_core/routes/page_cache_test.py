@@ -0,0 +1,124 @@
+import datetime
+from typing import List, Optional
+
+import pytest
+
+from ..config import _Config
+from ..compression import compress_response
+from ..storage import SessionData
+from ..webserver import HTTPRequest, HTTPResponse
+from . import page_cache
+from .page_cache import CachedPage, PageCache, INDEX_TAG, thread_tag
+
+
+def make_request(url: str, query_string: str = "") -> HTTPRequest:
+    return HTTPRequest("GET", url, b"", [], query_string=query_string)
+
+
+def body_of(page: Optional[CachedPage]) -> Optional[bytes]:
+    return None if page is None else page.body
+
+
+def make_session(user_id: int) -> SessionData:
+    now = datetime.datetime.now()
+    return SessionData(user_id, "key", now, now)
+
+
+def test_hit_needs_matching_etag() -> None:
+    cache = PageCache(1000)
+    request = make_request("/threads/1/")
+    assert cache.get(request, None, b'"a"') is None
+
+    cache.put(request, None, b'"a"', b"page", thread_tag(1))
+    assert body_of(cache.get(request, None, b'"a"')) == b"page"
+    # Rendered from data that has changed since
+    assert cache.get(request, None, b'"b"') is None
+    assert cache.stats.as_dict() == {
+        "hits": 1,
+        "misses": 2,
+        "evictions": 0,
+        "invalidations": 0,
+    }
+
+
+def test_variants_are_separate() -> None:
+    cache = PageCache(1000)
+    sessions: List[Optional[SessionData]] = [None, make_session(1), make_session(2)]
+    for session in sessions:
+        body = str(session and session.user_id).encode("utf-8")
+        cache.put(make_request("/index.html"), session, b'"a"', body, INDEX_TAG)
+    cache.put(make_request("/index.html", "after=5"), None, b'"a"', b"p2", INDEX_TAG)
+
+    assert body_of(cache.get(make_request("/index.html"), None, b'"a"')) == b"None"
+    assert (
+        body_of(cache.get(make_request("/index.html"), make_session(2), b'"a"')) == b"2"
+    )
+    assert (
+        body_of(cache.get(make_request("/index.html", "after=5"), None, b'"a"'))
+        == b"p2"
+    )
+
+
+def test_evicts_least_recently_used() -> None:
+    cache = PageCache(25)
+    for i in range(3):
+        cache.put(make_request(f"/threads/{i}/"), None, b'"a"', b"x" * 10, "t")
+    assert cache.get(make_request("/threads/0/"), None, b'"a"') is None
+    assert cache.get(make_request("/threads/1/"), None, b'"a"') is not None
+    assert cache.memory_used == 20
+
+    # /threads/1/ was just used, so /threads/2/ goes next
+    cache.put(make_request("/threads/3/"), None, b'"a"', b"x" * 10, "t")
+    assert cache.get(make_request("/threads/2/"), None, b'"a"') is None
+    assert cache.get(make_request("/threads/1/"), None, b'"a"') is not None
+    assert cache.stats.evictions == 2
+
+    cache.put(make_request("/big/"), None, b'"a"', b"x" * 26, "t")
+    assert cache.get(make_request("/big/"), None, b'"a"') is None
+
+
+def test_data_changed() -> None:
+    cache = PageCache(1000)
+    cache.put(make_request("/index.html"), None, b'"a"', b"index", INDEX_TAG)
+    cache.put(make_request("/threads/1/"), None, b'"a"', b"one", thread_tag(1))
+    cache.put(make_request("/threads/2/"), None, b'"a"', b"two", thread_tag(2))
+
+    cache.data_changed("thread", 1)
+    assert cache.get(make_request("/index.html"), None, b'"a"') is None
+    assert cache.get(make_request("/threads/1/"), None, b'"a"') is None
+    assert body_of(cache.get(make_request("/threads/2/"), None, b'"a"')) == b"two"
+
+    cache.data_changed("user", 1)
+    assert cache.get(make_request("/threads/2/"), None, b'"a"') is None
+    assert cache.memory_used == 0
+    assert cache.stats.invalidations == 3
+
+
+def test_compressed_variants_are_kept(monkeypatch: pytest.MonkeyPatch) -> None:
+    server_config = _Config()
+    cache = PageCache(100000)
+    body = b"<p>A post</p>\n" * 100
+    headers = [(b"ETag", b'"a"')]
+    cache.put(make_request("/threads/1/"), None, b'"a"', body, thread_tag(1))
+    request = HTTPRequest(
+        "GET", "/threads/1/", b"", [(b"Accept-Encoding", b"gzip")], query_string=""
+    )
+    page = cache.get(request, None, b'"a"')
+    assert page is not None
+
+    # The same as it would have been sent uncached
+    expected = compress_response(
+        server_config, request, HTTPResponse(200, body, headers)
+    )
+    response = cache.response(server_config, request, page, headers)
+    assert response.data == expected.data
+    assert response.headers == expected.headers
+    assert cache.memory_used == len(body) + len(page.variants["gzip"])
+
+    monkeypatch.setattr(page_cache, "compress", lambda *_: pytest.fail("compressed"))
+    assert cache.response(server_config, request, page, headers).data == expected.data
+    plain = cache.response(server_config, make_request("/threads/1/"), page, headers)
+    assert plain.data == body
+
+    cache.data_changed("thread", 1)
+    assert cache.memory_used == 0
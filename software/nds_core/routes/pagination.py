@@ -0,0 +1,123 @@
+from typing import Callable, Iterator, List, Optional, Tuple, TypeVar
+
+from ..webserver import HTTPRequest
+from .file_utils import openTemplate
+
+T = TypeVar("T")
+
+
+class PageCursor:
+    """Where a page starts or finishes, from ?after= or ?before=. Pages are
+    found by the key of the row either side of them (a thread_id or a
+    post's ordering), so deep pages cost as much to fetch as the first"""
+
+    after: Optional[int]
+    before: Optional[int]
+
+    def __init__(self, after: Optional[int] = None, before: Optional[int] = None):
+        self.after = after
+        self.before = before
+
+    @classmethod
+    def from_request(cls, request: HTTPRequest) -> "PageCursor":
+        """Anything that isn't a number gives the first page"""
+        before = _parse_key(request.get_query_param("before"))
+        if before is not None:
+            return cls(before=before)
+        return cls(after=_parse_key(request.get_query_param("after")))
+
+    def etag_part(self) -> str:
+        return f"a{self.after}b{self.before}"
+
+
+class Page:
+    has_prev: bool
+    has_next: bool
+    first_key: Optional[int]
+    last_key: Optional[int]
+
+    def __init__(
+        self,
+        has_prev: bool,
+        has_next: bool,
+        first_key: Optional[int],
+        last_key: Optional[int],
+    ):
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.first_key = first_key
+        self.last_key = last_key
+
+
+def trim_page(
+    rows: List[T], key: Callable[[T], int], limit: int, cursor: PageCursor
+) -> Tuple[List[T], Page]:
+    """rows were fetched with limit + 1 so that the extra row, if there is
+    one, shows there is more to see in the direction of travel. Paging
+    there from a cursor means there is something the other way too"""
+    more = len(rows) > limit
+    if cursor.before is not None:
+        # Fetched backwards, so the extra row is the first
+        rows = rows[-limit:]
+        has_prev, has_next = more, True
+    else:
+        rows = rows[:limit]
+        has_prev, has_next = cursor.after is not None, more
+
+    first_key = key(rows[0]) if rows else None
+    last_key = key(rows[-1]) if rows else None
+    return rows, Page(has_prev, has_next, first_key, last_key)
+
+
+def stream_page(
+    rows: Iterator[T], key: Callable[[T], int], limit: int, cursor: PageCursor
+) -> Tuple[Iterator[T], Page]:
+    """trim_page for rows that are still being read. The page's rows are
+    yielded as they arrive, and the Page is only filled in once they have
+    all been. Paging backwards the extra row comes first, so those rows are
+    read in before any are yielded"""
+    if cursor.before is not None:
+        page_rows, page = trim_page(list(rows), key, limit, cursor)
+        return iter(page_rows), page
+
+    page = Page(cursor.after is not None, False, None, None)
+
+    def read() -> Iterator[T]:
+        count = 0
+        for row in rows:
+            if count == limit:
+                page.has_next = True
+                break
+            if count == 0:
+                page.first_key = key(row)
+            page.last_key = key(row)
+            count += 1
+            yield row
+
+    return read(), page
+
+
+def page_links(url: str, page: Page) -> str:
+    """Previous/next links for the page, or nothing if it is the only one"""
+    if not page.has_prev and not page.has_next:
+        return ""
+    link = openTemplate("pageLink.html")
+
+    prev = ""
+    if page.has_prev:
+        # Paged past the end, back to the start
+        prev_url = url if page.first_key is None else f"{url}?before={page.first_key}"
+        prev = link.format(URL=prev_url, LABEL="Previous")
+    next_link = ""
+    if page.has_next and page.last_key is not None:
+        next_link = link.format(URL=f"{url}?after={page.last_key}", LABEL="Next")
+    return openTemplate("pageLinks.html").format(PREV=prev, NEXT=next_link)
+
+
+def _parse_key(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
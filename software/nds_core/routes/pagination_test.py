@@ -0,0 +1,65 @@
+from typing import List, Optional
+
+from ..webserver import HTTPRequest
+from .pagination import Page, PageCursor, page_links, stream_page, trim_page
+
+
+def cursor_for(query_string: str) -> PageCursor:
+    return PageCursor.from_request(
+        HTTPRequest("GET", "/index.html", b"", [], query_string=query_string)
+    )
+
+
+def test_cursor_from_request() -> None:
+    assert vars(cursor_for("")) == {"after": None, "before": None}
+    assert vars(cursor_for("after=12")) == {"after": 12, "before": None}
+    assert vars(cursor_for("before=7")) == {"after": None, "before": 7}
+    assert vars(cursor_for("after=nonsense")) == {"after": None, "before": None}
+
+
+def trim(rows: List[int], cursor: PageCursor) -> List[Optional[object]]:
+    page_rows, page = trim_page(rows, lambda row: row, 3, cursor)
+    return [page_rows, page.has_prev, page.has_next, page.first_key, page.last_key]
+
+
+def test_trim_page() -> None:
+    # First page, with and without more after it
+    assert trim([1, 2, 3, 4], PageCursor()) == [[1, 2, 3], False, True, 1, 3]
+    assert trim([1, 2], PageCursor()) == [[1, 2], False, False, 1, 2]
+    # Going forwards from a cursor
+    assert trim([4, 5, 6, 7], PageCursor(after=3)) == [[4, 5, 6], True, True, 4, 6]
+    assert trim([], PageCursor(after=9)) == [[], True, False, None, None]
+    # Going backwards, where the extra row is the first
+    assert trim([1, 2, 3, 4], PageCursor(before=5)) == [[2, 3, 4], True, True, 2, 4]
+    assert trim([1, 2], PageCursor(before=3)) == [[1, 2], False, True, 1, 2]
+
+
+def test_page_links() -> None:
+    assert page_links("/index.html", Page(False, False, 1, 2)) == ""
+
+    links = page_links("/index.html", Page(True, True, 4, 6))
+    assert 'href="/index.html?before=4"' in links
+    assert 'href="/index.html?after=6"' in links
+
+    # Paged off the end, back to the start
+    links = page_links("/index.html", Page(True, False, None, None))
+    assert 'href="/index.html"' in links
+    assert "after=" not in links
+
+
+def stream(rows: List[int], cursor: PageCursor) -> List[Optional[object]]:
+    page_rows, page = stream_page(iter(rows), lambda row: row, 3, cursor)
+    streamed = list(page_rows)
+    return [streamed, page.has_prev, page.has_next, page.first_key, page.last_key]
+
+
+def test_stream_page_matches_trim_page() -> None:
+    for rows, cursor in [
+        ([1, 2, 3, 4], PageCursor()),
+        ([1, 2], PageCursor()),
+        ([4, 5, 6, 7], PageCursor(after=3)),
+        ([], PageCursor(after=9)),
+        ([1, 2, 3, 4], PageCursor(before=5)),
+        ([1, 2], PageCursor(before=3)),
+    ]:
+        assert stream(rows, cursor) == trim(rows, cursor)
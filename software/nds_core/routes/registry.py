@@ -1,8 +1,12 @@
 import re
-from typing import Dict, Optional, Callable, Pattern
+from typing import Dict, Optional, Callable, Tuple
 from ..storage import Storage, SessionData
-from ..webserver import HTTPRequest, HTTPResponse
+from ..session import Sessions
+from ..webserver import HTTPRequest, HTTPResponse, Methods
 from .. import log
+from ..config import _Config
+from .page_cache import PageCache
+from .live_updates import LiveUpdates
 
 
 class RequestContext:
@@ -10,6 +14,10 @@ class RequestContext:
     request: HTTPRequest
     session: Optional[SessionData]
     url_match: re.Match[str]
+    page_cache: PageCache
+    server_config: _Config
+    live_updates: LiveUpdates
+    sessions: Sessions
 
     def __init__(
         self,
@@ -17,23 +25,38 @@ class RequestContext:
         request: HTTPRequest,
         session: Optional[SessionData],
         url_match: re.Match[str],
+        page_cache: PageCache,
+        server_config: _Config,
+        live_updates: LiveUpdates,
+        sessions: Sessions,
     ):
         self.storage = storage
         self.request = request
         self.session = session
         self.url_match = url_match
+        self.page_cache = page_cache
+        self.server_config = server_config
+        self.live_updates = live_updates
+        self.sessions = sessions
 
 
 RouteHandler = Callable[[RequestContext], HTTPResponse]
-RouteDict = Dict[Pattern[str], RouteHandler]
+RouteDict = Dict[Tuple[str, str], RouteHandler]  # (regex, method) -> handler
 
 
 def register_route(
-    route_dict: RouteDict, regex: str
+    route_dict: RouteDict, regex: str, methods: Tuple[Methods, ...] = ("GET",)
 ) -> Callable[[RouteHandler], RouteHandler]:
+    """Registers the handler for urls fully matching regex. Routes taking
+    GET answer HEAD too"""
+
     def register(function: RouteHandler) -> RouteHandler:
-        log.debug("registering_route", {"route": regex, "handler": function.__name__})
-        route_dict[re.compile(regex)] = function
+        log.debug(
+            "registering_route",
+            {"route": regex, "methods": methods, "handler": function.__name__},
+        )
+        for method in methods:
+            route_dict[(regex, method)] = function
         return function
 
     return register
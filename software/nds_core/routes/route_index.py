@@ -1,40 +1,78 @@
 from .registry import register_route, RouteDict, RequestContext
 from ..webserver import HTTPResponse
 
-from .file_utils import openFragment, wrapContent
+from .file_utils import (
+    openFragment,
+    openTemplate,
+    wrapContent,
+    pageEtag,
+    DYNAMIC_CACHE_HEADERS,
+)
+from ..conditional import is_not_modified, not_modified_response, validator_headers
+from ..metrics import stage
+from .page_cache import INDEX_TAG
+from .pagination import PageCursor, trim_page, page_links
 
 routes: RouteDict = {}
 
+THREADS_PER_PAGE = 10
+
 
 @register_route(routes, r"/index.html")
 def request_thread_index(context: RequestContext) -> HTTPResponse:
+    cursor = PageCursor.from_request(context.request)
+    etag = pageEtag(
+        context.session,
+        "index",
+        cursor.etag_part(),
+        context.storage.query_latest_thread_id(),
+        context.storage.get_user_revision(),
+    )
+    if is_not_modified(context.request, etag, None):
+        return not_modified_response(etag, None, DYNAMIC_CACHE_HEADERS)
+
+    headers = DYNAMIC_CACHE_HEADERS + validator_headers(etag, None)
+    page = context.page_cache.get(context.request, context.session, etag)
+    if page is not None:
+        return context.page_cache.response(
+            context.server_config, context.request, page, headers
+        )
+
+    body = format_index(context, cursor)
+    context.page_cache.put(context.request, context.session, etag, body, INDEX_TAG)
+    return HTTPResponse(status_code=200, data=body, headers=headers)
+
+
+def format_index(context: RequestContext, cursor: PageCursor) -> bytes:
     new_thread_button = (
         openFragment("newThreadButton.html") if context.session is not None else ""
     )
 
-    threads = context.storage.query_threads(10, 0)
+    threads, page = trim_page(
+        context.storage.query_threads(
+            THREADS_PER_PAGE + 1, cursor.after, cursor.before
+        ),
+        lambda t: t.thread_id,
+        THREADS_PER_PAGE,
+        cursor,
+    )
     user_ids = [t.user_id for t in threads]
     user_data = context.storage.query_users_by_ids(user_ids)
 
-    thread_summary_fragment = openFragment("threadSummary.html")
-    thread_summary_str = "\n".join(
-        [
-            thread_summary_fragment.format(
-                THREAD=t, USER=next(u for u in user_data if u.user_id == t.user_id)
-            )
-            for t in threads
-        ]
-    )
+    with stage("template"):
+        thread_summary_fragment = openTemplate("threadSummary.html")
+        users_by_id = {u.user_id: u for u in user_data}
+        thread_summary_str = "\n".join(
+            [
+                thread_summary_fragment.format(THREAD=t, USER=users_by_id[t.user_id])
+                for t in threads
+            ]
+        )
 
-    thread_index_fragment = openFragment("threadIndex.html")
-    thread_index_fragment = thread_index_fragment.format(
-        THREAD_OVERVIEW=thread_summary_str,
-        NEW_THREAD_AREA=new_thread_button,
-    )
+        thread_index_fragment = openTemplate("threadIndex.html").format(
+            THREAD_OVERVIEW=thread_summary_str,
+            NEW_THREAD_AREA=new_thread_button,
+            PAGE_LINKS=page_links(context.request.url, page),
+        )
 
-    return HTTPResponse(
-        status_code=200,
-        data=wrapContent(
-            context.session, context.request, "Home", thread_index_fragment
-        ),
-    )
+    return wrapContent(context.session, context.request, "Home", thread_index_fragment)
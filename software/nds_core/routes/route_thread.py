@@ -1,72 +1,233 @@
-import urllib
 import datetime
-from typing import List
+from typing import Iterator, List, Optional, Union
 from .registry import register_route, RouteDict, RequestContext
 from ..webserver import HTTPResponse
 from ..storage import ThreadData, PostData, UserData
 
-from .file_utils import openFragment, wrapContent
+from .file_utils import (
+    openFragment,
+    openTemplate,
+    wrapContent,
+    wrapContentParts,
+    pageEtag,
+    DYNAMIC_CACHE_HEADERS,
+)
+from ..conditional import is_not_modified, not_modified_response, validator_headers
+from ..metrics import timed
+from .page_cache import thread_tag
+from .pagination import Page, PageCursor, trim_page, stream_page, page_links
 
 routes: RouteDict = {}
 
+POSTS_PER_PAGE = 100
+STREAM_BATCH_POSTS = 20  # Posts rendered into each chunk when streaming
+EVENTS_MAX_CATCH_UP = POSTS_PER_PAGE  # Missed posts a reconnecting browser gets
 
+
+@timed("template")
 def format_thread(
     context: RequestContext,
     thread: ThreadData,
     posts: List[PostData],
     users: List[UserData],
+    page: Page,
 ) -> bytes:
-    post = openFragment("post.html")
+    post = openTemplate("post.html")
+    users_by_id = {u.user_id: u for u in users}
     post_str = "\n".join(
-        [
-            post.format(POST=d, USER=next(u for u in users if u.user_id == d.user_id))
-            for d in posts
-        ]
+        [post.format(POST=d, USER=users_by_id[d.user_id]) for d in posts]
     )
 
-    thread_template = openFragment("thread.html")
+    thread_template = openTemplate("thread.html")
 
-    if context.session is None:
-        reply = openFragment("signInButton.html")
-    else:
-        reply = openFragment("newPost.html").format(
-            THREAD=thread,
-            USER=context.storage.query_users_by_ids([context.session.user_id])[0],
+    thread_str = thread_template.format(
+        POSTS=post_str,
+        LIVE_UPDATES=format_live_updates(thread, page),
+        REPLY=format_reply(context, thread),
+        PAGE_LINKS=page_links(context.request.url, page),
+    )
+
+    return wrapContent(context.session, context.request, thread.title, thread_str)
+
+
+def stream_thread(
+    context: RequestContext, thread: ThreadData, cursor: PageCursor, etag: bytes
+) -> Iterator[bytes]:
+    """format_thread, sent as the posts are read from the database. The
+    page head goes out before any posts have been read, so a long thread
+    starts arriving straight away and only STREAM_BATCH_POSTS of it are
+    ever held in memory (plus the copy kept for the page cache)"""
+    root_head, root_tail = wrapContentParts(
+        context.session, context.request, thread.title
+    )
+    thread_head, thread_tail = openTemplate("thread.html").split("POSTS")
+    post = openTemplate("post.html")
+    reply = format_reply(context, thread)
+    rows, page = stream_page(
+        context.storage.iter_posts_by_thread_id(
+            thread.thread_id, POSTS_PER_PAGE + 1, cursor.after, cursor.before
+        ),
+        lambda row: row[0].ordering,
+        POSTS_PER_PAGE,
+        cursor,
+    )
+    page_cache = context.page_cache
+    request = context.request
+    session = context.session
+
+    def generate() -> Iterator[bytes]:
+        sent: List[bytes] = []
+        batch: List[str] = []
+
+        def chunk(data: bytes) -> bytes:
+            if page_cache.max_bytes > 0:
+                sent.append(data)
+            return data
+
+        yield chunk(root_head + thread_head.format().encode("utf-8"))
+        separator = ""
+        for post_data, user_data in rows:
+            batch.append(separator + post.format(POST=post_data, USER=user_data))
+            separator = "\n"
+            if len(batch) == STREAM_BATCH_POSTS:
+                yield chunk("".join(batch).encode("utf-8"))
+                batch = []
+        batch.append(
+            thread_tail.format(
+                LIVE_UPDATES=format_live_updates(thread, page),
+                REPLY=reply,
+                PAGE_LINKS=page_links(request.url, page),
+            )
         )
+        yield chunk("".join(batch).encode("utf-8") + root_tail)
+        if sent:
+            page_cache.put(
+                request, session, etag, b"".join(sent), thread_tag(thread.thread_id)
+            )
 
-    thread_str = thread_template.format(POSTS=post_str, REPLY=reply)
+    return generate()
 
-    return wrapContent(context.session, context.request, thread.title, thread_str)
+
+def format_reply(context: RequestContext, thread: ThreadData) -> str:
+    if context.session is None:
+        return openFragment("signInButton.html")
+    return openTemplate("newPost.html").format(
+        THREAD=thread,
+        USER=context.storage.query_users_by_ids([context.session.user_id])[0],
+    )
+
+
+def format_live_updates(thread: ThreadData, page: Page) -> str:
+    """New posts are only added to the last page"""
+    if page.has_next or page.last_key is None:
+        return ""
+    return openTemplate("liveUpdates.html").format(THREAD=thread, AFTER=page.last_key)
 
 
 @register_route(routes, r"/threads/(?P<thread_id>\d+)/")
 def request_thread(context: RequestContext) -> HTTPResponse:
     thread_id = int(context.url_match.groupdict()["thread_id"])
+    cursor = PageCursor.from_request(context.request)
 
+    thread_version = context.storage.query_thread_version(thread_id)
     thread_data = context.storage.query_thread_by_id(thread_id)
-    if thread_data is None:
+    if thread_version is None or thread_data is None:
         return HTTPResponse(
             status_code=302,
             headers=[(b"Location", b"404.html")],
         )
 
-    posts = context.storage.query_posts_by_thread_id(thread_id, 100, 0)
+    latest_post_id, last_modified = thread_version
+    etag = pageEtag(
+        context.session,
+        "thread",
+        thread_id,
+        cursor.etag_part(),
+        latest_post_id,
+        int(last_modified.timestamp()),
+        context.storage.get_user_revision(),
+    )
+    if is_not_modified(context.request, etag, last_modified):
+        return not_modified_response(etag, last_modified, DYNAMIC_CACHE_HEADERS)
+
+    headers = DYNAMIC_CACHE_HEADERS + validator_headers(etag, last_modified)
+    cached = context.page_cache.get(context.request, context.session, etag)
+    if cached is not None:
+        return context.page_cache.response(
+            context.server_config, context.request, cached, headers
+        )
+    if context.server_config.WEBSERVER_STREAM_THREADS:
+        return HTTPResponse(
+            status_code=200,
+            data=stream_thread(context, thread_data, cursor, etag),
+            headers=headers,
+        )
+
+    posts, page = trim_page(
+        context.storage.query_posts_by_thread_id(
+            thread_id, POSTS_PER_PAGE + 1, cursor.after, cursor.before
+        ),
+        lambda p: p.ordering,
+        POSTS_PER_PAGE,
+        cursor,
+    )
     user_ids = [p.user_id for p in posts]
     users = context.storage.query_users_by_ids(user_ids)
+    body = format_thread(context, thread_data, posts, users, page)
+    context.page_cache.put(
+        context.request, context.session, etag, body, thread_tag(thread_id)
+    )
+    return HTTPResponse(status_code=200, data=body, headers=headers)
+
+
+@register_route(routes, r"/threads/(?P<thread_id>\d+)/events")
+def thread_events(context: RequestContext) -> HTTPResponse:
+    """Server-sent events with each post made to the thread from now on.
+    Reconnecting browsers say where they got up to with Last-Event-ID"""
+    thread_id = int(context.url_match.groupdict()["thread_id"])
+    latest = context.storage.query_latest_post_ordering(thread_id)
+    if latest is None:
+        return HTTPResponse(
+            status_code=302,
+            headers=[(b"Location", b"/404.html")],
+        )
+
+    after = _parse_ordering(context.request.headers.get(b"Last-Event-ID"))
+    if after is None:
+        after = _parse_ordering(context.request.get_query_param("after"))
+    if after is None:
+        after = latest
+    # A browser further behind than that reloads the page to see the rest.
+    # Without a limit anyone could have the whole thread read and rendered
+    after = max(after, latest - EVENTS_MAX_CATCH_UP)
 
     return HTTPResponse(
-        status_code=200, data=format_thread(context, thread_data, posts, users)
+        status_code=200,
+        data=context.live_updates.watch(thread_id, after),
+        headers=[
+            (b"Content-Type", b"text/event-stream"),
+            (b"Cache-Control", b"no-cache"),
+            (b"X-Accel-Buffering", b"no"),  # Don't let proxies hold events back
+        ],
     )
 
 
-@register_route(routes, r"/threads/(?P<thread_id>\d+)/reply.html")
+def _parse_ordering(value: Optional[Union[str, bytes]]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+@register_route(routes, r"/threads/(?P<thread_id>\d+)/reply.html", methods=("POST",))
 def reply_to_thread(context: RequestContext) -> HTTPResponse:
     if context.session is None:
         return HTTPResponse(status_code=403)
 
     thread_id = int(context.url_match.groupdict()["thread_id"])
-    reply_data = urllib.parse.parse_qs(context.request.content)
-    reply_content = next(iter(reply_data.get(b"reply_content", [])), None)
+    reply_content = context.request.get_form_value(b"reply_content")
 
     if reply_content is None:
         return HTTPResponse(status_code=400, data=b"Missing content")
@@ -97,19 +258,18 @@ def new_thread_editor(context: RequestContext) -> HTTPResponse:
             context.session,
             context.request,
             "CREATE THREAD",
-            openFragment("newThread.html").format(USER=user_data),
+            openTemplate("newThread.html").format(USER=user_data),
         ),
     )
 
 
-@register_route(routes, r"/threads/create.html")
+@register_route(routes, r"/threads/create.html", methods=("POST",))
 def create_thread(context: RequestContext) -> HTTPResponse:
     if context.session is None:
         return HTTPResponse(status_code=403)
-    thread_data = urllib.parse.parse_qs(context.request.content)
 
-    thread_name = next(iter(thread_data.get(b"thread_name", [])), None)
-    thread_content = next(iter(thread_data.get(b"thread_content", [])), None)
+    thread_name = context.request.get_form_value(b"thread_name")
+    thread_content = context.request.get_form_value(b"thread_content")
 
     if thread_name is None or thread_content is None:
         return HTTPResponse(status_code=400, data=b"Missing thread title or content")
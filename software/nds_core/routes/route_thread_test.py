@@ -0,0 +1,90 @@
+import datetime
+from typing import Iterator, Optional, cast
+
+import pytest
+
+from ..config import _Config
+from ..session import Sessions
+from ..storage import ColorData, SessionData, Storage
+from ..webserver import HTTPRequest, PushStream
+from . import DISPATCHER
+from .live_updates import LiveUpdates
+from .page_cache import PageCache
+from .registry import RequestContext
+from .route_thread import (
+    EVENTS_MAX_CATCH_UP,
+    POSTS_PER_PAGE,
+    request_thread,
+    thread_events,
+)
+
+
+@pytest.fixture
+def storage() -> Iterator[Storage]:
+    storage = Storage(":memory:")
+    now = datetime.datetime.now()
+    user_id = storage.create_user("testUser", b"testSecret", ColorData(1, 2, 3))
+    thread_id = storage.create_thread(now, user_id, "Thread", "First post")
+    for i in range(POSTS_PER_PAGE * 2):
+        storage.create_post_in_thread(user_id, thread_id, now, f"Post {i}")
+    yield storage
+    storage.close()
+
+
+def make_context(
+    storage: Storage,
+    server_config: _Config,
+    request: HTTPRequest,
+    session: Optional[SessionData],
+) -> RequestContext:
+    route_match = DISPATCHER.match("GET", request.url)
+    assert route_match is not None
+    return RequestContext(
+        storage,
+        request,
+        session,
+        route_match.url_match,
+        PageCache(0),
+        server_config,
+        LiveUpdates(server_config, storage),
+        Sessions(server_config, storage),
+    )
+
+
+def render(
+    storage: Storage, query_string: str, session: Optional[SessionData], stream: bool
+) -> bytes:
+    server_config = _Config()
+    server_config.WEBSERVER_STREAM_THREADS = stream
+    request = HTTPRequest("GET", "/threads/1/", b"", [], query_string=query_string)
+    response = request_thread(make_context(storage, server_config, request, session))
+    assert response.status_code == 200
+    if isinstance(response.data, bytes):
+        assert not stream
+        return response.data
+    assert stream
+    return b"".join(cast(Iterator[bytes], response.data))
+
+
+@pytest.mark.parametrize("query_string", ["", "after=50", "after=150", "before=120"])
+@pytest.mark.parametrize("signed_in", [False, True])
+def test_streamed_page_matches_rendered(
+    storage: Storage, query_string: str, signed_in: bool
+) -> None:
+    now = datetime.datetime.now()
+    session = SessionData(1, "key", now, now) if signed_in else None
+    rendered = render(storage, query_string, session, stream=False)
+    assert b"Post 1" in rendered
+    assert render(storage, query_string, session, stream=True) == rendered
+
+
+def test_events_only_catch_up_so_far(storage: Storage) -> None:
+    request = HTTPRequest(
+        "GET", "/threads/1/events", b"", [(b"Last-Event-ID", b"-1")], query_string=""
+    )
+    context = make_context(storage, _Config(), request, None)
+    response = thread_events(context)
+    assert isinstance(response.data, PushStream)
+    chunks, _ = response.data.take()
+    assert b"".join(chunks).count(b"event: post") == EVENTS_MAX_CATCH_UP
+    context.live_updates.close()
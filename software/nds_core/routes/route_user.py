@@ -1,21 +1,28 @@
-import urllib.parse
 import random
 from ..webserver import HTTPResponse
-from ..auth import encode_password, validate_password_v1
-from ..session import create_session_header
+from ..auth import HasherBusy, encode_password, validate_password
+from ..session import clear_session_header
 from .registry import RouteDict, register_route, RequestContext
-from .file_utils import wrapContent, openFragment
+from .file_utils import wrapContent, openFragment, openTemplate
 from ..storage import ColorData, UserData
 
 
 routes: RouteDict = {}
 
 
-@register_route(routes, r"/user/create.html")
+def hasher_busy(context: RequestContext) -> HTTPResponse:
+    """Too many people are signing in at once"""
+    retry_after = context.server_config.WEBSERVER_RETRY_AFTER_S
+    return HTTPResponse(
+        status_code=503,
+        headers=[(b"Retry-After", str(retry_after).encode("utf-8"))],
+    )
+
+
+@register_route(routes, r"/user/create.html", methods=("POST",))
 def create_user(context: RequestContext) -> HTTPResponse:
-    user_data = urllib.parse.parse_qs(context.request.content)
-    user_name = next(iter(user_data.get(b"user_name", [])), None)
-    password = next(iter(user_data.get(b"password", [])), None)
+    user_name = context.request.get_form_value(b"user_name")
+    password = context.request.get_form_value(b"password")
     if user_name is None or password is None or len(password) < 1:
         return HTTPResponse(status_code=400, data=b"missing username or password")
 
@@ -23,7 +30,10 @@ def create_user(context: RequestContext) -> HTTPResponse:
         r=random.randint(0, 255), g=random.randint(0, 255), b=random.randint(0, 255)
     )
 
-    secret_bundle = encode_password(password)
+    try:
+        secret_bundle = encode_password(password)
+    except HasherBusy:
+        return hasher_busy(context)
     user_id = context.storage.create_user(
         user_name=user_name.decode("utf-8"), secret=secret_bundle, color=color
     )
@@ -32,13 +42,13 @@ def create_user(context: RequestContext) -> HTTPResponse:
         status_code=302,
         data=f"Created User {user_id}".encode("utf-8"),
         headers=[
-            create_session_header(context.storage, user_id),
+            context.sessions.create_header(user_id),
             (b"Location", b"/index.html"),
         ],
     )
 
 
-@register_route(routes, r"/user/update.html")
+@register_route(routes, r"/user/update.html", methods=("POST",))
 def update_user(context: RequestContext) -> HTTPResponse:
     if context.session is None or context.session.user_id is None:
         return HTTPResponse(
@@ -49,10 +59,9 @@ def update_user(context: RequestContext) -> HTTPResponse:
     user_id = context.session.user_id
     current_userdata = context.storage.query_users_by_ids([user_id])[0]
 
-    user_data = urllib.parse.parse_qs(context.request.content)
-    user_name = next(iter(user_data.get(b"user_name", [])), None)
-    password = next(iter(user_data.get(b"password", [])), None)
-    color = next(iter(user_data.get(b"color", [])), None)
+    user_name = context.request.get_form_value(b"user_name")
+    password = context.request.get_form_value(b"password")
+    color = context.request.get_form_value(b"color")
 
     if user_name is None or user_name == b"":
         # Don't change username
@@ -63,7 +72,10 @@ def update_user(context: RequestContext) -> HTTPResponse:
         secret_bundle = current_userdata.secret
     else:
         print("Changing Password")
-        secret_bundle = encode_password(password)
+        try:
+            secret_bundle = encode_password(password)
+        except HasherBusy:
+            return hasher_busy(context)
 
     if color is None or color == b"":
         colorData = current_userdata.color
@@ -86,11 +98,10 @@ def update_user(context: RequestContext) -> HTTPResponse:
     )
 
 
-@register_route(routes, r"/user/login.html")
+@register_route(routes, r"/user/login.html", methods=("POST",))
 def login_user(context: RequestContext) -> HTTPResponse:
-    user_data_str = urllib.parse.parse_qs(context.request.content)
-    user_name = next(iter(user_data_str.get(b"user_name", [])), None)
-    password = next(iter(user_data_str.get(b"password", [])), None)
+    user_name = context.request.get_form_value(b"user_name")
+    password = context.request.get_form_value(b"password")
     if user_name is None or password is None or len(password) < 1:
         return HTTPResponse(status_code=400, data=b"missing username or password")
 
@@ -99,7 +110,10 @@ def login_user(context: RequestContext) -> HTTPResponse:
         # No User with that name: 403
         return HTTPResponse(status_code=302, headers=[(b"Location", b"/403.html")])
 
-    password_is_valid = validate_password_v1(password, user_data.secret)
+    try:
+        password_is_valid = validate_password(password, user_data.secret)
+    except HasherBusy:
+        return hasher_busy(context)
     if not password_is_valid:
         return HTTPResponse(status_code=302, headers=[(b"Location", b"/403.html")])
 
@@ -107,21 +121,21 @@ def login_user(context: RequestContext) -> HTTPResponse:
         status_code=302,
         data=b"SUCCESS! You typed your password right!",
         headers=[
-            create_session_header(context.storage, user_data.user_id),
+            context.sessions.create_header(user_data.user_id),
             (b"Location", b"/index.html"),
         ],
     )
 
 
-@register_route(routes, r"/user/logout.html")
+@register_route(routes, r"/user/logout.html", methods=("POST",))
 def logout_user(context: RequestContext) -> HTTPResponse:
     if context.session is not None:
-        context.storage.delete_session_by_key(context.session.session_key)
+        context.sessions.end(context.session)
 
         return HTTPResponse(
             status_code=302,
             data=b"Signed Out",
-            headers=[(b"Location", b"/index.html")],
+            headers=[(b"Location", b"/index.html"), clear_session_header()],
         )
     else:
         return HTTPResponse(
@@ -150,8 +164,9 @@ def profile_page(context: RequestContext) -> HTTPResponse:
         )
     userData = context.storage.query_users_by_ids([context.session.user_id])[0]
 
-    profile = openFragment("profile.html")
-    profile = profile.format(SESSION=context.session, USER=userData)
+    profile = openTemplate("profile.html").format(
+        SESSION=context.session, USER=userData
+    )
 
     return HTTPResponse(
         status_code=200,
@@ -0,0 +1,10 @@
+// Adds posts to the thread as they are made. The script tag sits just
+// after the thread's posts
+(function () {
+    var script = document.currentScript;
+    var posts = script.previousElementSibling;
+    var events = new EventSource(script.dataset.events);
+    events.addEventListener("post", function (event) {
+        posts.insertAdjacentHTML("beforeend", event.data);
+    });
+})();
@@ -0,0 +1,181 @@
+import datetime
+import mimetypes
+import os
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+from ..config import _Config
+from ..webserver import HTTPRequest, HTTPResponse, Headers
+from ..compression import ENCODINGS, choose_encoding, compress, is_compressible_file
+from ..conditional import make_etag, validator_headers
+
+CACHE_CONTROL = (b"Cache-Control", b"max-age=3600")
+
+
+class StaticFile:
+    """A static file and everything needed to send it. Small files are held
+    in memory along with their compressed variants, each with its headers
+    ready to go. Anything that didn't fit is sent from disk with sendfile."""
+
+    path: str
+    mtime_ns: int
+    size: int
+    headers: Headers  # For the uncompressed file
+    data: Optional[bytes]  # None if it is sent from disk
+    variants: Dict[str, bytes]  # encoding -> compressed data
+    variant_headers: Dict[str, Headers]  # encoding -> headers
+
+    def __init__(self, path: str, stat: os.stat_result):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.data = None
+        self.variants = {}
+        self.variant_headers = {}
+
+        content_type, _ = mimetypes.guess_type(path)
+        etag = make_etag(f"{stat.st_size:x}", f"{stat.st_mtime_ns:x}")
+        last_modified = datetime.datetime.fromtimestamp(stat.st_mtime)
+        self.headers = [CACHE_CONTROL] + validator_headers(etag, last_modified)
+        if content_type is not None:
+            self.headers.append((b"Content-Type", content_type.encode("utf-8")))
+
+    def load(self, server_config: _Config) -> None:
+        """Reads the file into memory and compresses it"""
+        with open(self.path, "rb") as static_file:
+            data = static_file.read()
+        self.data = data
+        self.headers = self.headers + [
+            (b"Content-Length", str(len(data)).encode("utf-8"))
+        ]
+
+        if len(data) < server_config.WEBSERVER_COMPRESS_MIN_BYTES:
+            return
+        if not is_compressible_file(server_config, self.path):
+            return
+        self.headers.append((b"Vary", b"Accept-Encoding"))
+        for encoding in ENCODINGS:
+            compressed = compress(
+                data, encoding, server_config.WEBSERVER_COMPRESS_LEVEL
+            )
+            if len(compressed) >= len(data):
+                continue
+            self.variants[encoding] = compressed
+            self.variant_headers[encoding] = [
+                _encoded_header(key, val, encoding)
+                for key, val in self.headers
+                if key != b"Content-Length"
+            ] + [
+                (b"Content-Length", str(len(compressed)).encode("utf-8")),
+                (b"Content-Encoding", encoding.encode("utf-8")),
+            ]
+
+    def memory_used(self) -> int:
+        return len(self.data or b"") + sum(len(v) for v in self.variants.values())
+
+    def response(self, request: HTTPRequest) -> HTTPResponse:
+        if self.data is None:
+            # Not cached, the server works out the length from the file
+            return HTTPResponse(200, open(self.path, "rb"), self.headers)
+
+        if self.variants:
+            encoding = choose_encoding(request)
+            if encoding is not None and encoding in self.variants:
+                return HTTPResponse(
+                    200, self.variants[encoding], self.variant_headers[encoding]
+                )
+        return HTTPResponse(200, self.data, self.headers)
+
+
+class StaticCache:
+    """Serves the files in a directory from memory. Files are loaded the
+    first time they are asked for and reloaded if their mtime changes.
+    Once WEBSERVER_STATIC_CACHE_BYTES is used up, or for files over
+    WEBSERVER_STATIC_CACHE_MAX_FILE_BYTES, files are sent from disk instead.
+    Responses already carry the best Content-Encoding for the client, so
+    they don't need to go through compress_response."""
+
+    server_config: _Config
+    directory: str
+    names: Set[str]
+    directory_mtime_ns: int
+    files: Dict[str, StaticFile]
+    memory_used: int
+    lock: threading.Lock
+
+    def __init__(self, server_config: _Config, directory: str):
+        self.server_config = server_config
+        self.directory = directory
+        self.names = set()
+        self.directory_mtime_ns = -1
+        self.files = {}
+        self.memory_used = 0
+        self.lock = threading.Lock()
+        self._scan_directory()
+
+    def get(self, name: str) -> Optional[StaticFile]:
+        """The file called name, if it is in the directory"""
+        if name not in self.names:
+            # It might have been added since the directory was last listed
+            if not self._scan_directory() or name not in self.names:
+                return None
+
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._forget(name)
+            return None
+
+        static_file = self.files.get(name)
+        if (
+            static_file is not None
+            and static_file.mtime_ns == stat.st_mtime_ns
+            and static_file.size == stat.st_size
+        ):
+            return static_file
+        return self._load(name, path, stat)
+
+    def _load(self, name: str, path: str, stat: os.stat_result) -> StaticFile:
+        static_file = StaticFile(path, stat)
+        if stat.st_size <= self.server_config.WEBSERVER_STATIC_CACHE_MAX_FILE_BYTES:
+            static_file.load(self.server_config)
+
+        with self.lock:
+            old = self.files.pop(name, None)
+            if old is not None:
+                self.memory_used -= old.memory_used()
+
+            space = self.server_config.WEBSERVER_STATIC_CACHE_BYTES - self.memory_used
+            if static_file.memory_used() > space:
+                # Out of room, leave it on disk
+                static_file = StaticFile(path, stat)
+
+            self.files[name] = static_file
+            self.memory_used += static_file.memory_used()
+        return static_file
+
+    def _forget(self, name: str) -> None:
+        with self.lock:
+            self.names.discard(name)
+            old = self.files.pop(name, None)
+            if old is not None:
+                self.memory_used -= old.memory_used()
+
+    def _scan_directory(self) -> bool:
+        """Relists the directory if it has changed. Returns True if it did"""
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        if mtime_ns == self.directory_mtime_ns:
+            return False
+        self.names = {
+            entry.name for entry in os.scandir(self.directory) if entry.is_file()
+        }
+        self.directory_mtime_ns = mtime_ns
+        return True
+
+
+def _encoded_header(key: bytes, val: bytes, encoding: str) -> Tuple[bytes, bytes]:
+    if key == b"ETag":
+        # Same naming as compress_response, so conditional.py matches it
+        return (key, val[:-1] + b"-" + encoding.encode("utf-8") + b'"')
+    return (key, val)
@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+
+from ..config import _Config
+from ..webserver import HTTPRequest, get_header, is_file_body
+from .static_cache import StaticCache
+
+CSS = b"body { color: red; }\n" * 100
+
+
+def make_request(accept_encoding: bytes = b"gzip") -> HTTPRequest:
+    return HTTPRequest(
+        "GET", "/style.css", b"", [(b"Accept-Encoding", accept_encoding)]
+    )
+
+
+def make_cache(directory: Path) -> StaticCache:
+    server_config = _Config()
+    server_config.WEBSERVER_STATIC_CACHE_BYTES = 3000
+    server_config.WEBSERVER_STATIC_CACHE_MAX_FILE_BYTES = 4000
+    return StaticCache(server_config, str(directory))
+
+
+def test_serves_cached_variants(tmp_path: Path) -> None:
+    (tmp_path / "style.css").write_bytes(CSS)
+    cache = make_cache(tmp_path)
+    static_file = cache.get("style.css")
+    assert static_file is not None
+
+    response = static_file.response(make_request(b"gzip"))
+    assert isinstance(response.data, bytes)
+    assert len(response.data) < len(CSS)
+    assert get_header(response.headers, b"Content-Encoding") == b"gzip"
+    assert get_header(response.headers, b"Content-Type") == b"text/css"
+    assert get_header(response.headers, b"Content-Length") == str(
+        len(response.data)
+    ).encode("utf-8")
+
+    response = static_file.response(make_request(b"identity"))
+    assert response.data == CSS
+    assert get_header(response.headers, b"Content-Encoding") is None
+
+    assert cache.get("missing.css") is None
+    assert cache.get("../static_cache_test.py") is None
+
+
+def test_reloads_changed_files(tmp_path: Path) -> None:
+    path = tmp_path / "style.css"
+    path.write_bytes(CSS)
+    cache = make_cache(tmp_path)
+    first = cache.get("style.css")
+
+    path.write_bytes(b"p {}")
+    os.utime(path, ns=(0, 1))
+    second = cache.get("style.css")
+    assert second is not first
+    assert second is not None
+    assert second.data == b"p {}"
+    assert cache.get("style.css") is second
+
+    # New files show up without restarting
+    (tmp_path / "new.css").write_bytes(b"a {}")
+    assert cache.get("new.css") is not None
+
+
+def test_large_files_are_sent_from_disk(tmp_path: Path) -> None:
+    (tmp_path / "big.bin").write_bytes(b"x" * 5000)
+    (tmp_path / "a.css").write_bytes(CSS)
+    (tmp_path / "b.css").write_bytes(CSS)
+    cache = make_cache(tmp_path)
+
+    big = cache.get("big.bin")
+    assert big is not None
+    response = big.response(make_request())
+    assert is_file_body(response.data)
+    response.data.close()  # type: ignore
+
+    # The second css file doesn't fit under the memory cap
+    a_file = cache.get("a.css")
+    b_file = cache.get("b.css")
+    assert a_file is not None and a_file.data is not None
+    assert b_file is not None and b_file.data is None
+    assert cache.memory_used <= 3000
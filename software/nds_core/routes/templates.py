@@ -0,0 +1,137 @@
+import operator
+import os
+import string
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Pulls a field's value out of the keyword arguments, eg {USER.color.r}
+FieldGetter = Callable[[Dict[str, Any]], Any]
+
+_CONVERSIONS: Dict[str, Callable[[Any], str]] = {"r": repr, "s": str, "a": ascii}
+
+
+class Template:
+    """A fragment parsed once into literal text and the fields between it.
+    format() gives the same result as str.format on the original text, but
+    only has to look up the fields and join the pieces."""
+
+    source: str  # Empty for the halves made by split
+    literals: List[str]  # One more than there are fields
+    fields: List[Tuple[FieldGetter, str]]  # (getter, format spec)
+    names: List[str]  # Of the fields, as written in the template
+
+    def __init__(self, source: str):
+        self.source = source
+        self.literals = []
+        self.fields = []
+        self.names = []
+
+        literal = ""
+        for text, field_name, format_spec, conversion in string.Formatter().parse(
+            source
+        ):
+            literal += text
+            if field_name is None:
+                continue
+            self.literals.append(literal)
+            literal = ""
+            self.fields.append(
+                (_compile_field(field_name, conversion), format_spec or "")
+            )
+            self.names.append(field_name)
+        self.literals.append(literal)
+
+    def format(self, **kwargs: Any) -> str:
+        if not self.fields:
+            return self.literals[0]
+        parts = []
+        for literal, (getter, format_spec) in zip(self.literals, self.fields):
+            parts.append(literal)
+            parts.append(format(getter(kwargs), format_spec))
+        parts.append(self.literals[-1])
+        return "".join(parts)
+
+    def split(self, field_name: str) -> Tuple["Template", "Template"]:
+        """The templates either side of the first {field_name}, so that a
+        page can be sent before what goes there is ready"""
+        index = self.names.index(field_name)
+        after = index + 1
+        return (
+            _from_parts(self.literals[:after], self.fields[:index], self.names[:index]),
+            _from_parts(self.literals[after:], self.fields[after:], self.names[after:]),
+        )
+
+
+class TemplateCache:
+    """Compiled templates by file name. Each file is read once, unless
+    auto_reload is on (DEV_MODE) in which case it is recompiled whenever its
+    mtime changes."""
+
+    directory: str
+    auto_reload: bool
+    templates: Dict[str, Tuple[int, Template]]  # name -> (mtime_ns, template)
+    lock: threading.Lock
+
+    def __init__(self, directory: str, auto_reload: bool = False):
+        self.directory = directory
+        self.auto_reload = auto_reload
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> Template:
+        cached = self.templates.get(name)
+        if cached is not None and not self.auto_reload:
+            return cached[1]
+
+        path = os.path.join(self.directory, name)
+        mtime_ns = os.stat(path).st_mtime_ns
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+        with open(path, "r", encoding="utf-8") as template_file:
+            template = Template(template_file.read())
+        with self.lock:
+            self.templates[name] = (mtime_ns, template)
+        return template
+
+
+def _from_parts(
+    literals: List[str], fields: List[Tuple[FieldGetter, str]], names: List[str]
+) -> Template:
+    template = Template("")
+    template.literals = literals
+    template.fields = fields
+    template.names = names
+    return template
+
+
+def _compile_field(field_name: str, conversion: Optional[str]) -> FieldGetter:
+    first, rest = _split_field_name(field_name)
+    if "[" in rest:
+        # Indexing isn't worth compiling, leave it to string.Formatter
+        def get_field(kwargs: Dict[str, Any]) -> Any:
+            return string.Formatter().get_field(field_name, (), kwargs)[0]
+
+    elif rest:
+        get_attr = operator.attrgetter(rest[1:])
+
+        def get_field(kwargs: Dict[str, Any]) -> Any:
+            return get_attr(kwargs[first])
+
+    else:
+
+        def get_field(kwargs: Dict[str, Any]) -> Any:
+            return kwargs[first]
+
+    if conversion is None:
+        return get_field
+    convert = _CONVERSIONS[conversion]
+    return lambda kwargs: convert(get_field(kwargs))
+
+
+def _split_field_name(field_name: str) -> Tuple[str, str]:
+    # "USER.color.r" -> ("USER", ".color.r")
+    for i, char in enumerate(field_name):
+        if char in ".[":
+            return field_name[:i], field_name[i:]
+    return field_name, ""
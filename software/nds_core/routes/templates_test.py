@@ -0,0 +1,58 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from .templates import Template, TemplateCache
+from ..storage import ColorData, UserData
+
+
+def test_matches_str_format() -> None:
+    user = UserData("bob", 3, b"secret", ColorData(10, 20, 30))
+    sources = [
+        "<p style='color:rgb({USER.color.r},{USER.color.g},{USER.color.b})'>",
+        "{USER.user_name}: {TEXT} {{literal braces}}",
+        "{TEXT!r} {TEXT!s:>10} {NUMBER:04d} {NUMBER:x}",
+        "{ITEMS[1]} {ITEMS[0]}",
+        "",
+        "no fields at all",
+        "{TEXT}{TEXT}",
+    ]
+    kwargs = dict(USER=user, TEXT="hi", NUMBER=42, ITEMS=["a", "b"])
+    for source in sources:
+        assert Template(source).format(**kwargs) == source.format(**kwargs)
+
+
+def test_missing_field() -> None:
+    with pytest.raises(KeyError):
+        Template("{MISSING}").format(OTHER=1)
+
+
+def test_cache_reloads(tmp_path: Path) -> None:
+    path = tmp_path / "page.html"
+    with open(path, "w") as page:
+        page.write("first {X}")
+
+    cache = TemplateCache(str(tmp_path))
+    assert cache.get("page.html").format(X=1) == "first 1"
+    assert cache.get("page.html") is cache.get("page.html")
+
+    with open(path, "w") as page:
+        page.write("second {X}")
+    os.utime(path, ns=(0, 10**9))
+
+    # Files are only read once unless auto_reload is on
+    assert cache.get("page.html").format(X=1) == "first 1"
+    cache.auto_reload = True
+    assert cache.get("page.html").format(X=1) == "second 1"
+
+
+def test_split() -> None:
+    template = Template("<a>{TITLE}</a>{CONTENT}<b>{USER.user_name}{TITLE}</b>")
+    head, tail = template.split("CONTENT")
+    user = UserData("bob", 3, b"secret", ColorData(10, 20, 30))
+    assert head.format(TITLE="t") == "<a>t</a>"
+    assert tail.format(TITLE="t", USER=user) == "<b>bobt</b>"
+    assert head.format(TITLE="t") + "c" + tail.format(TITLE="t", USER=user) == (
+        template.format(TITLE="t", CONTENT="c", USER=user)
+    )
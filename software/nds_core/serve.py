@@ -1,22 +1,137 @@
+import signal
+import socket
+from types import FrameType
+from typing import Optional
+
 from .config import config, _Config
-import time
 
-from .webserver import HttpSocket, serve_page, HTTPRequest, HTTPResponse
-from .routes import handle_route_request
+from .webserver import HttpSocket, HTTPRequest, HTTPResponse
+from .server import Server, SentHook
+from . import metrics
+from . import log
+from . import auth
+from .prefork import Supervisor
+from .compression import compress_response
+from .conditional import conditional_response
+from .routes import handle_route_request, STATIC_ROUTE
+from .routes.file_utils import STATIC_DIR, TEMPLATES
+from .routes.static_cache import StaticCache
+from .routes.page_cache import PageCache
+from .routes.live_updates import LiveUpdates
 from .storage import Storage
+from .session import Sessions, SessionSweeper
+
+
+def run_worker(server_config: _Config, http_socket: socket.socket) -> None:
+    """Serves requests on http_socket until stopped. Every worker process
+    opens its own connection to the database"""
+    storage = Storage(server_config.STORAGE_PATH)
+    sessions = Sessions(server_config, storage)
+    session_sweeper = SessionSweeper(server_config, storage)
+    session_sweeper.start()
+    static_cache = StaticCache(server_config, STATIC_DIR)
+    TEMPLATES.auto_reload = server_config.DEV_MODE
+    page_cache = PageCache(server_config.WEBSERVER_PAGE_CACHE_BYTES)
+    storage.add_write_listener(page_cache.data_changed)
+    live_updates = LiveUpdates(server_config, storage)
+    storage.add_write_listener(live_updates.data_changed)
+    metrics_path = server_config.WEBSERVER_METRICS_PATH
+
+    def serve_page(request: HTTPRequest) -> HTTPResponse:
+        response = handle_route_request(
+            server_config,
+            storage,
+            sessions,
+            static_cache,
+            page_cache,
+            live_updates,
+            request,
+        )
+        response = conditional_response(request, response)
+        if request.route == STATIC_ROUTE:
+            return response  # Already in the encoding the client wants
+        return compress_response(server_config, request, response)
+
+    def route_handler(request: HTTPRequest) -> HTTPResponse:
+        if metrics_path is None:
+            return serve_page(request)
+        if request.url == metrics_path:
+            return metrics_response(server, page_cache)
+
+        start = metrics.start_request()
+        status_code = 500
+        try:
+            response = serve_page(request)
+            status_code = response.status_code
+            return response
+        finally:
+            metrics.finish_request(request.route or "unmatched", status_code, start)
+
+    def response_sent(request: HTTPRequest, num_bytes: int, seconds: float) -> None:
+        metrics.metrics.record_sent(request.route or "unmatched", num_bytes, seconds)
+
+    sent_hook: Optional[SentHook] = None if metrics_path is None else response_sent
+    server = Server(server_config, http_socket, route_handler, sent_hook)
+
+    def on_stop_signal(signum: int, frame: Optional[FrameType]) -> None:
+        # Stop rather than die, so everything below gets closed
+        server.stop()
+
+    previous_handlers = {
+        signum: signal.signal(signum, on_stop_signal)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        server.serve_forever()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        session_sweeper.close()
+        auth.close()
+        live_updates.close()
+        server.close()
+        storage.close()
+
+
+def metrics_response(server: Server, page_cache: PageCache) -> HTTPResponse:
+    counters = {
+        f"nds_server_{name}_total": value
+        for name, value in server.stats.as_dict().items()
+    }
+    for name, value in page_cache.stats.as_dict().items():
+        counters[f"nds_page_cache_{name}_total"] = value
+    gauges = {
+        "nds_open_connections": len(server.connections),
+        "nds_page_cache_bytes": page_cache.memory_used,
+        "nds_page_cache_pages": len(page_cache.pages),
+    }
+    if server.worker_pool is not None:
+        gauges["nds_handler_queue_length"] = server.worker_pool.queued()
+    return HTTPResponse(
+        status_code=200,
+        data=metrics.metrics.render(counters, gauges),
+        headers=[
+            (b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8"),
+            (b"Cache-Control", b"no-store"),
+        ],
+    )
 
 
 def run(server_config: _Config) -> None:
-    with HttpSocket(server_config) as http_socket:
-        storage = Storage("testdb.db")
+    log.configure(server_config)
+    auth.configure(server_config)
+    if server_config.WEBSERVER_WORKER_PROCESSES <= 1:
+        with HttpSocket(server_config) as http_socket:
+            run_worker(server_config, http_socket)
+        return
 
-        def route_handler(request: HTTPRequest) -> HTTPResponse:
-            return handle_route_request(storage, request)
+    # Bring the database up to date once, before the workers race to do it
+    Storage(server_config.STORAGE_PATH).close()
 
-        while 1:
-            served_client = serve_page(server_config, http_socket, route_handler)
-            if not served_client:
-                time.sleep(0.1)  # TODO: base this on if a request was served or not
+    supervisor = Supervisor(
+        server_config, lambda http_socket: run_worker(server_config, http_socket)
+    )
+    supervisor.run()
 
 
 if __name__ == "__main__":
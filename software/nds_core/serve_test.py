@@ -0,0 +1,40 @@
+import os
+import signal
+import socket
+from pathlib import Path
+
+from .config import _Config
+from .serve import run_worker
+from .webserver import HttpSocket
+
+
+def test_worker_shuts_down_cleanly_on_sigterm(tmp_path: Path) -> None:
+    server_config = _Config()
+    server_config.WEBSERVER_PORT = 0
+    server_config.STORAGE_PATH = str(tmp_path / "test.db")
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            os.close(read_end)
+            with HttpSocket(server_config) as http_socket:
+                port = http_socket.getsockname()[1]
+                os.write(write_end, f"{port}\n".encode())
+                run_worker(server_config, http_socket)
+            exit_code = 0
+        finally:
+            os._exit(exit_code)
+
+    os.close(write_end)
+    with os.fdopen(read_end, "rb") as pipe:
+        port = int(pipe.readline())
+        # Once it has answered a request it is serving, and so handling signals
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as client:
+            client.sendall(b"GET /missing HTTP/1.0\r\n\r\n")
+            assert client.recv(1024).startswith(b"HTTP/1.1 ")
+
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
@@ -0,0 +1,822 @@
+import io
+import itertools
+import os
+import selectors
+import socket
+import sys
+import time
+from collections import deque
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    Tuple,
+    Any,
+    BinaryIO,
+    Iterator,
+    cast,
+)
+
+from .config import _Config
+from .webserver import (
+    HTTPRequest,
+    HTTPResponse,
+    HTTPError,
+    RequestReader,
+    Body,
+    PushStream,
+    body_length,
+    is_file_body,
+    encode_head,
+    encode_page,
+    get_header,
+)
+from .worker_pool import WorkerPool, QueueFull
+from . import log
+
+PageHandler = Callable[[HTTPRequest], HTTPResponse]
+# Called with the request, bytes sent and seconds taken once a response
+# has gone out
+SentHook = Callable[[HTTPRequest, int, float], None]
+
+FILE_READ_BYTES = 64 * 1024  # Chunk size when a file can't be sendfile'd
+# Buffers passed to one sendmsg. The kernel refuses more than IOV_MAX (1024)
+SENDMSG_MAX_BUFFERS = 64
+# How far a handler thread producing an iterator body gets ahead of the client
+PUMP_AHEAD_BYTES = 256 * 1024
+
+
+class OutgoingResponse:
+    """Tracks what is left to send of a response. In memory parts go out
+    together with a single scatter/gather sendmsg without being copied
+    together first, file bodies go straight from disk with sendfile.
+    Iterator bodies are only pulled from once everything before them has
+    been sent, so a large streamed page never sits in memory all at once.
+    PushStream bodies are sent from whenever they have been written to.
+    With handler threads, iterators are pulled on one of those and arrive
+    here as a PushStream (see Server._pump_on_pool)."""
+
+    buffers: Deque[memoryview]
+    body_file: Optional[BinaryIO]
+    file_offset: int
+    file_remaining: int
+    body_iter: Optional[Iterator[bytes]]
+    body_stream: Optional[PushStream]
+    waiting: bool  # Everything pushed so far is sent, waiting on more
+    chunked: bool
+    bytes_sent: int
+
+    def __init__(self, head: bytes, body: Body, chunked: bool = False):
+        self.buffers = deque([memoryview(head)])
+        self.bytes_sent = 0
+        self.body_file = None
+        self.file_offset = 0
+        self.file_remaining = 0
+        self.body_iter = None
+        self.body_stream = None
+        self.waiting = False
+        self.chunked = chunked
+
+        if isinstance(body, bytes):
+            if body:
+                self.buffers.append(memoryview(body))
+        elif isinstance(body, PushStream):
+            self.body_stream = body
+        elif is_file_body(body):
+            self.body_file = cast(BinaryIO, body)
+            self.file_offset = self.body_file.tell()
+            self.file_remaining = body_length(body) or 0
+        else:
+            self.body_iter = iter(body)
+
+    def write_to(self, client_socket: socket.socket) -> bool:
+        """Sends as much as the socket will take without blocking. Returns
+        True once the whole response has been sent"""
+        self.waiting = False
+        while True:
+            if self.buffers:
+                if not self._send_buffers(client_socket):
+                    # Socket buffer is full, wait until it is writable again
+                    return False
+            elif self.body_file is not None and self.file_remaining > 0:
+                self._send_file(client_socket, self.body_file)
+            elif self.body_iter is not None:
+                self._next_chunk(self.body_iter)
+            elif self.body_stream is not None:
+                if not self._take_pushed(self.body_stream):
+                    self.waiting = True
+                    return False
+            else:
+                self.close()
+                return True
+
+    def _send_buffers(self, client_socket: socket.socket) -> bool:
+        """Returns False if the socket didn't take everything offered"""
+        batch = list(itertools.islice(self.buffers, SENDMSG_MAX_BUFFERS))
+        sent = client_socket.sendmsg(batch)
+        self.bytes_sent += sent
+        took_all = sent == sum(len(buffer) for buffer in batch)
+        while sent > 0:
+            first = self.buffers[0]
+            if sent >= len(first):
+                sent -= len(first)
+                self.buffers.popleft()
+            else:
+                self.buffers[0] = first[sent:]
+                sent = 0
+        return took_all
+
+    def _send_file(self, client_socket: socket.socket, body_file: BinaryIO) -> None:
+        try:
+            sent = os.sendfile(
+                client_socket.fileno(),
+                body_file.fileno(),
+                self.file_offset,
+                self.file_remaining,
+            )
+            self.bytes_sent += sent
+        except io.UnsupportedOperation:
+            # Not backed by a real file descriptor, so read it into memory a
+            # piece at a time instead
+            chunk = body_file.read(min(FILE_READ_BYTES, self.file_remaining))
+            sent = len(chunk)
+            self.buffers.append(memoryview(chunk))
+
+        if sent == 0:
+            # File is shorter than it was when the headers were sent
+            raise OSError("response body truncated")
+        self.file_offset += sent
+        self.file_remaining -= sent
+
+    def _next_chunk(self, body_iter: Iterator[bytes]) -> None:
+        try:
+            chunk = next(body_iter)
+        except StopIteration:
+            self.body_iter = None
+            if self.chunked:
+                self.buffers.append(memoryview(b"0\r\n\r\n"))
+            return
+
+        self._add_chunk(chunk)
+
+    def _take_pushed(self, body_stream: PushStream) -> bool:
+        """Queues up whatever has been pushed. Returns False if there
+        wasn't anything"""
+        chunks, closed = body_stream.take()
+        for chunk in chunks:
+            self._add_chunk(chunk)
+        if closed and body_stream.failed:
+            raise OSError("response body failed")
+        if closed:
+            self.body_stream = None
+            if self.chunked:
+                self.buffers.append(memoryview(b"0\r\n\r\n"))
+        return bool(chunks) or closed
+
+    def wait_for_push(self, waiter: Callable[[], None]) -> bool:
+        """Has waiter called once there is more to send. Returns False if
+        there already is"""
+        assert self.body_stream is not None
+        return self.body_stream.wait(waiter)
+
+    def _add_chunk(self, chunk: bytes) -> None:
+        if not chunk:
+            # An empty chunk would mark the end of a chunked body
+            return
+        if self.chunked:
+            self.buffers.append(memoryview(f"{len(chunk):X}\r\n".encode("utf-8")))
+            self.buffers.append(memoryview(chunk))
+            self.buffers.append(memoryview(b"\r\n"))
+        else:
+            self.buffers.append(memoryview(chunk))
+
+    def close(self) -> None:
+        if self.body_file is not None:
+            self.body_file.close()
+            self.body_file = None
+        if self.body_iter is not None:
+            # Lets generators clean up (eg close db cursors) if the client
+            # went away half way through
+            close = getattr(self.body_iter, "close", None)
+            if close is not None:
+                close()
+            self.body_iter = None
+        if self.body_stream is not None:
+            self.body_stream.close()
+            self.body_stream = None
+
+
+class Connection:
+    """State for a single client socket while it is owned by the server"""
+
+    client_socket: socket.socket
+    addr: Tuple[str, int]
+    reader: RequestReader
+    response: Optional[OutgoingResponse]
+    last_activity: float
+    keep_alive: bool
+    requests_served: int
+    protocol: str
+    in_flight: bool
+    closed: bool
+    head_only: bool
+    request_started: Optional[float]  # When the client started sending headers
+    body_started: Optional[float]  # When the client started sending a body
+    request: Optional[HTTPRequest]  # The request being responded to
+    send_started: float
+
+    def __init__(
+        self,
+        server_config: _Config,
+        client_socket: socket.socket,
+        addr: Tuple[str, int],
+    ):
+        self.client_socket = client_socket
+        self.addr = addr
+        self.reader = RequestReader(server_config)
+        self.response = None
+        self.last_activity = time.monotonic()
+        # A new connection has to send a request within the header timeout
+        self.request_started = self.last_activity
+        self.body_started = None
+        self.request = None
+        self.send_started = 0.0
+        self.keep_alive = False
+        self.requests_served = 0
+        self.protocol = "HTTP/1.1"
+        self.in_flight = False
+        self.closed = False
+        self.head_only = False
+
+    def is_idle(self) -> bool:
+        """True when parked between requests on a persistent connection"""
+        return self.response is None and not self.in_flight and self.reader.is_idle()
+
+
+class ServerStats:
+    """Counts of connections and requests turned away, to show how often
+    the server is running into its limits"""
+
+    connections_accepted: int
+    connections_rejected: int  # Over WEBSERVER_MAX_CONNECTIONS
+    requests_shed: int  # Handler queue was full
+    header_timeouts: int
+    body_timeouts: int
+    client_timeouts: int  # Client went quiet part way through a request/response
+
+    def __init__(self) -> None:
+        self.connections_accepted = 0
+        self.connections_rejected = 0
+        self.requests_shed = 0
+        self.header_timeouts = 0
+        self.body_timeouts = 0
+        self.client_timeouts = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+class Server:
+    """An event driven http server. Multiplexes every client connection
+    over a single selector so that a slow client doesn't hold up the rest.
+    Route handlers keep the same HTTPRequest -> HTTPResponse contract as
+    before.
+
+    The selector thread only does socket IO. Page handlers (database
+    queries, templates, password hashing) run on a pool of worker threads
+    which hand their responses back with call_soon_threadsafe.
+
+    Work is bounded: past WEBSERVER_MAX_CONNECTIONS new clients, and past
+    WEBSERVER_HANDLER_QUEUE_DEPTH new requests, get a 503 straight away
+    rather than waiting in an ever growing queue. Clients that dribble
+    their request in slowly are cut off at the header/body deadlines."""
+
+    server_config: _Config
+    http_socket: socket.socket
+    page_handler: PageHandler
+    response_sent: Optional[SentHook]
+    selector: selectors.BaseSelector
+    connections: Dict[int, Connection]
+    running: bool
+    worker_pool: Optional[WorkerPool]
+    callbacks: Deque[Callable[[], None]]
+    wake_recv: socket.socket
+    wake_send: socket.socket
+    stats: ServerStats
+    max_pending_input: int  # Bytes buffered while a response is pending
+    overloaded_page: bytes  # Encoded once, so shedding load stays cheap
+    timeout_page: bytes
+
+    def __init__(
+        self,
+        server_config: _Config,
+        http_socket: socket.socket,
+        page_handler: PageHandler,
+        response_sent: Optional[SentHook] = None,
+    ):
+        self.server_config = server_config
+        self.http_socket = http_socket
+        self.page_handler = page_handler
+        self.response_sent = response_sent
+        self.connections = {}
+        self.running = False
+        self.stats = ServerStats()
+        self.max_pending_input = (
+            server_config.WEBSERVER_MAX_HEADER_BYTES
+            + server_config.WEBSERVER_MAX_BODY_BYTES
+        )
+
+        retry_after = str(server_config.WEBSERVER_RETRY_AFTER_S).encode("utf-8")
+        self.overloaded_page = encode_page(
+            add_framing_headers(
+                server_config,
+                HTTPResponse(503, headers=[(b"Retry-After", retry_after)]),
+                keep_alive=False,
+                chunked=False,
+            )
+        )
+        self.timeout_page = encode_page(
+            add_framing_headers(
+                server_config, HTTPResponse(408), keep_alive=False, chunked=False
+            )
+        )
+
+        self.http_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.http_socket, selectors.EVENT_READ, None)
+
+        # Other threads poke this socket pair to wake the selector up when
+        # they have queued a callback
+        self.callbacks = deque()
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ, None)
+
+        self.worker_pool = None
+        if server_config.WEBSERVER_HANDLER_THREADS > 0:
+            self.worker_pool = WorkerPool(
+                server_config.WEBSERVER_HANDLER_THREADS,
+                server_config.WEBSERVER_HANDLER_QUEUE_DEPTH,
+                "page-handler",
+            )
+
+    def serve_forever(self) -> None:
+        self.running = True
+        while self.running:
+            self.poll(self.server_config.WEBSERVER_POLL_INTERVAL_MS / 1000)
+
+    def stop(self) -> None:
+        self.running = False
+        self._wake()
+
+    def close(self) -> None:
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+        for connection in list(self.connections.values()):
+            self._close(connection)
+        self.selector.close()
+        self.wake_recv.close()
+        self.wake_send.close()
+
+    def call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        """Queues callback to run on the selector thread. Safe to call from
+        any thread"""
+        self.callbacks.append(callback)
+        self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self.wake_send.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # Already plenty of wake ups queued
+
+    def _run_callbacks(self) -> None:
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while self.callbacks:
+            callback = self.callbacks.popleft()
+            try:
+                callback()
+            except Exception as err:
+                log.error("server_failure", {"exception": str(err)})
+
+    def poll(self, timeout: Optional[float]) -> None:
+        """Waits up to timeout seconds for socket activity and services
+        everything that is ready"""
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.wake_recv:
+                self._run_callbacks()
+                continue
+            if key.data is None:
+                self._accept()
+                continue
+
+            connection: Connection = key.data
+            connection.last_activity = time.monotonic()
+            try:
+                if events & selectors.EVENT_READ:
+                    self._on_readable(connection)
+                elif events & selectors.EVENT_WRITE:
+                    self._on_writable(connection)
+            except Exception as err:
+                log.error("server_failure", {"exception": str(err)})
+                self._close(connection)
+
+        self._close_timed_out()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                client_socket, addr = self.http_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                log.warn("client_accept_err", {"exception": str(err)})
+                return
+
+            client_socket.setblocking(False)
+            if len(self.connections) >= self.server_config.WEBSERVER_MAX_CONNECTIONS:
+                self.stats.connections_rejected += 1
+                log.warn("client_rejected", {"addr": addr})
+                send_and_close(client_socket, self.overloaded_page)
+                continue
+
+            self.stats.connections_accepted += 1
+            log.info("client_connected", {"addr": addr})
+            connection = Connection(self.server_config, client_socket, addr)
+            self.connections[client_socket.fileno()] = connection
+            self.selector.register(client_socket, selectors.EVENT_READ, connection)
+
+    def _on_readable(self, connection: Connection) -> None:
+        try:
+            data = connection.client_socket.recv(
+                self.server_config.WEBSERVER_RECV_BYTES
+            )
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            log.warn("client_recv_err", {"exception": str(err)})
+            self._close(connection)
+            return
+
+        if not data:
+            # Client hung up before sending a full request
+            self._close(connection)
+            return
+
+        connection.reader.feed(data)
+        if connection.response is None and not connection.in_flight:
+            self._process_buffered(connection)
+        elif len(connection.reader.buffer) > self.max_pending_input:
+            # The buffer isn't read, and its limits not checked, until the
+            # response is done. Pipelining can't need more than one request
+            log.warn(
+                "client_sent_too_much",
+                {"addr": connection.addr, "buffered": len(connection.reader.buffer)},
+            )
+            self._close(connection)
+
+    def _process_buffered(self, connection: Connection) -> None:
+        """Services the next request waiting in the connection's buffer.
+        Pipelined requests are answered one after another, in order"""
+        try:
+            page_request = connection.reader.read_request()
+        except HTTPError as err:
+            log.warn(
+                "client_bad_request",
+                {
+                    "addr": connection.addr,
+                    "status_code": err.status_code,
+                    "reason": err.reason,
+                },
+            )
+            connection.keep_alive = False
+            connection.head_only = False
+            connection.request = None
+            self._send(connection, error_response(err.status_code))
+            return
+
+        if page_request is None:
+            # Start the clocks on the parts of the request still to come
+            now = time.monotonic()
+            if connection.request_started is None and not connection.reader.is_idle():
+                connection.request_started = now
+            if connection.body_started is None and connection.reader.reading_body():
+                connection.body_started = now
+            self.selector.modify(
+                connection.client_socket, selectors.EVENT_READ, connection
+            )
+            return
+
+        connection.request_started = None
+        connection.body_started = None
+        connection.requests_served += 1
+        connection.request = page_request
+        connection.protocol = page_request.protocol
+        connection.head_only = page_request.method == "HEAD"
+        connection.keep_alive = (
+            page_request.wants_keep_alive()
+            and connection.requests_served
+            < self.server_config.WEBSERVER_KEEP_ALIVE_MAX_REQUESTS
+        )
+
+        if self.worker_pool is None:
+            page_response = handle_request(
+                self.page_handler, page_request, connection.addr
+            )
+            self._send(connection, page_response)
+            return
+
+        def run_handler() -> None:
+            page_response = handle_request(
+                self.page_handler, page_request, connection.addr
+            )
+            self.call_soon_threadsafe(
+                lambda: self._on_handled(connection, page_response)
+            )
+
+        connection.in_flight = True
+        try:
+            self.worker_pool.submit(run_handler)
+        except QueueFull:
+            self.stats.requests_shed += 1
+            log.warn("handler_queue_full", {"addr": connection.addr})
+            connection.in_flight = False
+            connection.keep_alive = False
+            connection.request = None
+            connection.response = OutgoingResponse(self.overloaded_page, b"")
+            self._on_writable(connection)
+
+    def _on_handled(self, connection: Connection, page_response: HTTPResponse) -> None:
+        connection.in_flight = False
+        if connection.closed:
+            # Client went away while the handler was running
+            discard_body(page_response.data)
+            return
+        connection.last_activity = time.monotonic()
+        self._send(connection, page_response)
+
+    def _send(self, connection: Connection, page_response: HTTPResponse) -> None:
+        chunked = False
+        if (
+            body_length(page_response.data) is None
+            and get_header(page_response.headers, b"Content-Length") is None
+        ):
+            if connection.protocol == "HTTP/1.1":
+                chunked = True
+            else:
+                # HTTP/1.0 clients don't understand chunked encoding, so the
+                # only way to mark the end of the body is closing the socket
+                connection.keep_alive = False
+
+        page_response = add_framing_headers(
+            self.server_config, page_response, connection.keep_alive, chunked
+        )
+        body = page_response.data
+        if connection.head_only:
+            # Headers describe the body a GET would get, but it isn't sent
+            discard_body(body)
+            body = b""
+            chunked = False
+        if self.worker_pool is not None and _is_iterator_body(body):
+            body = self._pump_on_pool(cast(Iterator[bytes], body))
+        connection.response = OutgoingResponse(
+            encode_head(page_response), body, chunked
+        )
+        connection.send_started = time.perf_counter()
+        # Most responses fit in the socket buffer, so try to send straight
+        # away rather than waiting a round trip through the selector
+        self._on_writable(connection)
+
+    def _pump_on_pool(self, chunks: Iterator[bytes]) -> Body:
+        """Moves pulling an iterator body (database reads, templating,
+        compression) off the selector thread, onto a handler thread that
+        writes it to a PushStream. If the pool is full it is pulled here
+        after all"""
+        assert self.worker_pool is not None
+        # wait_for_room keeps it to PUMP_AHEAD_BYTES plus a chunk
+        stream = PushStream(max_buffered=sys.maxsize)
+        try:
+            self.worker_pool.submit(lambda: _pump(chunks, stream))
+        except QueueFull:
+            return chunks
+        return stream
+
+    def _on_writable(self, connection: Connection) -> None:
+        response = connection.response
+        assert response is not None
+        while True:
+            try:
+                finished = response.write_to(connection.client_socket)
+            except (BlockingIOError, InterruptedError):
+                finished = False
+            except OSError as err:
+                log.warn("client_send_err", {"exception": str(err)})
+                self._close(connection)
+                return
+
+            if finished:
+                break
+            if not response.waiting:
+                self.selector.modify(
+                    connection.client_socket, selectors.EVENT_WRITE, connection
+                )
+                return
+            if response.wait_for_push(
+                lambda: self.call_soon_threadsafe(lambda: self._on_pushed(connection))
+            ):
+                # Nothing to do until the stream is pushed to, just notice
+                # if the client hangs up in the meantime
+                self.selector.modify(
+                    connection.client_socket, selectors.EVENT_READ, connection
+                )
+                return
+            # Pushed to in the meantime, go round again
+
+        if self.response_sent is not None and connection.request is not None:
+            self.response_sent(
+                connection.request,
+                response.bytes_sent,
+                time.perf_counter() - connection.send_started,
+            )
+        connection.response = None
+        connection.request = None
+        if connection.keep_alive:
+            self._process_buffered(connection)
+        else:
+            self._close(connection)
+
+    def _on_pushed(self, connection: Connection) -> None:
+        if connection.closed or connection.response is None:
+            return
+        connection.last_activity = time.monotonic()
+        self._on_writable(connection)
+
+    def _close_timed_out(self) -> None:
+        """Drops clients that have gone quiet so they don't hold a socket
+        open forever. Connections parked between requests get the longer
+        keep-alive timeout. Clients that keep sending, but too slowly to
+        finish their request by the header/body deadline, are dropped too"""
+        server_config = self.server_config
+        now = time.monotonic()
+        client_deadline = now - server_config.WEBSERVER_CLIENT_TIMEOUT_MS / 1000
+        idle_deadline = now - server_config.WEBSERVER_KEEP_ALIVE_TIMEOUT_MS / 1000
+        header_deadline = now - server_config.WEBSERVER_HEADER_TIMEOUT_MS / 1000
+        body_deadline = now - server_config.WEBSERVER_BODY_TIMEOUT_MS / 1000
+        for connection in list(self.connections.values()):
+            if connection.in_flight or (
+                connection.response is not None and connection.response.waiting
+            ):
+                # Waiting on us, not the client
+                continue
+            if connection.response is None:
+                if (
+                    connection.body_started is not None
+                    and connection.body_started < body_deadline
+                ):
+                    self.stats.body_timeouts += 1
+                    self._time_out(connection, "body")
+                    continue
+                if (
+                    connection.body_started is None
+                    and connection.request_started is not None
+                    and connection.request_started < header_deadline
+                ):
+                    self.stats.header_timeouts += 1
+                    self._time_out(connection, "header")
+                    continue
+            if connection.is_idle():
+                if connection.last_activity < idle_deadline:
+                    self._close(connection)
+            elif connection.last_activity < client_deadline:
+                self.stats.client_timeouts += 1
+                log.warn("client_timed_out", {"addr": connection.addr})
+                self._close(connection)
+
+    def _time_out(self, connection: Connection, stage: str) -> None:
+        log.warn("client_too_slow", {"addr": connection.addr, "stage": stage})
+        try:
+            connection.client_socket.send(self.timeout_page)
+        except OSError:
+            pass
+        self._close(connection)
+
+    def _close(self, connection: Connection) -> None:
+        if connection.closed:
+            return
+        connection.closed = True
+        if connection.response is not None:
+            connection.response.close()
+            connection.response = None
+        self.connections.pop(connection.client_socket.fileno(), None)
+        try:
+            self.selector.unregister(connection.client_socket)
+        except (KeyError, ValueError):
+            pass
+        connection.client_socket.close()
+
+
+def send_and_close(client_socket: socket.socket, data: bytes) -> None:
+    """Sends a short response if the socket will take it without blocking,
+    then closes. For turning clients away without spending anything more on
+    them"""
+    try:
+        client_socket.send(data)
+    except OSError:
+        pass
+    client_socket.close()
+
+
+def discard_body(data: Body) -> None:
+    """Releases a body that is never going to be sent"""
+    OutgoingResponse(b"", data).close()
+
+
+def error_response(status_code: int) -> HTTPResponse:
+    """A bare response for requests that never made it to a page handler"""
+    return HTTPResponse(status_code=status_code)
+
+
+def add_framing_headers(
+    server_config: _Config, response: HTTPResponse, keep_alive: bool, chunked: bool
+) -> HTTPResponse:
+    """Adds the Content-Length/Transfer-Encoding and Connection headers the
+    client needs to find the end of the response on a persistent connection"""
+    headers = list(response.headers)
+    content_length = body_length(response.data)
+    if chunked:
+        headers.append((b"Transfer-Encoding", b"chunked"))
+    elif response.status_code in (204, 304):
+        pass  # Never have a body
+    elif content_length is not None and get_header(headers, b"Content-Length") is None:
+        headers.append((b"Content-Length", str(content_length).encode("utf-8")))
+    if keep_alive:
+        timeout_s = server_config.WEBSERVER_KEEP_ALIVE_TIMEOUT_MS // 1000
+        max_requests = server_config.WEBSERVER_KEEP_ALIVE_MAX_REQUESTS
+        headers.append((b"Connection", b"keep-alive"))
+        headers.append(
+            (b"Keep-Alive", f"timeout={timeout_s}, max={max_requests}".encode("utf-8"))
+        )
+    else:
+        headers.append((b"Connection", b"close"))
+    return HTTPResponse(response.status_code, response.data, headers)
+
+
+def handle_request(
+    page_handler: PageHandler, page_request: HTTPRequest, addr: Any
+) -> HTTPResponse:
+    """Runs the page handler, falling back to the 500 page if it raises"""
+    log.info("requesting_page", {"addr": addr, "url": page_request.url})
+    try:
+        page_response = page_handler(page_request)
+    except Exception as err:
+        page_response = page_handler(
+            HTTPRequest(
+                method="GET",
+                url="/500.html",
+                content=b"",
+                headers=[],
+                query_params=[],
+            )
+        )
+        log.error(
+            "endpoint_failure",
+            {"exception": str(err), "url": page_request.url},
+        )
+
+    log.info(
+        "endpoint_response",
+        {
+            "addr": addr,
+            "url": page_request.url,
+            "status_code": page_response.status_code,
+        },
+    )
+    return page_response
+
+
+def _is_iterator_body(body: Body) -> bool:
+    return not isinstance(body, (bytes, PushStream)) and not is_file_body(body)
+
+
+def _pump(chunks: Iterator[bytes], stream: PushStream) -> None:
+    """Writes chunks to stream no faster than the client takes them"""
+    try:
+        for chunk in chunks:
+            if not stream.wait_for_room(PUMP_AHEAD_BYTES):
+                return  # Client went away
+            stream.write(chunk)
+    except Exception as err:
+        log.error("response_body_failure", {"exception": str(err)})
+        stream.abort()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+    stream.close()
@@ -0,0 +1,321 @@
+import io
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+import pytest
+
+from .config import _Config
+from .webserver import HttpSocket, HTTPRequest, HTTPResponse, PushStream
+from .server import Server, PageHandler
+
+LARGE_BODY = bytes(range(256)) * 4096
+
+
+def failing_stream() -> Iterator[bytes]:
+    yield b"part of a page"
+    raise ValueError("database went away")
+
+
+def echo_handler(request: HTTPRequest) -> HTTPResponse:
+    if request.url == "/file":
+        body_file = tempfile.TemporaryFile()
+        body_file.write(LARGE_BODY)
+        body_file.seek(0)
+        return HTTPResponse(status_code=200, data=body_file)
+    if request.url == "/producer":
+        # Which thread pulls the body
+        return HTTPResponse(
+            status_code=200,
+            data=(threading.current_thread().name.encode("utf-8") for _ in [0]),
+        )
+    if request.url == "/failing-stream":
+        return HTTPResponse(status_code=200, data=failing_stream())
+    if request.url == "/stream":
+        return HTTPResponse(status_code=200, data=iter([b"hello ", b"", b"world"]))
+    if request.url == "/buffer":
+        return HTTPResponse(status_code=200, data=io.BytesIO(LARGE_BODY))
+    return HTTPResponse(status_code=200, data=request.url.encode("utf-8"))
+
+
+PUSHED: List[PushStream] = []
+
+
+def push_handler(request: HTTPRequest) -> HTTPResponse:
+    if request.url == "/push-many":
+        # More chunks than one sendmsg can take
+        stream = PushStream()
+        for i in range(600):
+            stream.write(b"%d " % i)
+        stream.close()
+        return HTTPResponse(status_code=200, data=stream)
+    if request.url != "/push":
+        return echo_handler(request)
+    stream = PushStream()
+    stream.write(b"first ")
+    PUSHED.append(stream)
+    return HTTPResponse(status_code=200, data=stream)
+
+
+def make_config() -> _Config:
+    server_config = _Config()
+    server_config.WEBSERVER_PORT = 0
+    server_config.WEBSERVER_POLL_INTERVAL_MS = 10
+    return server_config
+
+
+@contextmanager
+def running_server(
+    server_config: _Config, handler: PageHandler = echo_handler
+) -> Iterator[Tuple[Server, Tuple[str, int]]]:
+    with HttpSocket(server_config) as http_socket:
+        server = Server(server_config, http_socket, handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            yield server, ("127.0.0.1", http_socket.getsockname()[1])
+        finally:
+            server.stop()
+            thread.join()
+            server.close()
+
+
+@pytest.fixture
+def server_addr() -> Iterator[Tuple[str, int]]:
+    with running_server(make_config()) as (_server, addr):
+        yield addr
+
+
+def read_until_closed(client: socket.socket) -> bytes:
+    data = b""
+    while True:
+        chunk = client.recv(1024)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_serves_interleaved_clients(server_addr: Tuple[str, int]) -> None:
+    client_1 = socket.create_connection(server_addr)
+    client_2 = socket.create_connection(server_addr)
+
+    # Client 1 only sends half a request, which must not block client 2
+    client_1.sendall(b"GET /one HTTP/1.1\r\n")
+    client_2.sendall(b"GET /two HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert read_until_closed(client_2).endswith(b"\r\n\r\n/two")
+
+    client_1.sendall(b"Connection: close\r\n\r\n")
+    assert read_until_closed(client_1).endswith(b"\r\n\r\n/one")
+
+    client_1.close()
+    client_2.close()
+
+
+def test_keep_alive_serves_pipelined_requests(server_addr: Tuple[str, int]) -> None:
+    client = socket.create_connection(server_addr)
+    client.sendall(
+        b"GET /first HTTP/1.1\r\n\r\n"
+        b"POST /second HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"
+        b"GET /third HTTP/1.1\r\nConnection: close\r\n\r\n"
+    )
+    responses = read_until_closed(client).split(b"HTTP/1.1 200 OK\r\n")[1:]
+    client.close()
+
+    assert len(responses) == 3
+    assert b"Connection: keep-alive\r\n" in responses[0]
+    assert b"Content-Length: 6\r\n" in responses[0]
+    assert responses[0].endswith(b"\r\n\r\n/first")
+    assert responses[1].endswith(b"\r\n\r\n/second")
+    assert b"Connection: close\r\n" in responses[2]
+    assert responses[2].endswith(b"\r\n\r\n/third")
+
+
+@pytest.mark.parametrize("url", [b"/file", b"/buffer"])
+def test_sends_file_bodies(server_addr: Tuple[str, int], url: bytes) -> None:
+    client = socket.create_connection(server_addr)
+    client.sendall(b"GET " + url + b" HTTP/1.1\r\nConnection: close\r\n\r\n")
+    head, body = read_until_closed(client).split(b"\r\n\r\n", maxsplit=1)
+    client.close()
+
+    assert f"Content-Length: {len(LARGE_BODY)}".encode("utf-8") in head
+    assert body == LARGE_BODY
+
+
+def test_streams_iterator_bodies_chunked(server_addr: Tuple[str, int]) -> None:
+    client = socket.create_connection(server_addr)
+    client.sendall(b"GET /stream HTTP/1.1\r\nConnection: close\r\n\r\n")
+    head, body = read_until_closed(client).split(b"\r\n\r\n", maxsplit=1)
+    client.close()
+
+    assert b"Transfer-Encoding: chunked" in head
+    assert b"Content-Length" not in head
+    assert body == b"6\r\nhello \r\n5\r\nworld\r\n0\r\n\r\n"
+
+    # HTTP/1.0 can't do chunked, so the end of the body is the socket closing
+    client = socket.create_connection(server_addr)
+    client.sendall(b"GET /stream HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+    head, body = read_until_closed(client).split(b"\r\n\r\n", maxsplit=1)
+    client.close()
+
+    assert b"Connection: close" in head
+    assert body == b"hello world"
+
+
+def test_sends_pushed_chunks_as_they_are_written() -> None:
+    with running_server(make_config(), push_handler) as (server, addr):
+        client = socket.create_connection(addr)
+        client.sendall(b"GET /push HTTP/1.1\r\nConnection: close\r\n\r\n")
+        received = b""
+        while not received.endswith(b"first \r\n"):
+            received += client.recv(1024)
+
+        stream = PUSHED.pop()
+        # Nothing is left to send, the connection waits on the stream
+        time.sleep(0.05)
+        assert server.connections and not stream.chunks
+        stream.write(b"second")
+        stream.close()
+        received += read_until_closed(client)
+        client.close()
+
+    head, body = received.split(b"\r\n\r\n", maxsplit=1)
+    assert b"Transfer-Encoding: chunked" in head
+    assert body == b"6\r\nfirst \r\n6\r\nsecond\r\n0\r\n\r\n"
+
+
+def test_sends_many_pushed_chunks() -> None:
+    with running_server(make_config(), push_handler) as (_server, addr):
+        client = socket.create_connection(addr)
+        client.sendall(b"GET /push-many HTTP/1.1\r\nConnection: close\r\n\r\n")
+        head, body = read_until_closed(client).split(b"\r\n\r\n", maxsplit=1)
+        client.close()
+
+    assert head.startswith(b"HTTP/1.1 200")
+    chunks = [b"%d " % i for i in range(600)]
+    assert body == b"".join(b"%X\r\n%s\r\n" % (len(c), c) for c in chunks) + (
+        b"0\r\n\r\n"
+    )
+
+
+def test_closes_clients_sending_too_much_while_waiting() -> None:
+    server_config = make_config()
+    server_config.WEBSERVER_MAX_BODY_BYTES = 1000
+    with running_server(server_config, push_handler) as (server, addr):
+        client = socket.create_connection(addr)
+        client.sendall(b"GET /push HTTP/1.1\r\n\r\n")
+        while not client.recv(1024).endswith(b"first \r\n"):
+            pass
+        PUSHED.pop()
+        try:
+            for _ in range(100):
+                client.sendall(b"x" * 1000)
+                time.sleep(0.001)
+        except OSError:
+            pass  # Reset by the server
+        deadline = time.monotonic() + 1
+        while server.connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not server.connections
+        client.close()
+
+
+def test_iterator_bodies_are_pulled_on_handler_threads(
+    server_addr: Tuple[str, int],
+) -> None:
+    client = socket.create_connection(server_addr)
+    client.sendall(b"GET /producer HTTP/1.0\r\n\r\n")
+    _head, body = read_until_closed(client).split(b"\r\n\r\n", maxsplit=1)
+    client.close()
+    assert body.startswith(b"page-handler-")
+
+    # A body that fails part way mustn't look complete
+    client = socket.create_connection(server_addr)
+    client.sendall(b"GET /failing-stream HTTP/1.1\r\n\r\n")
+    head, body = read_until_closed(client).split(b"\r\n\r\n", maxsplit=1)
+    client.close()
+    assert head.startswith(b"HTTP/1.1 200")
+    assert not body.endswith(b"0\r\n\r\n")
+
+
+def test_head_sends_headers_only(server_addr: Tuple[str, int]) -> None:
+    client = socket.create_connection(server_addr)
+    client.sendall(
+        b"HEAD /file HTTP/1.1\r\n\r\n" b"GET /abc HTTP/1.1\r\nConnection: close\r\n\r\n"
+    )
+    data = read_until_closed(client)
+    client.close()
+
+    head, second = data.split(b"\r\n\r\n", maxsplit=1)
+    assert f"Content-Length: {len(LARGE_BODY)}".encode("utf-8") in head
+    assert second.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert second.endswith(b"\r\n\r\n/abc")
+
+
+def test_rejects_connections_over_limit() -> None:
+    server_config = make_config()
+    server_config.WEBSERVER_MAX_CONNECTIONS = 1
+    with running_server(server_config) as (server, addr):
+        client_1 = socket.create_connection(addr)
+        client_1.sendall(b"GET /one HTTP/1.1\r\n")
+        client_2 = socket.create_connection(addr)
+        response = read_until_closed(client_2)
+        assert response.startswith(b"HTTP/1.1 503 Service Unavailable\r\n")
+        assert b"Retry-After: 2\r\n" in response
+
+        # The first client is still served
+        client_1.sendall(b"Connection: close\r\n\r\n")
+        assert read_until_closed(client_1).endswith(b"\r\n\r\n/one")
+        client_1.close()
+        client_2.close()
+
+        assert server.stats.connections_rejected == 1
+
+
+def test_sheds_requests_when_handler_queue_full() -> None:
+    server_config = make_config()
+    server_config.WEBSERVER_HANDLER_THREADS = 1
+    server_config.WEBSERVER_HANDLER_QUEUE_DEPTH = 1
+    release = threading.Event()
+
+    def blocking_handler(request: HTTPRequest) -> HTTPResponse:
+        release.wait(5)
+        return echo_handler(request)
+
+    with running_server(server_config, blocking_handler) as (server, addr):
+        clients = [socket.create_connection(addr) for _ in range(3)]
+        # One request runs, one queues, the third has nowhere to go
+        for client in clients:
+            client.sendall(b"GET /x HTTP/1.1\r\nConnection: close\r\n\r\n")
+            time.sleep(0.05)
+        assert read_until_closed(clients[2]).startswith(b"HTTP/1.1 503 ")
+
+        release.set()
+        for client in clients[:2]:
+            assert read_until_closed(client).endswith(b"\r\n\r\n/x")
+        for client in clients:
+            client.close()
+
+        assert server.stats.requests_shed == 1
+
+
+def test_drops_clients_that_send_headers_too_slowly() -> None:
+    server_config = make_config()
+    server_config.WEBSERVER_HEADER_TIMEOUT_MS = 100
+    with running_server(server_config) as (server, addr):
+        client = socket.create_connection(addr)
+        client.sendall(b"GET / HTTP/1.1\r\n")
+        # Trickling bytes in keeps the connection active, but doesn't
+        # extend the deadline
+        for _ in range(4):
+            time.sleep(0.05)
+            try:
+                client.sendall(b"X")
+            except OSError:
+                break
+        assert read_until_closed(client).startswith(b"HTTP/1.1 408 ")
+        client.close()
+
+        assert server.stats.header_timeouts == 1
@@ -1,40 +1,317 @@
 import datetime
 import base64
+import hashlib
+import hmac
 import os
+import threading
+import time
+from collections import OrderedDict
 
-from typing import Tuple, Optional
-from .storage import Storage, SessionData
+from typing import Dict, Tuple, Optional
+from . import log
+from .config import _Config
+from .storage import ItemId, Storage, SessionData
 from .webserver import HTTPRequest
 
+SESSION_COOKIE = "nds_core_auth"
+SESSION_LIFETIME = datetime.timedelta(days=1)
+TOKEN_PREFIX = "v1."  # Session keys are standard base64, which has no dots
 
-def create_session_header(storage: Storage, user_id: int) -> Tuple[bytes, bytes]:
-    session_key = base64.b64encode(os.urandom(32)).decode("utf-8")
-    storage.create_session_for_user(
-        user_id=user_id,
-        session_key=session_key,
-        creation_date=datetime.datetime.now(),
-        expiry_date=datetime.datetime.now() + datetime.timedelta(days=1),
-    )
-    header = (
+
+def clear_session_header() -> Tuple[bytes, bytes]:
+    """Makes the browser forget its session, so that it stops sending the
+    key to workers that may still have it cached"""
+    return (
         b"Set-Cookie",
-        f"nds_core_auth={session_key}; SameSite=strict; Path=/;".encode("utf-8"),
+        f"{SESSION_COOKIE}=; SameSite=strict; Path=/; Max-Age=0;".encode("utf-8"),
     )
-    return header
-
-
-def get_session_data(
-    storage: Storage, page_request: HTTPRequest
-) -> Optional[SessionData]:
-    cookie_headers = [h[1] for h in page_request.headers if h[0] == b"Cookie"]
-    for cookie_str in cookie_headers:
-        cookies = cookie_str.split(b";")
-        for cookie in cookies:
-            key, val = cookie.split(b"=", maxsplit=1)
-            if key.strip() == b"nds_core_auth":
-                session = storage.get_session_by_key(val.decode("utf-8").strip())
-                if session is None or datetime.datetime.now() > session.expiry_date:
-                    storage.clear_sessions_by_date(datetime.datetime.now())
+
+
+class SessionCache:
+    """Sessions by key, so that signed in users' requests don't have to go
+    to the database. Keys with no session behind them are remembered too,
+    for SESSION_CACHE_NEGATIVE_TTL_S. Sessions deleted through this
+    process's Storage are dropped straight away. Ones deleted by other
+    worker processes are picked up from the deleted_session table every
+    SESSION_CACHE_SYNC_S, so can still be used for that long. Nothing is
+    kept for longer than SESSION_CACHE_TTL_S, or past its session's expiry
+    date."""
+
+    max_sessions: int
+    ttl_s: float
+    negative_ttl_s: float
+    sync_interval_s: float
+    # session_key -> (time.monotonic() to look it up again, session or None)
+    sessions: "OrderedDict[str, Tuple[float, Optional[SessionData]]]"
+    last_deletion_id: int  # Of the newest deletion read from storage
+    next_sync: float  # time.monotonic()
+    lock: threading.Lock
+
+    def __init__(self, server_config: _Config):
+        self.max_sessions = server_config.SESSION_CACHE_SIZE
+        self.ttl_s = server_config.SESSION_CACHE_TTL_S
+        self.negative_ttl_s = server_config.SESSION_CACHE_NEGATIVE_TTL_S
+        self.sync_interval_s = server_config.SESSION_CACHE_SYNC_S
+        self.sessions = OrderedDict()
+        self.last_deletion_id = 0
+        self.next_sync = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, storage: Storage, session_key: str) -> Optional[SessionData]:
+        now = time.monotonic()
+        if now >= self.next_sync and self.max_sessions > 0:
+            self._sync(storage)
+        with self.lock:
+            cached = self.sessions.get(session_key)
+            if cached is not None and cached[0] > now:
+                self.sessions.move_to_end(session_key)
+                return cached[1]
+
+        session = storage.get_session_by_key(session_key)
+        if session is None:
+            ttl_s = self.negative_ttl_s
+        else:
+            time_left = session.expiry_date - datetime.datetime.now()
+            ttl_s = min(self.ttl_s, time_left.total_seconds())
+        if ttl_s <= 0 or self.max_sessions <= 0:
+            return session
+
+        with self.lock:
+            self.sessions[session_key] = (now + ttl_s, session)
+            self.sessions.move_to_end(session_key)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session
+
+    def data_changed(self, kind: str, item_id: ItemId) -> None:
+        """Storage write listener"""
+        if kind != "session" or not isinstance(item_id, str):
+            return
+        with self.lock:
+            self.sessions.pop(item_id, None)
+
+    def _sync(self, storage: Storage) -> None:
+        with self.lock:
+            if time.monotonic() < self.next_sync:
+                return  # Another thread got here first
+            self.next_sync = time.monotonic() + self.sync_interval_s
+            for deletion_id, session_key in storage.query_deleted_sessions(
+                self.last_deletion_id
+            ):
+                self.sessions.pop(session_key, None)
+                self.last_deletion_id = deletion_id
+
+
+class SessionTokens:
+    """Session tokens that carry their user and expiry date, signed with
+    HMAC-SHA256 so that they can be checked without the database:
+    v1.<user_id>.<created>.<expires>.<token_id>.<signature>
+
+    Signing out revokes the token. Revocations are kept in memory, picked
+    up from other worker processes through the revoked_session table every
+    SESSION_REVOCATION_SYNC_S, and forgotten once the token has expired."""
+
+    storage: Storage
+    key: bytes
+    sync_interval_s: float
+    revoked: Dict[str, datetime.datetime]  # token_id -> token expiry date
+    last_revocation_id: int  # Of the newest revocation read from storage
+    next_sync: float  # time.monotonic()
+    lock: threading.Lock
+
+    def __init__(self, server_config: _Config, storage: Storage, key: bytes):
+        self.storage = storage
+        self.key = key
+        self.sync_interval_s = server_config.SESSION_REVOCATION_SYNC_S
+        self.revoked = {}
+        self.last_revocation_id = 0
+        self.next_sync = 0.0
+        self.lock = threading.Lock()
+
+    def create(self, user_id: int) -> str:
+        created = int(time.time())
+        expires = created + int(SESSION_LIFETIME.total_seconds())
+        token_id = base64.urlsafe_b64encode(os.urandom(12)).decode("utf-8")
+        payload = f"{TOKEN_PREFIX}{user_id}.{created}.{expires}.{token_id}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str) -> Optional[SessionData]:
+        """The session in token, or None if it isn't one of ours or has
+        expired or been revoked"""
+        payload, _, signature = token.rpartition(".")
+        expected = self._sign(payload).encode("utf-8")
+        if not hmac.compare_digest(signature.encode("utf-8"), expected):
+            return None
+        # Signed by us, so it is well formed
+        _, user_id, created, expires, token_id = payload.split(".")
+        expiry_date = datetime.datetime.fromtimestamp(int(expires))
+        if datetime.datetime.now() > expiry_date or self.is_revoked(token_id):
+            return None
+        return SessionData(
+            user_id=int(user_id),
+            session_key=token,
+            creation_date=datetime.datetime.fromtimestamp(int(created)),
+            expiry_date=expiry_date,
+        )
+
+    def revoke(self, session: SessionData) -> None:
+        token_id = _token_id(session.session_key)
+        with self.lock:
+            self.revoked[token_id] = session.expiry_date
+        self.storage.revoke_session_token(token_id, session.expiry_date)
+
+    def is_revoked(self, token_id: str) -> bool:
+        if time.monotonic() >= self.next_sync:
+            self._sync()
+        return token_id in self.revoked
+
+    def _sign(self, payload: str) -> str:
+        digest = hmac.new(self.key, payload.encode("utf-8"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode("utf-8").rstrip("=")
+
+    def _sync(self) -> None:
+        now = datetime.datetime.now()
+        with self.lock:
+            if time.monotonic() < self.next_sync:
+                return  # Another thread got here first
+            self.next_sync = time.monotonic() + self.sync_interval_s
+            for (
+                revocation_id,
+                token_id,
+                expiry_date,
+            ) in self.storage.query_revoked_session_tokens(self.last_revocation_id):
+                self.revoked[token_id] = expiry_date
+                self.last_revocation_id = revocation_id
+            expired = [t for t, expiry in self.revoked.items() if now > expiry]
+            for token_id in expired:
+                del self.revoked[token_id]
+        if expired:
+            self.storage.clear_revoked_session_tokens(now)
+
+
+class Sessions:
+    """Signs users in and out, and finds which user a request is from.
+    SESSION_TOKENS picks what new sessions are: "KEY" for random keys
+    looked up in the session table (through a SessionCache), or "SIGNED"
+    for SessionTokens. Both are accepted whichever is picked, so switching
+    doesn't sign anyone out."""
+
+    storage: Storage
+    signed: bool  # Whether new sessions get tokens rather than keys
+    cache: SessionCache
+    tokens: SessionTokens
+
+    def __init__(self, server_config: _Config, storage: Storage):
+        if server_config.SESSION_TOKENS not in ("KEY", "SIGNED"):
+            raise ValueError(f"Unknown SESSION_TOKENS {server_config.SESSION_TOKENS}")
+        self.storage = storage
+        self.signed = server_config.SESSION_TOKENS == "SIGNED"
+        self.cache = SessionCache(server_config)
+        storage.add_write_listener(self.cache.data_changed)
+        signing_key = server_config.SESSION_SIGNING_KEY
+        self.tokens = SessionTokens(
+            server_config,
+            storage,
+            (
+                storage.get_session_signing_key()
+                if signing_key is None
+                else signing_key.encode("utf-8")
+            ),
+        )
+
+    def create_header(self, user_id: int) -> Tuple[bytes, bytes]:
+        """Starts a session for the user, the header sets its cookie"""
+        if self.signed:
+            session_key = self.tokens.create(user_id)
+        else:
+            session_key = base64.b64encode(os.urandom(32)).decode("utf-8")
+            self.storage.create_session_for_user(
+                user_id=user_id,
+                session_key=session_key,
+                creation_date=datetime.datetime.now(),
+                expiry_date=datetime.datetime.now() + SESSION_LIFETIME,
+            )
+        header = (
+            b"Set-Cookie",
+            f"{SESSION_COOKIE}={session_key}; SameSite=strict; Path=/;".encode("utf-8"),
+        )
+        return header
+
+    def get(self, page_request: HTTPRequest) -> Optional[SessionData]:
+        for key, val in page_request.cookies:
+            if key != SESSION_COOKIE:
+                continue
+            if val.startswith(TOKEN_PREFIX):
+                session = self.tokens.verify(val)
+                if session is None:
                     continue
-                else:
-                    return session
-    return None
+                return session
+
+            session = self.cache.get(self.storage, val)
+            if session is None:
+                continue
+            if datetime.datetime.now() > session.expiry_date:
+                continue  # SessionSweeper will delete it
+            return session
+        return None
+
+    def end(self, session: SessionData) -> None:
+        if session.session_key.startswith(TOKEN_PREFIX):
+            self.tokens.revoke(session)
+        else:
+            self.storage.delete_session_by_key(session.session_key)
+
+
+class SessionSweeper:
+    """Deletes expired sessions, and the records of deleted ones, from a
+    background thread every SESSION_SWEEP_INTERVAL_S. They are deleted SESSION_SWEEP_BATCH at a
+    time, so that requests wanting to write don't wait on one big delete"""
+
+    storage: Storage
+    interval_s: float
+    batch_size: int
+    thread: Optional[threading.Thread]
+    stopping: threading.Event
+
+    def __init__(self, server_config: _Config, storage: Storage):
+        self.storage = storage
+        self.interval_s = server_config.SESSION_SWEEP_INTERVAL_S
+        self.batch_size = server_config.SESSION_SWEEP_BATCH
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self) -> None:
+        self.thread = threading.Thread(
+            target=self._run, name="session-sweeper", daemon=True
+        )
+        self.thread.start()
+
+    def close(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def sweep(self) -> int:
+        """Returns how many sessions were deleted"""
+        now = datetime.datetime.now()
+        swept = 0
+        while not self.stopping.is_set():
+            deleted = self.storage.clear_sessions_by_date(now, self.batch_size)
+            swept += deleted
+            if deleted < self.batch_size:
+                break
+        self.storage.clear_deleted_sessions(now)
+        if swept:
+            log.info("sessions_swept", {"count": swept})
+        return swept
+
+    def _run(self) -> None:
+        while not self.stopping.wait(self.interval_s):
+            try:
+                self.sweep()
+            except Exception as err:
+                log.error("session_sweep_failure", {"exception": str(err)})
+
+
+def _token_id(token: str) -> str:
+    return token.split(".")[4]
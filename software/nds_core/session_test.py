@@ -0,0 +1,193 @@
+import datetime
+from typing import Iterator, List, Optional
+
+import pytest
+
+from .config import _Config
+from .session import SessionCache, SessionTokens, Sessions, SessionSweeper
+from .webserver import HTTPRequest
+from .storage import Storage, SessionData, ColorData
+
+
+@pytest.fixture
+def storage() -> Iterator[Storage]:
+    storage = Storage(":memory:")
+    storage.create_user("testUser", b"testSecret", ColorData(0, 0, 0))
+    yield storage
+    storage.close()
+
+
+def count_lookups(storage: Storage, monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    lookups: List[str] = []
+    get_session_by_key = storage.get_session_by_key
+
+    def counted(session_key: str) -> Optional[SessionData]:
+        lookups.append(session_key)
+        return get_session_by_key(session_key)
+
+    monkeypatch.setattr(storage, "get_session_by_key", counted)
+    return lookups
+
+
+def add_session(storage: Storage, key: str, lifetime: datetime.timedelta) -> None:
+    now = datetime.datetime.now()
+    storage.create_session_for_user(1, key, now, now + lifetime)
+
+
+def test_known_sessions_skip_the_database(
+    storage: Storage, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = SessionCache(_Config())
+    storage.add_write_listener(cache.data_changed)
+    lookups = count_lookups(storage, monkeypatch)
+    add_session(storage, "key", datetime.timedelta(days=1))
+
+    for _ in range(3):
+        session = cache.get(storage, "key")
+        assert session is not None and session.user_id == 1
+        # Remembered that there is no such session
+        assert cache.get(storage, "missing") is None
+    assert lookups == ["key", "missing"]
+
+    storage.delete_session_by_key("key")
+    assert cache.get(storage, "key") is None
+    assert lookups == ["key", "missing", "key"]
+
+
+def test_deleting_a_session_keeps_the_users_others(
+    storage: Storage, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = SessionCache(_Config())
+    storage.add_write_listener(cache.data_changed)
+    add_session(storage, "laptop", datetime.timedelta(days=1))
+    add_session(storage, "phone", datetime.timedelta(days=1))
+    cache.get(storage, "laptop")
+    cache.get(storage, "phone")
+    lookups = count_lookups(storage, monkeypatch)
+
+    storage.delete_session_by_key("laptop")
+    assert cache.get(storage, "phone") is not None
+    assert lookups == []
+
+
+def test_deletions_reach_other_workers(storage: Storage) -> None:
+    server_config = _Config()
+    server_config.SESSION_CACHE_SYNC_S = 0
+    other_worker = SessionCache(server_config)
+    add_session(storage, "key", datetime.timedelta(days=1))
+    add_session(storage, "kept", datetime.timedelta(days=1))
+    assert other_worker.get(storage, "key") is not None
+    assert other_worker.get(storage, "kept") is not None
+
+    storage.delete_session_by_key("key")
+    assert other_worker.get(storage, "key") is None
+    assert list(other_worker.sessions) == ["kept", "key"]
+    assert other_worker.sessions["key"][1] is None
+
+
+def test_sessions_are_not_cached_past_expiry(
+    storage: Storage, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = SessionCache(_Config())
+    lookups = count_lookups(storage, monkeypatch)
+    add_session(storage, "expired", datetime.timedelta(days=-1))
+
+    cache.get(storage, "expired")
+    cache.get(storage, "expired")
+    assert lookups == ["expired", "expired"]
+
+
+def test_least_recently_used_go_first(storage: Storage) -> None:
+    server_config = _Config()
+    server_config.SESSION_CACHE_SIZE = 2
+    cache = SessionCache(server_config)
+    for key in ["a", "b", "c"]:
+        add_session(storage, key, datetime.timedelta(days=1))
+    cache.get(storage, "a")
+    cache.get(storage, "b")
+    cache.get(storage, "a")
+    cache.get(storage, "c")
+    assert list(cache.sessions) == ["a", "c"]
+
+
+def test_tokens_are_checked_without_the_database(
+    storage: Storage, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    tokens = SessionTokens(_Config(), storage, b"key")
+    token = tokens.create(1)
+    tokens.is_revoked("")  # Read the revocations, which are still empty
+    monkeypatch.setattr(
+        Storage, "connection", property(lambda _: pytest.fail("used the database"))
+    )
+
+    session = tokens.verify(token)
+    assert session is not None and session.user_id == 1
+    assert session.expiry_date > datetime.datetime.now()
+    assert tokens.verify(token.replace("v1.1.", "v1.2.")) is None
+    assert tokens.verify(token[:-1]) is None
+    assert SessionTokens(_Config(), storage, b"other").verify(token) is None
+
+
+def test_revocations_reach_other_workers(storage: Storage) -> None:
+    server_config = _Config()
+    server_config.SESSION_REVOCATION_SYNC_S = 0
+    tokens = SessionTokens(server_config, storage, b"key")
+    other_worker = SessionTokens(server_config, storage, b"key")
+    token = tokens.create(1)
+    session = other_worker.verify(token)
+    assert session is not None
+
+    tokens.revoke(session)
+    assert tokens.verify(token) is None
+    assert other_worker.verify(token) is None
+
+
+def test_expired_revocations_are_forgotten(storage: Storage) -> None:
+    tokens = SessionTokens(_Config(), storage, b"key")
+    long_ago = datetime.datetime.now() - datetime.timedelta(days=2)
+    storage.revoke_session_token("expired", long_ago)
+    assert not tokens.is_revoked("expired")
+    assert tokens.revoked == {}
+    assert storage.query_revoked_session_tokens(0) == []
+
+
+def test_either_kind_of_session_is_accepted(storage: Storage) -> None:
+    server_config = _Config()
+    server_config.SESSION_REVOCATION_SYNC_S = 0
+    sessions = Sessions(server_config, storage)
+    server_config.SESSION_TOKENS = "SIGNED"
+    signed_sessions = Sessions(server_config, storage)
+
+    for created_by in [sessions, signed_sessions]:
+        _, cookie = created_by.create_header(1)
+        request = HTTPRequest("GET", "/", b"", [(b"Cookie", cookie.split(b";")[0])])
+        for checked_by in [sessions, signed_sessions]:
+            checked = checked_by.get(request)
+            assert checked is not None and checked.user_id == 1
+
+        session = created_by.get(request)
+        assert session is not None
+        created_by.end(session)
+        assert sessions.get(request) is None
+        assert signed_sessions.get(request) is None
+    assert sessions.tokens.key == storage.get_session_signing_key()
+
+
+def test_expired_sessions_are_left_to_the_sweeper(storage: Storage) -> None:
+    server_config = _Config()
+    server_config.SESSION_SWEEP_BATCH = 2
+    sessions = Sessions(server_config, storage)
+    for key in ["a", "b", "c"]:
+        add_session(storage, key, datetime.timedelta(days=-1))
+    add_session(storage, "current", datetime.timedelta(days=1))
+
+    request = HTTPRequest("GET", "/", b"", [(b"Cookie", b"nds_core_auth=a")])
+    assert sessions.get(request) is None
+    assert storage.get_session_by_key("a") is not None
+
+    add_session(storage, "ended", datetime.timedelta(seconds=-1))
+    storage.delete_session_by_key("ended")
+    assert SessionSweeper(server_config, storage).sweep() == 3
+    assert storage.query_deleted_sessions(0) == []
+    assert storage.get_session_by_key("a") is None
+    assert storage.get_session_by_key("current") is not None
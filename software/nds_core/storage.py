@@ -1,11 +1,24 @@
 import sqlite3
 import json
-from typing import List, Optional
+import os
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 from datetime import datetime
 from dataclasses import dataclass
 
 
 from . import log
+from .metrics import timed_methods
+
+_memory_db_ids = itertools.count()
+
+# Called after a write is committed with what changed: ("thread", thread_id)
+# when a thread or its posts do, ("user", user_id) when a user does and
+# ("session", session_key) when a session is deleted
+ItemId = Union[int, str]
+WriteListener = Callable[[str, ItemId], None]
 
 
 @dataclass
@@ -46,6 +59,7 @@ class PostData:
     content: str
     post_date: datetime
     edit_date: datetime
+    ordering: int  # Position in the thread, the first post is 0
 
 
 @dataclass
@@ -85,16 +99,58 @@ class ThreadIDDoesNotExist(Exception):
         self.thread_id = thread_id
 
 
+@timed_methods("storage")
 class Storage:
-    connection: sqlite3.Connection
+    """Safe to use from several threads at once: each thread transparently
+    gets its own sqlite connection to the same database. Time spent in
+    every public method counts towards the request's storage time"""
+
+    path: str
+    _local: threading.local
+    _connections: List[sqlite3.Connection]
+    _connections_lock: threading.Lock
+    _write_listeners: List[WriteListener]
 
     def __init__(self, path: str):
         log.info("opening_db", {"path": path})
 
-        self.connection = sqlite3.connect(path)
-        self.connection.execute("PRAGMA foreign_keys = ON;")
+        if path == ":memory:":
+            # Every connection to ":memory:" gets its own empty database, so
+            # name a shared in memory one for the threads to use
+            path = f"file:nds_memdb_{next(_memory_db_ids)}?mode=memory&cache=shared"
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._write_listeners = []
+
+        # Lets readers in other processes carry on while one of them writes
+        self.connection.execute("PRAGMA journal_mode = WAL;")
         _ensure_db_up_to_date(self.connection)
 
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection, opened on first use"""
+        connection: Optional[sqlite3.Connection] = getattr(
+            self._local, "connection", None
+        )
+        if connection is None:
+            # Connections are only ever used by the thread that opened them,
+            # check_same_thread is off so that close() can close them all
+            connection = sqlite3.connect(self.path, uri=True, check_same_thread=False)
+            connection.execute("PRAGMA foreign_keys = ON;")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
     def create_user(self, user_name: str, secret: bytes, color: ColorData) -> int:
         cur = self.connection.cursor()
         try:
@@ -113,6 +169,7 @@ class Storage:
                 },
             )
         except sqlite3.IntegrityError as err:
+            self.connection.rollback()
             if err.args[0] == "UNIQUE constraint failed: user.user_name":
                 raise UserNameAlreadyExists(user_name=user_name)
             raise err from err
@@ -191,11 +248,42 @@ class Storage:
                 },
             )
         except sqlite3.IntegrityError as err:
+            self.connection.rollback()
             if err.args[0] == "UNIQUE constraint failed: user.user_name":
                 raise UserNameAlreadyExists(user_name=user_data.user_name) from err
             raise err from err
 
+        self._bump_user_revision(cur)
         self.connection.commit()
+        self._notify_write("user", user_data.user_id)
+
+    def _bump_user_revision(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(
+            """
+            UPDATE
+                metadata
+            SET
+                value=value + 1
+            WHERE
+                setting='user_revision'
+            """
+        )
+
+    def get_user_revision(self) -> int:
+        """A counter that goes up whenever a user's details change, so that
+        pages showing user names and colors know they are stale"""
+        cur = self.connection.cursor()
+        cur.execute(
+            """
+            SELECT
+                value
+            FROM
+                metadata
+            WHERE
+                setting='user_revision'
+            """
+        )
+        return int(cur.fetchone()[0])
 
     def create_session_for_user(
         self,
@@ -222,6 +310,7 @@ class Storage:
             )
             self.connection.commit()
         except sqlite3.IntegrityError as err:
+            self.connection.rollback()
             if err.args[0] == "FOREIGN KEY constraint failed":
                 raise UserIDDoesNotExist(user_id=user_id)
             raise err from err
@@ -250,27 +339,98 @@ class Storage:
         )
 
     def delete_session_by_key(self, session_key: str) -> None:
+        with self._write_transaction() as cur:
+            cur.execute(
+                """
+                SELECT
+                    expiry_date
+                FROM
+                    session
+                WHERE
+                    session_key=:session_key;
+                """,
+                {"session_key": session_key},
+            )
+            data = cur.fetchone()
+            cur.execute(
+                """
+                DELETE
+                FROM
+                    session
+                WHERE
+                    session_key=:session_key;
+                """,
+                {"session_key": session_key},
+            )
+            if data is not None:
+                # So that other worker processes drop it from their caches
+                cur.execute(
+                    """
+                    INSERT INTO
+                        deleted_session (session_key, expiry_date)
+                    VALUES
+                        (:session_key, :expiry_date)
+                    """,
+                    {"session_key": session_key, "expiry_date": data[0]},
+                )
+        if data is not None:
+            self._notify_write("session", session_key)
+
+    def clear_sessions_by_date(self, expire_before: datetime, limit: int = -1) -> int:
+        """Deletes up to limit (-1 for all) sessions that expired before
+        expire_before. Returns how many went"""
         cur = self.connection.cursor()
+        # ISO format dates string sort nicely....
         cur.execute(
             """
             DELETE
             FROM
                 session
             WHERE
-                session_key=:session_key;
+                session_id IN (
+                    SELECT
+                        session_id
+                    FROM
+                        session
+                    WHERE
+                        expiry_date < :expire_before
+                    LIMIT :limit
+                );
             """,
-            {"session_key": session_key},
+            {"expire_before": expire_before.isoformat(), "limit": limit},
         )
         self.connection.commit()
+        return cur.rowcount
 
-    def clear_sessions_by_date(self, expire_before: datetime) -> None:
+    def query_deleted_sessions(self, after: int) -> List[Tuple[int, str]]:
+        """(deletion_id, session_key) of sessions deleted since the deletion
+        after"""
+        cur = self.connection.cursor()
+        cur.execute(
+            """
+            SELECT
+                deletion_id, session_key
+            FROM
+                deleted_session
+            WHERE
+                deletion_id > :after
+            ORDER BY
+                deletion_id
+            """,
+            {"after": after},
+        )
+        return [
+            (deletion_id, session_key) for deletion_id, session_key in cur.fetchall()
+        ]
+
+    def clear_deleted_sessions(self, expire_before: datetime) -> None:
+        """Sessions past their expiry date aren't cached anywhere anyway"""
         cur = self.connection.cursor()
-        # ISO format dates string sort nicely....
         cur.execute(
             """
             DELETE
             FROM
-                session
+                deleted_session
             WHERE
                 expiry_date < :expire_before;
             """,
@@ -278,44 +438,133 @@ class Storage:
         )
         self.connection.commit()
 
-    def create_thread(
-        self, post_date: datetime, user_id: int, title: str, initial_post_content: str
-    ) -> int:
+    def get_session_signing_key(self) -> bytes:
+        """The key session tokens are signed with, made when the database
+        was, so that every worker process shares it"""
         cur = self.connection.cursor()
-        cur.execute("BEGIN;")
+        cur.execute(
+            """
+            SELECT
+                value
+            FROM
+                metadata
+            WHERE
+                setting='session_signing_key'
+            """
+        )
+        return bytes.fromhex(cur.fetchone()[0])
 
+    def revoke_session_token(self, token_id: str, expiry_date: datetime) -> None:
+        cur = self.connection.cursor()
         cur.execute(
             """
-                INSERT INTO
-                    thread (title)
-                VALUES
-                    (:title)
-                RETURNING thread_id;
+            INSERT INTO
+                revoked_session (token_id, expiry_date)
+            VALUES
+                (:token_id, :expiry_date)
             """,
-            {
-                "title": title,
-            },
+            {"token_id": token_id, "expiry_date": expiry_date.isoformat()},
         )
-        thread_id = int(cur.fetchone()[0])
-        _post_id = self._create_post_in_thread(
-            cur, user_id, thread_id, post_date, initial_post_content, 0
+        self.connection.commit()
+
+    def query_revoked_session_tokens(
+        self, after: int
+    ) -> List[Tuple[int, str, datetime]]:
+        """(revocation_id, token_id, expiry_date) of tokens revoked since the
+        revocation after"""
+        cur = self.connection.cursor()
+        cur.execute(
+            """
+            SELECT
+                revocation_id, token_id, expiry_date
+            FROM
+                revoked_session
+            WHERE
+                revocation_id > :after
+            ORDER BY
+                revocation_id
+            """,
+            {"after": after},
         )
+        return [
+            (revocation_id, token_id, datetime.fromisoformat(expiry_date))
+            for revocation_id, token_id, expiry_date in cur.fetchall()
+        ]
 
-        cur.execute("COMMIT;")
+    def clear_revoked_session_tokens(self, expire_before: datetime) -> None:
+        """Tokens that have expired don't need revoking any more"""
+        cur = self.connection.cursor()
+        cur.execute(
+            """
+            DELETE
+            FROM
+                revoked_session
+            WHERE
+                expiry_date < :expire_before;
+            """,
+            {"expire_before": expire_before.isoformat()},
+        )
+        self.connection.commit()
 
+    def create_thread(
+        self, post_date: datetime, user_id: int, title: str, initial_post_content: str
+    ) -> int:
+        with self._write_transaction() as cur:
+            cur.execute(
+                """
+                    INSERT INTO
+                        thread (title)
+                    VALUES
+                        (:title)
+                    RETURNING thread_id;
+                """,
+                {
+                    "title": title,
+                },
+            )
+            thread_id = int(cur.fetchone()[0])
+            _post_id = self._create_post_in_thread(
+                cur, user_id, thread_id, post_date, initial_post_content, 0
+            )
+
+        self._notify_write("thread", thread_id)
         return thread_id
 
     def create_post_in_thread(
         self, user_id: int, thread_id: int, post_date: datetime, post_content: str
     ) -> int:
+        with self._write_transaction() as cur:
+            ordering = self._get_max_post_id(cur, thread_id) + 1
+            post_id = self._create_post_in_thread(
+                cur, user_id, thread_id, post_date, post_content, ordering
+            )
+        self._notify_write("thread", thread_id)
+        return post_id
+
+    def add_write_listener(self, listener: WriteListener) -> None:
+        """Writes made through this Storage are passed on to listener.
+        Writes by other processes are not, so anything cached from them
+        still has to be checked against the database"""
+        self._write_listeners.append(listener)
+
+    def _notify_write(self, kind: str, item_id: ItemId) -> None:
+        for listener in self._write_listeners:
+            listener(kind, item_id)
+
+    @contextmanager
+    def _write_transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Takes the write lock up front. A deferred transaction that reads
+        before writing fails outright, rather than waiting, if another
+        thread or process commits in between. Rolls back if anything
+        raises, so the connection isn't left stuck in the transaction"""
         cur = self.connection.cursor()
-        cur.execute("BEGIN;")
-        ordering = self._get_max_post_id(cur, thread_id) + 1
-        post_id = self._create_post_in_thread(
-            cur, user_id, thread_id, post_date, post_content, ordering
-        )
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK;")
+            raise
         cur.execute("COMMIT;")
-        return post_id
 
     def _get_max_post_id(self, cur: sqlite3.Cursor, thread_id: int) -> int:
         cur.execute(
@@ -379,7 +628,11 @@ class Storage:
         )
         return post_id
 
-    def query_threads(self, limit: int, offset: int) -> List[ThreadData]:
+    def query_threads(
+        self, limit: int, after: Optional[int] = None, before: Optional[int] = None
+    ) -> List[ThreadData]:
+        """Up to limit threads in thread_id order, starting just after the
+        thread_id after or finishing just before the thread_id before"""
         cur = self.connection.cursor()
         cur.execute(
             """
@@ -399,15 +652,18 @@ class Storage:
 
             WHERE
                 post_thread.ordering == 0
+                AND thread.thread_id > :after
+                AND thread.thread_id < :before
 
             ORDER BY
-                thread.thread_id
+                thread.thread_id {}
             LIMIT :limit
-            OFFSET :offset
-            """,
-            {"limit": limit, "offset": offset},
+            """.format(
+                "ASC" if before is None else "DESC"
+            ),
+            _keyset_params(limit, after, before),
         )
-        rows = cur.fetchall()
+        rows = _in_key_order(cur.fetchall(), before)
 
         return [
             ThreadData(
@@ -419,6 +675,50 @@ class Storage:
             for row in rows
         ]
 
+    def query_latest_thread_id(self) -> int:
+        cur = self.connection.cursor()
+        cur.execute(
+            """
+            SELECT
+                MAX(thread_id)
+            FROM
+                thread
+            """
+        )
+        return int(cur.fetchone()[0] or 0)
+
+    def query_latest_post_ordering(self, thread_id: int) -> Optional[int]:
+        """The ordering of the newest post in the thread, or None if there is
+        no such thread"""
+        try:
+            return self._get_max_post_id(self.connection.cursor(), thread_id)
+        except ThreadIDDoesNotExist:
+            return None
+
+    def query_thread_version(self, thread_id: int) -> Optional[Tuple[int, datetime]]:
+        """The newest post_id and edit_date in a thread, which between them
+        change whenever the thread's posts do"""
+        cur = self.connection.cursor()
+        cur.execute(
+            """
+            SELECT
+                MAX(post.post_id), MAX(post.edit_date)
+            FROM
+                post_thread
+
+            INNER JOIN post
+                ON post.post_id == post_thread.post_id
+
+            WHERE
+                post_thread.thread_id == :thread_id
+            """,
+            {"thread_id": thread_id},
+        )
+        row = cur.fetchone()
+        if row[0] is None:
+            return None
+        return (int(row[0]), datetime.fromisoformat(row[1]))
+
     def query_thread_by_id(self, thread_id: int) -> Optional[ThreadData]:
         cur = self.connection.cursor()
         cur.execute(
@@ -459,32 +759,42 @@ class Storage:
         )
 
     def query_posts_by_thread_id(
-        self, thread_id: int, limit: int, offset: int
+        self,
+        thread_id: int,
+        limit: int,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
     ) -> List[PostData]:
+        """Up to limit posts in the order they were made, starting just after
+        the ordering after or finishing just before the ordering before"""
         cur = self.connection.cursor()
         cur.execute(
             """
             SELECT
-                post_user.user_id, post.post_id, post.content, post.post_date, post.edit_date
+                post_user.user_id, post.post_id, post.content, post.post_date, post.edit_date,
+                post_thread.ordering
             FROM
-                post
+                post_thread
 
-            INNER JOIN post_thread
+            INNER JOIN post
                 ON post_thread.post_id == post.post_id
             INNER JOIN post_user
                 on post_user.post_id == post.post_id
 
             WHERE
                 post_thread.thread_id == :thread_id
+                AND post_thread.ordering > :after
+                AND post_thread.ordering < :before
 
             ORDER BY
-               ordering
+               post_thread.ordering {}
             LIMIT :limit
-            OFFSET :offset
-            """,
-            {"thread_id": thread_id, "limit": limit, "offset": offset},
+            """.format(
+                "ASC" if before is None else "DESC"
+            ),
+            {"thread_id": thread_id, **_keyset_params(limit, after, before)},
         )
-        rows = cur.fetchall()
+        rows = _in_key_order(cur.fetchall(), before)
 
         return [
             PostData(
@@ -493,10 +803,99 @@ class Storage:
                 content=row[2],
                 post_date=datetime.fromisoformat(row[3]),
                 edit_date=datetime.fromisoformat(row[4]),
+                ordering=row[5],
             )
             for row in rows
         ]
 
+    def iter_posts_by_thread_id(
+        self,
+        thread_id: int,
+        limit: int,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+    ) -> Iterator[Tuple[PostData, UserData]]:
+        """query_posts_by_thread_id along with each post's author, yielded
+        as sqlite produces the rows rather than read in one go. Nothing is
+        read until the first row is asked for, and then on the connection
+        of whichever thread is iterating"""
+        query = """
+            SELECT
+                post_user.user_id, post.post_id, post.content, post.post_date,
+                post.edit_date, post_thread.ordering,
+                user.user_name, user.secret, user.color
+            FROM
+                post_thread
+
+            INNER JOIN post
+                ON post_thread.post_id == post.post_id
+            INNER JOIN post_user
+                ON post_user.post_id == post.post_id
+            INNER JOIN user
+                ON user.user_id == post_user.user_id
+
+            WHERE
+                post_thread.thread_id == :thread_id
+                AND post_thread.ordering > :after
+                AND post_thread.ordering < :before
+
+            ORDER BY
+                post_thread.ordering {}
+            LIMIT :limit
+            """
+        if before is None:
+            query = query.format("ASC")
+        else:
+            # Read backwards from before, then put the page the right way
+            # round. Only this has to sort, the forwards read streams
+            query = "SELECT * FROM ({}) ORDER BY ordering".format(
+                query.format("DESC")
+            )
+
+        cur = self.connection.cursor()
+        cur.execute(
+            query, {"thread_id": thread_id, **_keyset_params(limit, after, before)}
+        )
+        users: Dict[int, UserData] = {}  # The same few users post a lot
+        try:
+            for row in cur:
+                user = users.get(row[0])
+                if user is None:
+                    user = users[row[0]] = UserData(
+                        user_name=row[6],
+                        user_id=row[0],
+                        secret=row[7],
+                        color=parse_color(row[8]),
+                    )
+                post = PostData(
+                    user_id=row[0],
+                    post_id=row[1],
+                    content=row[2],
+                    post_date=datetime.fromisoformat(row[3]),
+                    edit_date=datetime.fromisoformat(row[4]),
+                    ordering=row[5],
+                )
+                yield (post, user)
+        finally:
+            cur.close()
+
+
+def _keyset_params(
+    limit: int, after: Optional[int], before: Optional[int]
+) -> Dict[str, int]:
+    """Pages are found by seeking the index to either side of a key rather
+    than with OFFSET, so later pages cost no more than the first"""
+    return {
+        "limit": limit,
+        "after": -1 if after is None else after,
+        "before": 2**63 - 1 if before is None else before,
+    }
+
+
+def _in_key_order(rows: List[Any], before: Optional[int]) -> List[Any]:
+    # Paging backwards reads the index in reverse, to stop at limit rows
+    return rows if before is None else rows[::-1]
+
 
 def parse_color(color: Optional[str]) -> ColorData:
     if color is not None:
@@ -683,10 +1082,181 @@ def _upgrade_v3_to_v4(connection: sqlite3.Connection) -> None:
     connection.commit()
 
 
+def _upgrade_v4_to_v5(connection: sqlite3.Connection) -> None:
+    cur = connection.cursor()
+    cur.executescript(
+        """
+        BEGIN;
+        INSERT INTO
+            metadata
+        VALUES
+            ('user_revision', 0);
+        COMMIT;
+    """
+    )
+
+    cur.execute(
+        """
+        UPDATE
+            metadata
+        SET
+            value=:db_version
+        WHERE
+            setting='db_version'
+    """,
+        {"db_version": 5},
+    )
+    connection.commit()
+
+
+def _upgrade_v5_to_v6(connection: sqlite3.Connection) -> None:
+    cur = connection.cursor()
+    cur.executescript(
+        """
+        BEGIN;
+        CREATE INDEX
+            post_thread_ordering_index
+        ON
+            post_thread(thread_id, ordering);
+
+        CREATE INDEX
+            post_user_post_index
+        ON
+            post_user(post_id);
+        COMMIT;
+    """
+    )
+
+    cur.execute(
+        """
+        UPDATE
+            metadata
+        SET
+            value=:db_version
+        WHERE
+            setting='db_version'
+    """,
+        {"db_version": 6},
+    )
+    connection.commit()
+
+
+def _upgrade_v6_to_v7(connection: sqlite3.Connection) -> None:
+    cur = connection.cursor()
+    cur.executescript(
+        """
+        BEGIN;
+        CREATE TABLE revoked_session (
+            revocation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token_id TEXT NOT NULL,
+            expiry_date TEXT NOT NULL
+        );
+        COMMIT;
+    """
+    )
+
+    cur.execute(
+        """
+        INSERT INTO
+            metadata
+        VALUES
+            ('session_signing_key', :key)
+    """,
+        {"key": os.urandom(32).hex()},
+    )
+    cur.execute(
+        """
+        UPDATE
+            metadata
+        SET
+            value=:db_version
+        WHERE
+            setting='db_version'
+    """,
+        {"db_version": 7},
+    )
+    connection.commit()
+
+
+def _upgrade_v7_to_v8(connection: sqlite3.Connection) -> None:
+    cur = connection.cursor()
+    cur.executescript(
+        """
+        BEGIN;
+        CREATE INDEX
+            session_expiry_index
+        ON
+            session(expiry_date);
+
+        CREATE INDEX
+            revoked_session_expiry_index
+        ON
+            revoked_session(expiry_date);
+        COMMIT;
+    """
+    )
+
+    cur.execute(
+        """
+        UPDATE
+            metadata
+        SET
+            value=:db_version
+        WHERE
+            setting='db_version'
+    """,
+        {"db_version": 8},
+    )
+    connection.commit()
+
+
+def _upgrade_v8_to_v9(connection: sqlite3.Connection) -> None:
+    cur = connection.cursor()
+    cur.executescript(
+        """
+        BEGIN;
+        CREATE TABLE deleted_session (
+            deletion_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_key TEXT NOT NULL,
+            expiry_date TEXT NOT NULL
+        );
+
+        CREATE INDEX
+            deleted_session_expiry_index
+        ON
+            deleted_session(expiry_date);
+        COMMIT;
+    """
+    )
+
+    cur.execute(
+        """
+        UPDATE
+            metadata
+        SET
+            value=:db_version
+        WHERE
+            setting='db_version'
+    """,
+        {"db_version": 9},
+    )
+    connection.commit()
+
+
 def _ensure_db_up_to_date(connection: sqlite3.Connection) -> None:
     current_version = _get_db_version(connection)
 
-    versions = [_create_v1_db, _upgrade_v1_to_v2, _upgrade_v2_to_v3, _upgrade_v3_to_v4]
+    versions = [
+        _create_v1_db,
+        _upgrade_v1_to_v2,
+        _upgrade_v2_to_v3,
+        _upgrade_v3_to_v4,
+        _upgrade_v4_to_v5,
+        _upgrade_v5_to_v6,
+        _upgrade_v6_to_v7,
+        _upgrade_v7_to_v8,
+        _upgrade_v8_to_v9,
+    ]
 
     while current_version < len(versions):
         upgrade_function = versions[current_version]
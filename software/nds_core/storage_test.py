@@ -1,7 +1,11 @@
 import sqlite3
 import pytest
 import datetime
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
 from .storage import (
+    ItemId,
     Storage,
     _get_db_version,
     _create_v1_db,
@@ -21,6 +25,89 @@ def test_create_storage() -> None:
     Storage(":memory:")
 
 
+def test_storage_is_shared_between_threads() -> None:
+    storage = Storage(":memory:")
+    storage.create_user("testUser", b"testSecret", ColorData(0, 0, 0))
+
+    found: List[Optional[UserData]] = []
+    thread = threading.Thread(
+        target=lambda: found.append(storage.query_user_by_user_name("testUser"))
+    )
+    thread.start()
+    thread.join()
+
+    assert found[0] is not None
+    assert found[0].user_name == "testUser"
+    storage.close()
+
+
+def test_concurrent_posts_from_threads(tmp_path: Path) -> None:
+    storage = Storage(str(tmp_path / "test.db"))
+    user_id = storage.create_user("testUser", b"testSecret", ColorData(0, 0, 0))
+    thread_id = storage.create_thread(datetime.datetime.now(), user_id, "Title", "1")
+
+    errors: List[Exception] = []
+
+    def post_replies() -> None:
+        try:
+            for _ in range(20):
+                storage.create_post_in_thread(
+                    user_id, thread_id, datetime.datetime.now(), "reply"
+                )
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=post_replies) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(storage.query_posts_by_thread_id(thread_id, 100)) == 81
+    storage.close()
+
+
+def test_write_listeners() -> None:
+    storage = Storage(":memory:")
+    writes: List[Tuple[str, ItemId]] = []
+    storage.add_write_listener(lambda kind, item_id: writes.append((kind, item_id)))
+
+    now = datetime.datetime.now()
+    user_id = storage.create_user("testUser", b"testSecret", ColorData(0, 0, 0))
+    thread_id = storage.create_thread(now, user_id, "Title", "First")
+    storage.create_post_in_thread(user_id, thread_id, now, "Second")
+    storage.update_user(UserData("renamed", user_id, b"testSecret", ColorData(1, 2, 3)))
+    storage.create_session_for_user(user_id, "key", now, now)
+    storage.delete_session_by_key("key")
+    storage.delete_session_by_key("missing")
+
+    assert writes == [
+        ("thread", thread_id),
+        ("thread", thread_id),
+        ("user", user_id),
+        ("session", "key"),
+    ]
+    storage.close()
+
+
+def test_iter_posts_matches_query() -> None:
+    storage = Storage(":memory:")
+    now = datetime.datetime.now()
+    user_id = storage.create_user("testUser", b"testSecret", ColorData(1, 2, 3))
+    thread_id = storage.create_thread(now, user_id, "Title", "First")
+    for i in range(9):
+        storage.create_post_in_thread(user_id, thread_id, now, f"Post {i}")
+
+    for after, before in [(None, None), (3, None), (None, 6), (None, 2)]:
+        rows = list(storage.iter_posts_by_thread_id(thread_id, 4, after, before))
+        assert [post for post, _ in rows] == storage.query_posts_by_thread_id(
+            thread_id, 4, after, before
+        )
+        assert all(user.user_name == "testUser" for _, user in rows)
+    storage.close()
+
+
 def test_empty_db_is_v_neg1() -> None:
     db = sqlite3.connect(":memory:")
     assert _get_db_version(db) == 0
@@ -45,7 +132,7 @@ def test_can_upgrade_to_v1() -> None:
 def test_upgrades_all() -> None:
     db = sqlite3.connect(":memory:")
     _ensure_db_up_to_date(db)
-    assert _get_db_version(db) == 4
+    assert _get_db_version(db) == 9
 
 
 def test_can_create_user() -> None:
@@ -174,7 +261,7 @@ def test_delete_session_by_date() -> None:
         expiry_date=d3,
     )
 
-    storage.clear_sessions_by_date(d2)
+    assert storage.clear_sessions_by_date(d2) == 1
     # Should delete d1 but not d3
 
     assert storage.get_session_by_key("asdfwargle1") is None
@@ -184,6 +271,30 @@ def test_delete_session_by_date() -> None:
     assert storage.get_session_by_key("asdfwargle2") is None
 
 
+def test_delete_sessions_in_batches() -> None:
+    storage = Storage(":memory:")
+    d1 = datetime.datetime.now()
+    user_1 = storage.create_user("testUser", b"testSecret", ColorData(0, 0, 0))
+    for i in range(5):
+        storage.create_session_for_user(
+            user_id=user_1,
+            session_key=f"asdfwargle{i}",
+            creation_date=d1,
+            expiry_date=d1 + datetime.timedelta(hours=i - 3),
+        )
+
+    assert storage.clear_sessions_by_date(d1, 2) == 2
+    assert storage.clear_sessions_by_date(d1, 2) == 1
+    assert storage.clear_sessions_by_date(d1, 2) == 0
+    assert storage.get_session_by_key("asdfwargle3") is not None
+
+    plan = storage.connection.execute(
+        "EXPLAIN QUERY PLAN SELECT session_id FROM session WHERE expiry_date < ?",
+        (d1.isoformat(),),
+    ).fetchall()
+    assert "session_expiry_index" in str(plan)
+
+
 def test_parse_hex() -> None:
     assert ColorData.from_hex("#010203") == ColorData(r=1, g=2, b=3)
     assert ColorData.from_hex("#111213") == ColorData(r=17, g=18, b=19)
@@ -218,7 +329,7 @@ def test_create_thread() -> None:
         user_id, thread_id_2, d1, "Thread2 Post2"
     )
 
-    assert storage.query_threads(3, 0) == [
+    assert storage.query_threads(3) == [
         ThreadData(
             thread_id=thread_id_1,
             title="The First Thread",
@@ -238,7 +349,7 @@ def test_create_thread() -> None:
             post_date=d1,
         ),
     ]
-    assert storage.query_threads(2, 0) == [
+    assert storage.query_threads(2) == [
         ThreadData(
             thread_id=thread_id_1,
             title="The First Thread",
@@ -252,7 +363,7 @@ def test_create_thread() -> None:
             post_date=d1,
         ),
     ]
-    assert storage.query_threads(2, 1) == [
+    assert storage.query_threads(2, after=thread_id_1) == [
         ThreadData(
             thread_id=thread_id_2,
             title="The Second Thread",
@@ -266,7 +377,7 @@ def test_create_thread() -> None:
             post_date=d1,
         ),
     ]
-    assert storage.query_threads(5, 1) == [
+    assert storage.query_threads(5, after=thread_id_1) == [
         ThreadData(
             thread_id=thread_id_2,
             title="The Second Thread",
@@ -281,6 +392,11 @@ def test_create_thread() -> None:
         ),
     ]
 
+    before_3 = storage.query_threads(2, before=thread_id_3)
+    assert [t.thread_id for t in before_3] == [thread_id_1, thread_id_2]
+    before_2 = storage.query_threads(5, before=thread_id_2)
+    assert [t.thread_id for t in before_2] == [thread_id_1]
+
     assert storage.query_thread_by_id(thread_id_1) == ThreadData(
         thread_id=thread_id_1,
         title="The First Thread",
@@ -314,13 +430,18 @@ def test_post_on_thread() -> None:
         user_id_1, thread_id_2, d1, "Thread2 Post2"
     )
 
-    assert storage.query_posts_by_thread_id(thread_id_1, 10, 0) == [
+    assert storage.query_latest_post_ordering(thread_id_1) == 2
+    assert storage.query_latest_post_ordering(thread_id_2) == 1
+    assert storage.query_latest_post_ordering(thread_id_2 + 1) is None
+
+    assert storage.query_posts_by_thread_id(thread_id_1, 10) == [
         PostData(
             user_id=user_id_1,
             post_id=1,
             content="Contents of first thread",
             post_date=d1,
             edit_date=d1,
+            ordering=0,
         ),
         PostData(
             user_id=user_id_2,
@@ -328,6 +449,7 @@ def test_post_on_thread() -> None:
             content="Thread1 Post2",
             post_date=d1,
             edit_date=d1,
+            ordering=1,
         ),
         PostData(
             user_id=user_id_1,
@@ -335,16 +457,18 @@ def test_post_on_thread() -> None:
             content="Thread1 Post3",
             post_date=d1,
             edit_date=d1,
+            ordering=2,
         ),
     ]
 
-    assert storage.query_posts_by_thread_id(thread_id_2, 10, 0) == [
+    assert storage.query_posts_by_thread_id(thread_id_2, 10) == [
         PostData(
             user_id=user_id_2,
             post_id=2,
             content="Contents of second thread",
             post_date=d1,
             edit_date=d1,
+            ordering=0,
         ),
         PostData(
             user_id=user_id_1,
@@ -352,9 +476,18 @@ def test_post_on_thread() -> None:
             content="Thread2 Post2",
             post_date=d1,
             edit_date=d1,
+            ordering=1,
         ),
     ]
 
+    # Paging either way from a post
+    assert [p.ordering for p in storage.query_posts_by_thread_id(thread_id_1, 1)] == [0]
+    page = storage.query_posts_by_thread_id(thread_id_1, 5, after=0)
+    assert [p.post_id for p in page] == [post_id_1_1, post_id_1_2]
+    page = storage.query_posts_by_thread_id(thread_id_1, 1, before=2)
+    assert [p.post_id for p in page] == [post_id_1_1]
+    assert storage.query_posts_by_thread_id(thread_id_1, 5, after=2) == []
+
     # Post on nonexistant thread
     with pytest.raises(ThreadIDDoesNotExist):
         storage.create_post_in_thread(user_id_2, 1234, d1, "Thread1 Post2")
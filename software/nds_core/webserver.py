@@ -1,62 +1,318 @@
-from typing import Optional, Literal, Callable, List, Tuple
+from collections import deque
+from typing import (
+    Callable,
+    Deque,
+    Optional,
+    Literal,
+    List,
+    Tuple,
+    Union,
+    BinaryIO,
+    Iterator,
+    Dict,
+    cast,
+)
+import os
+import re
 import socket
-import time
+import threading
+import urllib.parse
 from .config import _Config
 
 from . import log
 
 
-Methods = Literal["GET", "POST", "DELETE"]
+Methods = Literal["GET", "HEAD", "POST", "DELETE"]
 Headers = List[Tuple[bytes, bytes]]
 QueryParams = List[Tuple[str, str]]
+Cookies = List[Tuple[str, str]]
+Body = Union[bytes, BinaryIO, Iterator[bytes], "PushStream"]
+
+# Hex digits only. int(..., 16) would also take signs, 0x and underscores,
+# which a proxy in front of us may not read the same way
+CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]{1,16}")
+
+
+class HeaderMap:
+    """Request headers. Lookups are case insensitive, and the index is only
+    built the first time something is looked up"""
+
+    _items: Headers
+    _index: Optional[Dict[bytes, List[bytes]]]
+
+    def __init__(self, items: Optional[Headers] = None):
+        self._items = [] if items is None else items
+        self._index = None
+
+    def _get_index(self) -> Dict[bytes, List[bytes]]:
+        if self._index is None:
+            self._index = {}
+            for key, val in self._items:
+                self._index.setdefault(key.lower(), []).append(val)
+        return self._index
+
+    def get(self, name: bytes) -> Optional[bytes]:
+        """The first value sent for the header, if any"""
+        values = self._get_index().get(name.lower())
+        return None if values is None else values[0]
+
+    def get_all(self, name: bytes) -> List[bytes]:
+        return self._get_index().get(name.lower(), [])
+
+    def append(self, name: bytes, val: bytes) -> None:
+        self._items.append((name, val))
+        if self._index is not None:
+            self._index.setdefault(name.lower(), []).append(val)
+
+    def items(self) -> Headers:
+        """Every header, in the order it was sent"""
+        return list(self._items)
+
+    def __contains__(self, name: bytes) -> bool:
+        return name.lower() in self._get_index()
+
+    def __len__(self) -> int:
+        return len(self._items)
 
 
 class HTTPRequest:
+    """A request from a client. The query string, cookies and form body are
+    only parsed if something asks for them"""
+
     method: Methods
     url: str
     content: bytes
-    headers: Headers
-    query_params: QueryParams
+    headers: HeaderMap
+    query_string: str
+    protocol: str
+    route: Optional[str]  # Set by whatever picks the handler, for metrics
+
+    _query_params: Optional[QueryParams]
+    _cookies: Optional[Cookies]
+    _form: Optional[Dict[bytes, List[bytes]]]
 
     def __init__(
         self,
         method: Methods,
         url: str,
         content: bytes,
-        headers: Headers,
-        query_params: QueryParams,
+        headers: Union[Headers, HeaderMap],
+        query_params: Optional[QueryParams] = None,
+        protocol: str = "HTTP/1.1",
+        query_string: str = "",
     ):
         self.method = method
         self.url = url
         self.content = content
-        self.headers = headers
-        self.query_params = query_params
+        self.headers = headers if isinstance(headers, HeaderMap) else HeaderMap(headers)
+        self.query_string = query_string
+        self.protocol = protocol
+        self.route = None
+        self._query_params = query_params
+        self._cookies = None
+        self._form = None
+
+    @property
+    def query_params(self) -> QueryParams:
+        """Percent decoded (key, value) pairs from the query string"""
+        if self._query_params is None:
+            self._query_params = urllib.parse.parse_qsl(
+                self.query_string, keep_blank_values=True
+            )
+        return self._query_params
+
+    def get_query_param(self, key: str) -> Optional[str]:
+        return next((v for k, v in self.query_params if k == key), None)
+
+    @property
+    def cookies(self) -> Cookies:
+        """(name, value) pairs from every Cookie header"""
+        if self._cookies is None:
+            self._cookies = []
+            for cookie_str in self.headers.get_all(b"Cookie"):
+                for cookie in cookie_str.decode("utf-8", errors="replace").split(";"):
+                    key, _, val = cookie.partition("=")
+                    self._cookies.append((key.strip(), val.strip()))
+        return self._cookies
+
+    @property
+    def form(self) -> Dict[bytes, List[bytes]]:
+        """The body decoded as application/x-www-form-urlencoded"""
+        if self._form is None:
+            self._form = urllib.parse.parse_qs(self.content)
+        return self._form
+
+    def get_form_value(self, key: bytes) -> Optional[bytes]:
+        return next(iter(self.form.get(key, [])), None)
+
+    def wants_keep_alive(self) -> bool:
+        """HTTP/1.1 connections persist unless the client says otherwise,
+        HTTP/1.0 ones only if the client asks"""
+        connection = self.headers.get(b"Connection")
+        tokens = [] if connection is None else connection.lower().split(b",")
+        tokens = [t.strip() for t in tokens]
+        if self.protocol == "HTTP/1.0":
+            return b"keep-alive" in tokens
+        return b"close" not in tokens
+
+
+class PushStream:
+    """A response body that is written to as things happen, rather than
+    pulled from, eg server-sent events. The server sends whatever has been
+    written whenever the client can take it. In between it costs no more
+    than the open socket: no thread waits on it. Safe to write to and close
+    from any thread"""
+
+    chunks: Deque[bytes]
+    buffered: int  # Bytes written but not yet taken by the server
+    max_buffered: int
+    closed: bool
+    failed: bool  # Closed part way through, the client mustn't take it as whole
+    lock: threading.Lock
+    room: threading.Condition  # Notified when chunks are taken or it closes
+    _waiter: Optional[Callable[[], None]]
+    _close_callbacks: List[Callable[[], None]]
+
+    def __init__(self, max_buffered: int = 1024 * 1024):
+        self.chunks = deque()
+        self.buffered = 0
+        self.max_buffered = max_buffered
+        self.closed = False
+        self.failed = False
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        self._waiter = None
+        self._close_callbacks = []
+
+    def write(self, data: bytes) -> bool:
+        """Queues data to send. Returns False if the stream is closed. A
+        client that lets more than max_buffered pile up is cut off"""
+        with self.lock:
+            if self.closed:
+                return False
+            overflowed = self.buffered + len(data) > self.max_buffered
+            waiter = None
+            if not overflowed:
+                self.chunks.append(data)
+                self.buffered += len(data)
+                waiter, self._waiter = self._waiter, None
+        if overflowed:
+            log.warn("push_stream_overflow", {"buffered": self.buffered})
+            self.close()
+            return False
+        if waiter is not None:
+            waiter()
+        return True
+
+    def close(self) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            waiter, self._waiter = self._waiter, None
+            callbacks, self._close_callbacks = self._close_callbacks, []
+            self.room.notify_all()
+        if waiter is not None:
+            waiter()
+        for callback in callbacks:
+            callback()
+
+    def abort(self) -> None:
+        """Closes the stream without finishing the response, so that the
+        connection is dropped rather than the body looking complete"""
+        self.failed = True
+        self.close()
+
+    def wait_for_room(self, max_buffered: int) -> bool:
+        """Blocks until less than max_buffered is waiting to be sent.
+        Returns False if the stream has been closed"""
+        with self.room:
+            while self.buffered >= max_buffered and not self.closed:
+                self.room.wait()
+            return not self.closed
+
+    def on_close(self, callback: Callable[[], None]) -> None:
+        """Runs callback once the stream is closed, by either end"""
+        with self.lock:
+            if not self.closed:
+                self._close_callbacks.append(callback)
+                return
+        callback()
+
+    def take(self) -> Tuple[List[bytes], bool]:
+        """Everything written since last time, and whether the stream has
+        been closed"""
+        with self.lock:
+            chunks = list(self.chunks)
+            self.chunks.clear()
+            self.buffered = 0
+            self.room.notify_all()
+            return chunks, self.closed
+
+    def wait(self, waiter: Callable[[], None]) -> bool:
+        """Has waiter called, from whichever thread writes next, once there
+        is something to take. Returns False without waiting if there
+        already is"""
+        with self.lock:
+            if self.chunks or self.closed:
+                return False
+            self._waiter = waiter
+            return True
 
 
 class HTTPResponse:
+    """A response to send to the client. The body is one of:
+    - bytes
+    - an open binary file, which the server sends straight from disk and
+      closes when done
+    - an iterator (eg a generator) of bytes, which the server pulls from
+      only as fast as the client reads
+    - a PushStream, which the server sends from as it is written to
+    Unless the handler sets a Content-Length header the last two are sent
+    with chunked transfer encoding"""
+
     status_code: int
-    data: bytes
+    data: Body
     headers: Headers
 
-    def __init__(self, status_code: int, data: bytes = b"", headers: Headers = []):
+    def __init__(self, status_code: int, data: Body = b"", headers: Headers = []):
         self.status_code = status_code
         self.data = data
         self.headers = headers
 
 
+class HTTPError(Exception):
+    """Raised when a client sends something we can't or won't service"""
+
+    status_code: int
+    reason: str
+
+    def __init__(self, status_code: int, reason: str):
+        self.status_code = status_code
+        self.reason = reason
+
+
 class HttpSocket:
+    """The listening socket. With reuse_port several processes can each bind
+    their own socket to the same port and the kernel shares connections
+    between them"""
+
     http_socket: Optional[socket.socket]
+    reuse_port: bool
 
-    def __init__(self, server_config: _Config):
+    def __init__(self, server_config: _Config, reuse_port: bool = False):
         self.server_config = server_config
+        self.reuse_port = reuse_port
 
     def __enter__(self) -> socket.socket:
         self.http_socket = socket.socket()
         self.http_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.http_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         self.http_socket.bind(("0.0.0.0", self.server_config.WEBSERVER_PORT))
 
-        self.http_socket.listen(1)
+        self.http_socket.listen(self.server_config.WEBSERVER_BACKLOG)
         self.http_socket.settimeout(0)
         return self.http_socket
 
@@ -67,15 +323,16 @@ class HttpSocket:
             self.http_socket.close()
 
 
-def parse_method(raw: bytes) -> Methods:
-    method: Optional[Methods] = None
-    if raw == b"GET":
-        method = "GET"
-    elif raw == b"POST":
-        method = "POST"
-    elif raw == b"DELETE":
-        method = "DELETE"
+_METHODS: Dict[bytes, Methods] = {
+    b"GET": "GET",
+    b"HEAD": "HEAD",
+    b"POST": "POST",
+    b"DELETE": "DELETE",
+}
+
 
+def parse_method(raw: bytes) -> Methods:
+    method = _METHODS.get(raw)
     if method is None:
         raise Exception(f"unknown method {repr(raw)}")
 
@@ -83,28 +340,27 @@ def parse_method(raw: bytes) -> Methods:
 
 
 def parse_request(raw: bytes) -> Optional[HTTPRequest]:
-    """Extracts a HTTP request from raw bytes"""
+    """Extracts a HTTP request from raw bytes. Only the request line and
+    header lines are split up here, everything else is left for
+    HTTPRequest to parse if it is needed"""
     try:
-        header, content = raw.split(b"\r\n\r\n", maxsplit=1)
-        lines = header.split(b"\r\n")
-
-        method_raw, url_raw, protocol = lines[0].strip().split(b" ")
-        headers: Headers = [
-            # Mypy can't tell about the maxsplit
-            tuple([t.strip() for t in line.split(b":", maxsplit=1)])  # type: ignore
-            for line in lines[1:]
-        ]
+        head_end = raw.index(b"\r\n\r\n")
+        line_end = raw.find(b"\r\n", 0, head_end)
+        if line_end < 0:
+            line_end = head_end
+
+        method_raw, url_raw, protocol_raw = raw[:line_end].strip().split(b" ")
+        headers: Headers = []
+        headers_start = line_end + 2
+        if headers_start < head_end:
+            for line in raw[headers_start:head_end].split(b"\r\n"):
+                key, _, val = line.partition(b":")
+                headers.append((key.strip(), val.strip()))
 
         method = parse_method(method_raw)
-        url_parts = url_raw.decode("utf-8").split("?", maxsplit=1)
-        url = url_parts[0]
-        query_str = url_parts[1] if len(url_parts) > 1 else ""
-        query_params = []
-        for query in query_str.split("&"):
-            spl = query.split("=", maxsplit=1)
-            key = spl[0]
-            val = spl[1] if len(spl) > 1 else ""
-            query_params.append((key, val))
+        protocol = protocol_raw.decode("utf-8")
+        url, _, query_string = url_raw.decode("utf-8").partition("?")
+        body_start = head_end + 4
     except Exception as err:
         log.warn("failed_parsing_request", {"exception": str(err)})
         return None
@@ -112,97 +368,201 @@ def parse_request(raw: bytes) -> Optional[HTTPRequest]:
     return HTTPRequest(
         method=method,
         url=url,
-        headers=headers,
-        content=content,
-        query_params=query_params,
+        headers=HeaderMap(headers),
+        content=raw[body_start:],
+        protocol=protocol,
+        query_string=query_string,
     )
 
 
-def get_data_from_client(client_socket: socket.socket) -> Optional[bytes]:
-    # TODO: continue receiving until end of transmission
-    try:
-        raw = client_socket.recv(1024)
-    except OSError as err:
-        log.warn("client_recv_err", {"exception": str(err)})
-        return None
+def get_header(headers: Union[Headers, HeaderMap], name: bytes) -> Optional[bytes]:
+    """Returns the value of the first header matching name (case insensitive)"""
+    if isinstance(headers, HeaderMap):
+        return headers.get(name)
+    name = name.lower()
+    for key, val in headers:
+        if key.lower() == name:
+            return val
+    return None
 
-    return raw
 
+class RequestReader:
+    """Incrementally assembles requests from data received from a client.
+    Buffers until the end of the header block, then reads exactly
+    Content-Length bytes or decodes a chunked body. Any bytes after the end
+    of a request are kept for the next one."""
 
-def send_response_bytes(
-    server_config: _Config, client_socket: socket.socket, page_bytes: bytes
-) -> None:
-    try:
-        client_socket.settimeout(server_config.WEBSERVER_CLIENT_TIMEOUT_MS)
-        while len(page_bytes) > 0:
-            sent = client_socket.send(page_bytes)
-            page_bytes = page_bytes[sent:]
-            time.sleep(server_config.WEBSERVER_BUFFER_SEND_MS / 1000)
-        client_socket.settimeout(0)
+    max_header_bytes: int
+    max_body_bytes: int
+    buffer: bytearray
 
-    except OSError:
-        log.warn("client_timed_out", {})
+    _request: Optional[HTTPRequest]
+    _content_length: int
+    _chunked: bool
+    _chunk_remaining: int
+    _body: bytearray
 
+    def __init__(self, server_config: _Config):
+        self.max_header_bytes = server_config.WEBSERVER_MAX_HEADER_BYTES
+        self.max_body_bytes = server_config.WEBSERVER_MAX_BODY_BYTES
+        self.buffer = bytearray()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._request = None
+        self._content_length = 0
+        self._chunked = False
+        self._chunk_remaining = -1
+        self._body = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+
+    def is_idle(self) -> bool:
+        """True if there is no partially received request"""
+        return self._request is None and len(self.buffer) == 0
+
+    def reading_body(self) -> bool:
+        """True once the headers of a request are in but not its body"""
+        return self._request is not None
+
+    def read_request(self) -> Optional[HTTPRequest]:
+        """Returns the next complete request, or None if more data is needed.
+        Raises HTTPError if the request is malformed or over the limits"""
+        if self._request is None and not self._read_head():
+            return None
+
+        if self._chunked:
+            if not self._read_chunks():
+                return None
+        else:
+            if len(self.buffer) < self._content_length:
+                return None
+            self._body = self.buffer[: self._content_length]
+            del self.buffer[: self._content_length]
+
+        request = self._request
+        assert request is not None
+        request.content = bytes(self._body)
+        self._reset()
+        return request
+
+    def _read_head(self) -> bool:
+        end = self.buffer.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.buffer) > self.max_header_bytes:
+                raise HTTPError(431, "header too large")
+            return False
+
+        end += 4
+        if end > self.max_header_bytes:
+            raise HTTPError(431, "header too large")
+
+        request = parse_request(bytes(self.buffer[:end]))
+        del self.buffer[:end]
+        if request is None:
+            raise HTTPError(400, "malformed request")
+
+        transfer_encoding = request.headers.get(b"Transfer-Encoding")
+        content_lengths = request.headers.get_all(b"Content-Length")
+        if len(set(val.strip() for val in content_lengths)) > 1:
+            # Which one a proxy in front of us went by is anyone's guess
+            raise HTTPError(400, "conflicting content lengths")
+        content_length = content_lengths[0] if content_lengths else None
+        if transfer_encoding is not None:
+            if transfer_encoding.strip().lower() != b"chunked":
+                raise HTTPError(501, "unsupported transfer encoding")
+            self._chunked = True
+        elif content_length is not None:
+            if not content_length.strip().isdigit():
+                raise HTTPError(400, "invalid content length")
+            self._content_length = int(content_length)
+            if self._content_length > self.max_body_bytes:
+                raise HTTPError(413, "body too large")
+
+        self._request = request
+        return True
+
+    def _read_chunks(self) -> bool:
+        """Decodes as many chunks as are buffered. Returns True once the
+        terminating chunk and trailers have been consumed"""
+        while True:
+            if self._chunk_remaining < 0:
+                # Waiting on a chunk size line
+                line_end = self.buffer.find(b"\r\n")
+                if line_end < 0:
+                    if len(self.buffer) > self.max_header_bytes:
+                        raise HTTPError(400, "chunk size line too long")
+                    return False
+                size_str = bytes(self.buffer[:line_end]).split(b";", maxsplit=1)[0]
+                size_str = size_str.rstrip(b" \t")  # Allowed before extensions
+                if CHUNK_SIZE.fullmatch(size_str) is None:
+                    raise HTTPError(400, "invalid chunk size")
+                self._chunk_remaining = int(size_str, 16)
+                del self.buffer[: line_end + 2]
+
+                if len(self._body) + self._chunk_remaining > self.max_body_bytes:
+                    raise HTTPError(413, "body too large")
+
+            if self._chunk_remaining == 0:
+                # Last chunk, skip any trailers up until the empty line
+                while True:
+                    line_end = self.buffer.find(b"\r\n")
+                    if line_end < 0:
+                        if len(self.buffer) > self.max_header_bytes:
+                            raise HTTPError(431, "trailers too large")
+                        return False
+                    del self.buffer[: line_end + 2]
+                    if line_end == 0:
+                        return True
+
+            chunk_end = self._chunk_remaining
+            if len(self.buffer) < chunk_end + 2:
+                return False
+            if not self.buffer.startswith(b"\r\n", chunk_end):
+                raise HTTPError(400, "malformed chunk")
+            self._body += self.buffer[:chunk_end]
+            del self.buffer[: chunk_end + 2]
+            self._chunk_remaining = -1
+
+
+def is_file_body(data: Body) -> bool:
+    return not isinstance(data, (bytes, PushStream)) and hasattr(data, "read")
+
+
+def body_length(data: Body) -> Optional[int]:
+    """Number of bytes left to send in a response body, or None if it is
+    streamed from an iterator and so isn't known up front"""
+    if isinstance(data, bytes):
+        return len(data)
+    if not is_file_body(data):
+        return None
+    data = cast(BinaryIO, data)
+    position = data.tell()
+    end = data.seek(0, os.SEEK_END)
+    data.seek(position)
+    return end - position
 
-def encode_page(response: HTTPResponse) -> bytes:
+
+def encode_head(response: HTTPResponse) -> bytes:
+    """Encodes the status line and headers, up to and including the blank
+    line that separates them from the body"""
     status_line = f"HTTP/1.1 {response.status_code} {STATUS_CODE_TO_REASON[response.status_code]}".encode(
         "utf-8"
     )
     headers = b"\r\n".join(a + b": " + b for a, b in response.headers)
-    return status_line + b"\r\n" + headers + b"\r\n\r\n" + response.data
-
+    return status_line + b"\r\n" + headers + b"\r\n\r\n"
 
-def serve_page(
-    server_config: _Config,
-    http_socket: socket.socket,
-    page_handler: Callable[[HTTPRequest], HTTPResponse],
-) -> bool:
-    """A dumb http server that can serve multiple page. Can only service a single client per
-    call. Returns True if a client was serviced"""
-    try:
-        client_socket, addr = http_socket.accept()
-    except OSError:
-        return False
 
-    try:
-        log.info("client_connected", {"addr": addr})
-        raw = get_data_from_client(client_socket)
-        if raw is not None:
-            page_request = parse_request(raw)
-            if page_request is not None:
-                log.info("requesting_page", {"addr": addr, "url": page_request.url})
-                try:
-                    page_response = page_handler(page_request)
-                except Exception as err:
-                    page_response = page_handler(
-                        HTTPRequest(
-                            method="GET",
-                            url="/500.html",
-                            content=b"",
-                            headers=[],
-                            query_params=[],
-                        )
-                    )
-                    log.error(
-                        "endpoint_failure",
-                        {"exception": str(err), "url": page_request.url},
-                    )
-
-                log.info(
-                    "endpoint_response",
-                    {
-                        "addr": addr,
-                        "url": page_request.url,
-                        "status_code": page_response.status_code,
-                    },
-                )
-                page_bytes = encode_page(page_response)
-                send_response_bytes(server_config, client_socket, page_bytes)
-    except Exception as err:
-        log.error("server_failure", {"exception": str(err)})
-
-    client_socket.close()
-    return True
+def encode_page(response: HTTPResponse) -> bytes:
+    data = response.data
+    if is_file_body(data):
+        data = cast(BinaryIO, data).read()
+    elif isinstance(data, PushStream):
+        raise ValueError("a PushStream never has a whole body to encode")
+    elif not isinstance(data, bytes):
+        data = b"".join(data)
+    return encode_head(response) + data
 
 
 STATUS_CODE_TO_REASON = {
@@ -240,6 +600,7 @@ STATUS_CODE_TO_REASON = {
     415: "Unsupported Media Type",
     416: "Requested range not satisfiable",
     417: "Expectation Failed",
+    431: "Request Header Fields Too Large",
     500: "Internal Server Error",
     501: "Not Implemented",
     502: "Bad Gateway",
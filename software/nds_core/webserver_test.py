@@ -1,4 +1,13 @@
-from .webserver import parse_request, encode_page, HTTPResponse
+import pytest
+
+from .config import _Config
+from .webserver import (
+    parse_request,
+    encode_page,
+    HTTPResponse,
+    HTTPError,
+    RequestReader,
+)
 
 
 def test_parse_garbage_returns_none() -> None:
@@ -20,7 +29,7 @@ def test_parse_simple_get_request() -> None:
     assert parsed is not None
     assert parsed.url == "/hello.htm"
     assert parsed.method == "GET"
-    assert parsed.headers == [
+    assert parsed.headers.items() == [
         (b"User-Agent", b"Mozilla/4.0 (compatible; MSIE5.01; Windows NT)"),
         (b"Host", b"www.tutorialspoint.com"),
         (b"Accept-Language", b"en-us"),
@@ -31,6 +40,28 @@ def test_parse_simple_get_request() -> None:
     assert parsed.content == b""
 
 
+def test_parse_request_accessors() -> None:
+    parsed = parse_request(
+        b"POST /reply?a=b%20c&d&e= HTTP/1.1\r\n"
+        b"content-type: application/x-www-form-urlencoded\r\n"
+        b"Cookie: theme=dark; nds_core_auth=abc=\r\n"
+        b"\r\n"
+        b"post_content=hello+world&thread_id=3"
+    )
+    assert parsed is not None
+    assert parsed.url == "/reply"
+    assert parsed.query_params == [("a", "b c"), ("d", ""), ("e", "")]
+    assert parsed.get_query_param("a") == "b c"
+    assert parsed.headers.get(b"Content-Type") == b"application/x-www-form-urlencoded"
+    assert parsed.cookies == [("theme", "dark"), ("nds_core_auth", "abc=")]
+    assert parsed.get_form_value(b"post_content") == b"hello world"
+    assert parsed.get_form_value(b"missing") is None
+
+    parsed = parse_request(b"GET / HTTP/1.1\r\n\r\n")
+    assert parsed is not None
+    assert parsed.query_params == []
+
+
 def test_encode_simple_response() -> None:
     response = HTTPResponse(
         status_code=200,
@@ -47,3 +78,85 @@ def test_encode_simple_response() -> None:
         b"\r\n"
         b"argle"
     )
+
+
+def make_reader() -> RequestReader:
+    server_config = _Config()
+    server_config.WEBSERVER_MAX_HEADER_BYTES = 128
+    server_config.WEBSERVER_MAX_BODY_BYTES = 64
+    return RequestReader(server_config)
+
+
+def test_reader_waits_for_content_length() -> None:
+    reader = make_reader()
+    reader.feed(b"POST /reply HTTP/1.1\r\nContent-Length: 10\r\n\r\nhello")
+    assert reader.read_request() is None
+
+    reader.feed(b"worldGET")
+    request = reader.read_request()
+    assert request is not None
+    assert request.url == "/reply"
+    assert request.content == b"helloworld"
+
+    # Bytes past the end of the body belong to the next request
+    assert reader.read_request() is None
+    assert reader.buffer == b"GET"
+
+
+def test_reader_decodes_chunked_body() -> None:
+    reader = make_reader()
+    reader.feed(b"POST / HTTP/1.1\r\ntransfer-encoding: chunked\r\n\r\n5\r\nhel")
+    assert reader.read_request() is None
+
+    reader.feed(b"lo\r\n6;ext=1\r\n world\r\n0\r\nTrailer: x\r\n\r\n")
+    request = reader.read_request()
+    assert request is not None
+    assert request.content == b"hello world"
+    assert reader.buffer == b""
+
+
+@pytest.mark.parametrize(
+    "size", [b"-2", b"+5", b"0x5", b"1_0", b" 5", b"", b"g", b"1" * 17]
+)
+def test_reader_rejects_invalid_chunk_sizes(size: bytes) -> None:
+    reader = make_reader()
+    reader.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n")
+    reader.feed(size + b"\r\nhello\r\n0\r\n\r\n")
+    with pytest.raises(HTTPError) as err:
+        reader.read_request()
+    assert err.value.status_code == 400
+
+
+def test_reader_rejects_conflicting_content_lengths() -> None:
+    reader = make_reader()
+    reader.feed(b"POST / HTTP/1.1\r\nContent-Length: 5\r\nContent-Length: 6\r\n\r\n")
+    with pytest.raises(HTTPError) as err:
+        reader.read_request()
+    assert err.value.status_code == 400
+
+    # Repeating the same length is harmless
+    reader = make_reader()
+    reader.feed(b"POST / HTTP/1.1\r\nContent-Length: 5\r\nContent-Length: 5\r\n\r\n")
+    reader.feed(b"hello")
+    request = reader.read_request()
+    assert request is not None and request.content == b"hello"
+
+
+def test_reader_enforces_limits() -> None:
+    reader = make_reader()
+    reader.feed(b"GET / HTTP/1.1\r\nX-Big: " + b"a" * 200)
+    with pytest.raises(HTTPError) as err:
+        reader.read_request()
+    assert err.value.status_code == 431
+
+    reader = make_reader()
+    reader.feed(b"POST / HTTP/1.1\r\nContent-Length: 65\r\n\r\n")
+    with pytest.raises(HTTPError) as err:
+        reader.read_request()
+    assert err.value.status_code == 413
+
+    reader = make_reader()
+    reader.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n41\r\n")
+    with pytest.raises(HTTPError) as err:
+        reader.read_request()
+    assert err.value.status_code == 413
@@ -0,0 +1,58 @@
+import queue
+import threading
+from typing import Callable, List, Optional
+
+from . import log
+
+Job = Callable[[], None]
+
+
+class QueueFull(Exception):
+    queue_depth: int
+
+    def __init__(self, queue_depth: int):
+        self.queue_depth = queue_depth
+
+
+class WorkerPool:
+    """A fixed set of threads pulling jobs off a bounded queue. Submitting
+    never blocks, if the queue is full the job is refused with QueueFull so
+    the caller can shed load instead of queuing without limit."""
+
+    jobs: "queue.Queue[Optional[Job]]"
+    threads: List[threading.Thread]
+
+    def __init__(self, num_threads: int, queue_depth: int, name: str):
+        self.jobs = queue.Queue(maxsize=queue_depth)
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(num_threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job: Job) -> None:
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            raise QueueFull(self.jobs.maxsize)
+
+    def queued(self) -> int:
+        return self.jobs.qsize()
+
+    def shutdown(self) -> None:
+        """Lets queued jobs finish, then stops the threads"""
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as err:
+                log.error("worker_job_failure", {"exception": str(err)})